@@ -0,0 +1,66 @@
+import random
+import numpy as np
+import pytest
+
+@pytest.fixture(autouse=True)
+def seed():
+	random.seed(0)
+	np.random.seed(0)
+
+@pytest.fixture
+def make_batch():
+	"""Returns a factory of random SampleBatches, as the buffers store them: with a priority column constant over the batch, and the batch type in the infos of every transition.
+	The batch type is the one given by clustering_scheme, if any. The other columns (e.g. actions) are passed as keyword arguments."""
+	from ray.rllib.policy.sample_batch import SampleBatch
+	def make_batch(size=2, priority=None, priority_id='td_errors', batch_type='none', clustering_scheme=None, obs_shape=(3,), **columns):
+		batch = SampleBatch({
+			SampleBatch.OBS: np.random.rand(size,*obs_shape).astype(np.float32),
+			SampleBatch.REWARDS: np.random.rand(size),
+			priority_id: np.full(size, np.random.rand() if priority is None else priority),
+			**columns,
+		})
+		if clustering_scheme is not None:
+			batch_type = clustering_scheme.get_batch_type(batch)
+		batch[SampleBatch.INFOS] = np.array([{'batch_type': batch_type} for _ in range(size)], dtype=object)
+		return batch
+	return make_batch
+
+@pytest.fixture
+def buffer_options():
+	"""The options of a small prioritized buffer, whose priorities are the td_errors of the batches of make_batch."""
+	return {
+		'priority_id': 'td_errors',
+		'priority_aggregation_fn': 'np.mean',
+		'global_size': 64,
+		'prioritization_importance_beta': 0.4,
+	}
+
+@pytest.fixture
+def make_buffer():
+	"""Returns a factory of PseudoPrioritizedBuffers, whose priorities are the td_errors of the batches of make_batch."""
+	from xarl.experience_buffers.buffer.pseudo_prioritized_buffer import PseudoPrioritizedBuffer
+	def make_buffer(**buffer_options):
+		return PseudoPrioritizedBuffer(**{'priority_id': 'td_errors', 'priority_aggregation_fn': 'np.mean', 'seed': 0, **buffer_options})
+	return make_buffer
+
+@pytest.fixture
+def make_local_replay_buffer(buffer_options):
+	"""Returns a factory of LocalReplayBuffers with buffer_options, that can replay as soon as they have a batch."""
+	from xarl.experience_buffers.replay_buffer import LocalReplayBuffer
+	def make_local_replay_buffer(**kwargs):
+		return LocalReplayBuffer(**{'buffer_options': buffer_options, 'learning_starts': 1, 'seed': 0, **kwargs})
+	return make_local_replay_buffer
+
+@pytest.fixture
+def assert_same_batch():
+	def assert_same_batch(batch, expected_batch):
+		assert type(batch) is type(expected_batch)
+		assert sorted(batch.keys()) == sorted(expected_batch.keys())
+		for k in expected_batch.keys():
+			assert batch[k].dtype == expected_batch[k].dtype
+			assert batch[k].shape == expected_batch[k].shape
+			if batch[k].dtype == object:
+				assert list(batch[k]) == list(expected_batch[k])
+			else:
+				assert np.array_equal(batch[k], expected_batch[k])
+	return assert_same_batch
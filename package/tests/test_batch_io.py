@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("ray.rllib")
+
+from ray.rllib.policy.sample_batch import SampleBatch
+
+from xarl.experience_buffers.buffer.batch_io import save_batches, load_batches
+
+def test_save_load_batches_round_trip(tmp_path, make_batch, assert_same_batch):
+	batch_list = []
+	for i,size in enumerate([1,4,2,5,3,3]): # different lengths and columns
+		batch = make_batch(size, batch_type=('none',i), actions=np.random.randint(0, 4, size))
+		if i%3 != 0:
+			batch[SampleBatch.NEXT_OBS] = np.random.rand(size,3).astype(np.float32)
+		batch_list.append(batch)
+	save_batches(str(tmp_path), batch_list)
+	loaded_batch_list = list(load_batches(str(tmp_path)))
+	assert len(loaded_batch_list) == len(batch_list)
+	for batch, expected_batch in zip(loaded_batch_list, batch_list):
+		assert_same_batch(batch, expected_batch)
+
+	# The loaded rows are copies in RAM, they can be changed without touching the saved ones
+	for batch in loaded_batch_list:
+		assert not isinstance(batch[SampleBatch.OBS], np.memmap)
+		batch[SampleBatch.OBS] += 1
+	for batch, expected_batch in zip(load_batches(str(tmp_path)), batch_list):
+		assert_same_batch(batch, expected_batch)
+
+def test_save_load_no_batches(tmp_path):
+	save_batches(str(tmp_path), [])
+	assert list(load_batches(str(tmp_path))) == []
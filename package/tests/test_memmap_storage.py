@@ -0,0 +1,82 @@
+import gc
+import os
+import random
+import pytest
+
+pytest.importorskip("ray.rllib")
+
+from ray.rllib.policy.sample_batch import SampleBatch
+
+from xarl.experience_buffers.buffer.columnar_storage import ColumnarBatchStorage
+from xarl.experience_buffers.buffer.memmap_storage import MemmapBatchStorage
+
+@pytest.mark.parametrize("cache_size", [0, 3])
+@pytest.mark.parametrize("max_rows", [None, 20])
+def test_memmap_storage_behaves_like_a_list(tmp_path, max_rows, cache_size, make_batch, assert_same_batch):
+	storage_list = [
+		ColumnarBatchStorage(max_rows=max_rows),
+		MemmapBatchStorage(max_rows=max_rows, directory=str(tmp_path), cache_size=cache_size),
+	]
+	batch_list = []
+	for _ in range(100):
+		operation = random.random()
+		if not batch_list or operation < 0.5: # append, growing the storage
+			if len(batch_list) == max_rows:
+				continue
+			batch = make_batch()
+			batch_list.append(batch)
+			for storage in storage_list:
+				storage.append(batch)
+		elif operation < 0.7: # pop
+			batch_list.pop()
+			for storage in storage_list:
+				storage.pop()
+		elif operation < 0.85: # move, as when a batch is evicted by swapping it with the last one
+			src_idx, dst_idx = random.randrange(len(batch_list)), random.randrange(len(batch_list))
+			batch_list[dst_idx] = batch_list[src_idx]
+			for storage in storage_list:
+				storage.move(src_idx, dst_idx)
+		else: # changing a returned batch does not change the stored one
+			for storage in storage_list:
+				storage[random.randrange(len(batch_list))][SampleBatch.OBS] += 1
+		idx_list = [random.randrange(len(batch_list)) for _ in range(4)] if batch_list else []
+		for storage in storage_list:
+			assert len(storage) == len(batch_list)
+			for idx in idx_list:
+				assert_same_batch(storage[idx], batch_list[idx])
+			for idx, batch in zip(idx_list, storage.gather(idx_list)):
+				assert_same_batch(batch, batch_list[idx])
+			if batch_list:
+				assert storage.get_count(0) == batch_list[0].count
+
+def test_memmap_storage_removes_its_files(tmp_path, make_batch):
+	storage = MemmapBatchStorage(directory=str(tmp_path))
+	for _ in range(10):
+		storage.append(make_batch())
+	assert len(os.listdir(tmp_path)) == 1
+	assert len(os.listdir(os.path.join(tmp_path, os.listdir(tmp_path)[0]))) == 3 # one file per column, except the infos; the ones of the smaller arrays are removed when the storage grows
+	del storage
+	gc.collect()
+	assert os.listdir(tmp_path) == []
+
+def test_memmap_buffer_save_load_sample_round_trip(tmp_path, make_batch, make_buffer, assert_same_batch):
+	buffer_options = {
+		'global_size': 32,
+		'memmap_directory': str(tmp_path / 'memmap'),
+		'memmap_cache_size': 2,
+	}
+	buffer = make_buffer(**buffer_options)
+	for i in range(40):
+		buffer.add(make_batch(), type_id=i%3)
+	buffer.save(str(tmp_path / 'buffer'))
+	loaded_buffer = make_buffer(**buffer_options)
+	loaded_buffer.load(str(tmp_path / 'buffer'))
+	assert [len(type_batch) for type_batch in loaded_buffer.batches] == [len(type_batch) for type_batch in buffer.batches]
+	for type_batch, loaded_type_batch in zip(buffer.batches, loaded_buffer.batches):
+		assert isinstance(loaded_type_batch, MemmapBatchStorage)
+		for batch, loaded_batch in zip(type_batch, loaded_type_batch):
+			batch.pop('batch_ids'), loaded_batch.pop('batch_ids') # the loaded batches get new ids
+			assert_same_batch(loaded_batch, batch)
+	for _ in range(10):
+		for batch in loaded_buffer.sample(n=4):
+			assert batch.count == 2
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("ray.rllib")
+
+from ray.rllib.policy.sample_batch import SampleBatch
+
+from xarl.experience_buffers.buffer.obs_deduplication import can_deduplicate_obs, split_new_obs, merge_new_obs
+
+def make_trajectory(size, episode_ends=(), transition_id=0):
+	"""Returns a batch of contiguous transitions, whose new_obs[t] is obs[t+1] except at episode_ends and at the last row."""
+	frames = np.random.rand(size+1,2,2).astype(np.float32)
+	obs = frames[:-1].copy()
+	new_obs = frames[1:].copy()
+	for t in episode_ends:
+		new_obs[t] = np.random.rand(2,2) # the terminal observation is not the next obs
+	return SampleBatch({
+		SampleBatch.OBS: obs,
+		SampleBatch.NEXT_OBS: new_obs,
+		SampleBatch.REWARDS: np.random.rand(size),
+		'transition_ids': np.arange(transition_id, transition_id+size),
+		'td_errors': np.full(size, np.random.rand()),
+		SampleBatch.INFOS: np.array([{} for _ in range(size)], dtype=object),
+	})
+
+def test_split_merge_new_obs_round_trip():
+	batch = make_trajectory(8, episode_ends=(2,5))
+	assert can_deduplicate_obs(batch)
+	rows, frames = split_new_obs(batch)
+	assert list(rows) == [2,5,7]
+	assert np.array_equal(merge_new_obs(batch[SampleBatch.OBS], rows, frames), batch[SampleBatch.NEXT_OBS])
+	# A single transition is its own last row
+	batch = make_trajectory(1)
+	rows, frames = split_new_obs(batch)
+	assert list(rows) == [0]
+	assert np.array_equal(merge_new_obs(batch[SampleBatch.OBS], rows, frames), batch[SampleBatch.NEXT_OBS])
+
+def test_can_deduplicate_obs():
+	batch = make_trajectory(3)
+	assert can_deduplicate_obs(batch)
+	assert not can_deduplicate_obs(SampleBatch({SampleBatch.OBS: batch[SampleBatch.OBS]}))
+	assert not can_deduplicate_obs(SampleBatch({SampleBatch.OBS: batch[SampleBatch.OBS], SampleBatch.NEXT_OBS: batch[SampleBatch.NEXT_OBS].astype(np.float64)}))
+	assert not can_deduplicate_obs(SampleBatch({SampleBatch.OBS: batch[SampleBatch.OBS], SampleBatch.NEXT_OBS: batch[SampleBatch.NEXT_OBS][:,0]}))
+
+@pytest.mark.parametrize("storage", ["list", "columnar", "memmap"])
+def test_deduplicated_buffer_returns_the_original_new_obs(tmp_path, storage, make_buffer):
+	buffer_options = {
+		'global_size': 32,
+		'deduplicate_observations': True,
+		'columnar_storage': storage == 'columnar',
+		'memmap_directory': str(tmp_path / 'memmap') if storage == 'memmap' else None,
+	}
+	buffer = make_buffer(**buffer_options)
+	new_obs_dict = {}
+	for i in range(12):
+		batch = make_trajectory(4, episode_ends=(1,) if i%2 else (), transition_id=4*i)
+		for transition_id, new_obs in zip(batch['transition_ids'], batch[SampleBatch.NEXT_OBS]):
+			new_obs_dict[transition_id] = new_obs.copy()
+		buffer.add(batch, type_id=i%2)
+
+	def assert_original_new_obs(buffer):
+		for _ in range(10):
+			for batch in buffer.sample(n=4):
+				for transition_id, new_obs in zip(batch['transition_ids'], batch[SampleBatch.NEXT_OBS]):
+					assert np.array_equal(new_obs, new_obs_dict[transition_id])
+
+	assert_original_new_obs(buffer)
+	# The stored batches do not hold new_obs, if it could be deduplicated
+	if storage == 'list':
+		assert all(SampleBatch.NEXT_OBS not in batch for type_batch in buffer.batches for batch in type_batch)
+
+	# So do the saved and loaded ones
+	buffer.save(str(tmp_path / 'buffer'))
+	loaded_buffer = make_buffer(**buffer_options)
+	loaded_buffer.load(str(tmp_path / 'buffer'))
+	assert loaded_buffer.count() == buffer.count()
+	assert_original_new_obs(loaded_buffer)
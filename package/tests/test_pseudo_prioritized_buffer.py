@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("ray.rllib")
+
+from ray.rllib.policy.sample_batch import SampleBatch
+
+from xarl.utils.segment_tree import segment_tree_backends
+
+def get_arrays_nbytes(batch):
+	return sum(batch[k].nbytes for k in batch.keys() if isinstance(batch[k], np.ndarray))
+
+def test_max_bytes_counts_and_evicts_sample_batches(make_batch, make_buffer):
+	batch_nbytes = get_arrays_nbytes(make_batch(size=4)) + 4*(8+4) # the buffer adds the batch_ids and weights columns
+	buffer = make_buffer(global_size=100, max_bytes=10*batch_nbytes)
+	for i in range(30):
+		buffer.add(make_batch(size=4), type_id=i%3)
+		stored_batches = [batch for batches in buffer.batches for batch in batches]
+		assert buffer._stored_nbytes == sum(map(get_arrays_nbytes, stored_batches)) # the infos' dicts are not counted
+		assert buffer._stored_nbytes <= 10*batch_nbytes
+	assert buffer.count() == 10
+	stats = buffer.stats()
+	assert stats['stored_nbytes'] == 10*batch_nbytes
+	assert sum(stats['cluster_nbytes'].values()) == 10*batch_nbytes
+
+def sample_weights_of_degenerate_clusters(make_batch, make_buffer, segment_tree_backend):
+	buffer = make_buffer(segment_tree_backend=segment_tree_backend)
+	buffer.add(make_batch(size=1, priority=-1.), type_id=0, update_prioritisation_weights=True) # the only batch of its cluster has the historical min priority, its normalised priority mass is 0
+	buffer.add(make_batch(size=1, priority=2.), type_id=1, update_prioritisation_weights=True)
+	buffer.add(make_batch(size=1, priority=3.), type_id=1, update_prioritisation_weights=True)
+	return [batch['weights'] for batch in buffer.sample(4)]
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning") # 0/0
+@pytest.mark.parametrize("segment_tree_backend", sorted(segment_tree_backends.keys()))
+def test_degenerate_cluster_weights_do_not_depend_on_backend(make_batch, make_buffer, segment_tree_backend):
+	expected_weights = sample_weights_of_degenerate_clusters(make_batch, make_buffer, 'python')
+	np.random.seed(0)
+	weights = sample_weights_of_degenerate_clusters(make_batch, make_buffer, segment_tree_backend)
+	np.testing.assert_array_equal(weights, expected_weights)
+
+@pytest.mark.parametrize("columnar_storage", [False, True])
+@pytest.mark.parametrize("prioritized_drop_probability", [0, 0.5])
+def test_rarest_cluster_is_moved_to_overflow(make_batch, make_buffer, prioritized_drop_probability, columnar_storage):
+	buffer = make_buffer(global_size=100, max_clusters=3, prioritized_drop_probability=prioritized_drop_probability, columnar_storage=columnar_storage, debug_checks=True)
+	for _ in range(10):
+		buffer.add(make_batch(), type_id='a')
+	for _ in range(2):
+		buffer.add(make_batch(), type_id='b')
+	b_batches = {batch['batch_ids'][0]: (batch[SampleBatch.OBS].copy(), buffer.get_priority(idx, 'b')) for idx,batch in enumerate(buffer.batches[buffer.get_type('b')])}
+	# A new label rarer than b goes to the overflow cluster
+	buffer.add(make_batch(), type_id='c')
+	assert buffer.type_keys == ['a', 'b', 'overflow']
+	# Once it is more frequent than b, b is moved to the overflow cluster, keeping its batches and their priorities
+	buffer.add(make_batch(), type_id='c')
+	assert sorted(buffer.type_keys) == ['a', 'c', 'overflow']
+	assert buffer.get_cluster_size('overflow') == 3 and buffer.get_cluster_size('c') == 1
+	assert buffer.count() == 14
+	for batch_id, (obs, priority) in b_batches.items():
+		type_, idx = buffer.get_batch_location(batch_id)
+		assert buffer.type_keys[type_] == 'overflow'
+		assert np.array_equal(buffer.batches[type_][idx][SampleBatch.OBS], obs)
+		assert buffer.get_priority(idx, 'overflow') == pytest.approx(priority)
+	# The overflow cluster is sampled and evicted as any other
+	for _ in range(100):
+		buffer.add(make_batch(), type_id='a')
+		for batch in buffer.sample(2):
+			assert buffer.get_batch_location(batch['batch_ids'][0]) is not None
+	# Reading the stats does not reset them
+	for _ in range(2):
+		routing_stats = buffer.stats()['cluster_routing']
+		assert routing_stats['routed_labels'] == {'c': 1}
+		assert routing_stats['routed_batches'] == 1 and routing_stats['demoted_clusters'] == 1
+	buffer.reset_routing_stats()
+	assert buffer.stats()['cluster_routing']['routed_labels'] == {}
@@ -0,0 +1,53 @@
+import threading
+import pytest
+
+from xarl.utils.read_write_lock import LightReadWriteLock
+
+def run_in_thread(fn):
+	thread = threading.Thread(target=fn, daemon=True)
+	thread.start()
+	return thread
+
+def test_readers_share_the_lock_and_writers_wait_for_them():
+	lock = LightReadWriteLock()
+	readers_inside = threading.Barrier(3, timeout=5)
+	release_readers = threading.Event()
+	def read():
+		with lock.reading():
+			readers_inside.wait() # both readers hold the lock at once
+			release_readers.wait(5)
+	reader_threads = [run_in_thread(read) for _ in range(2)]
+	readers_inside.wait()
+	writer_done = threading.Event()
+	def write():
+		with lock.writing():
+			writer_done.set()
+	writer_thread = run_in_thread(write)
+	assert not writer_done.wait(0.2)
+	release_readers.set()
+	assert writer_done.wait(5)
+	for thread in reader_threads + [writer_thread]:
+		thread.join(5)
+		assert not thread.is_alive()
+
+def test_write_lock_is_reentrant_and_can_be_downgraded():
+	lock = LightReadWriteLock()
+	with lock.writing():
+		with lock.writing(): # e.g. a callback run under the lock updates the priorities
+			pass
+		with pytest.raises(AssertionError):
+			with lock.writing():
+				lock.downgrade() # re-acquired, it cannot be downgraded
+	lock.acquire_write()
+	lock.downgrade()
+	# Other readers can join, writers cannot
+	reader_done = threading.Event()
+	writer_done = threading.Event()
+	reader_thread = run_in_thread(lambda: (lock.acquire_read(), reader_done.set(), lock.release_read()))
+	assert reader_done.wait(5)
+	writer_thread = run_in_thread(lambda: (lock.acquire_write(), writer_done.set(), lock.release_write()))
+	assert not writer_done.wait(0.2)
+	lock.release_read()
+	assert writer_done.wait(5)
+	reader_thread.join(5)
+	writer_thread.join(5)
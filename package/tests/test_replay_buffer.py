@@ -0,0 +1,128 @@
+import threading
+import pytest
+
+pytest.importorskip("ray.rllib")
+
+from ray.rllib.policy.sample_batch import SampleBatch, DEFAULT_POLICY_ID
+
+from xarl.experience_buffers.clustering_scheme import H
+
+def get_clusters(local_replay_buffer):
+	replay_buffer = local_replay_buffer.replay_buffers[DEFAULT_POLICY_ID]
+	clusters = {
+		type_id: sorted(map(lambda x: x[SampleBatch.OBS].tobytes(), replay_buffer.batches[replay_buffer.get_type(type_id)]))
+		for type_id in replay_buffer.type_keys
+	}
+	if local_replay_buffer.prioritized_replay:
+		priorities = {
+			type_id: sorted(
+				replay_buffer._sample_priority_tree[replay_buffer.get_type(type_id)][i]
+				for i in range(replay_buffer._sample_priority_tree[replay_buffer.get_type(type_id)].inserted_elements)
+			)
+			for type_id in replay_buffer.type_keys
+		}
+		return clusters, priorities
+	return clusters
+
+@pytest.mark.parametrize("prioritized_replay", [True, False])
+def test_save_load_sample_round_trip(tmp_path, make_batch, make_local_replay_buffer, buffer_options, prioritized_replay):
+	buffer_options = buffer_options if prioritized_replay else {'global_size': 64}
+	clustering_scheme = H()
+	local_replay_buffer = make_local_replay_buffer(prioritized_replay=prioritized_replay, buffer_options=buffer_options, clustering_scheme=clustering_scheme)
+	for _ in range(20):
+		local_replay_buffer.add_batch(make_batch(clustering_scheme=clustering_scheme))
+	local_replay_buffer.save(str(tmp_path))
+
+	loaded_clustering_scheme = H()
+	loaded_replay_buffer = make_local_replay_buffer(prioritized_replay=prioritized_replay, buffer_options=buffer_options, clustering_scheme=loaded_clustering_scheme)
+	loaded_replay_buffer.load(str(tmp_path))
+	assert loaded_replay_buffer.num_added == local_replay_buffer.num_added
+	assert get_clusters(loaded_replay_buffer) == get_clusters(local_replay_buffer)
+	assert loaded_clustering_scheme.batch_stats.mean == clustering_scheme.batch_stats.mean
+	assert loaded_clustering_scheme.get_state()['config'] == clustering_scheme.get_state()['config']
+
+	# The loaded buffer can be sampled and keeps on growing, with batch ids that do not clash
+	loaded_replay_buffer.add_batch(make_batch(clustering_scheme=loaded_clustering_scheme))
+	replay_buffer = loaded_replay_buffer.replay_buffers[DEFAULT_POLICY_ID]
+	batch_ids = [batch['batch_ids'][0] for type_batch in replay_buffer.batches for batch in type_batch]
+	assert len(batch_ids) == 21 and len(set(batch_ids)) == len(batch_ids)
+	for batch in loaded_replay_buffer.replay(batch_count=4):
+		assert batch.policy_batches[DEFAULT_POLICY_ID].count == 2
+
+def test_load_checks_options(tmp_path, make_batch, make_local_replay_buffer, buffer_options):
+	clustering_scheme = H()
+	local_replay_buffer = make_local_replay_buffer(clustering_scheme=clustering_scheme)
+	for _ in range(20):
+		local_replay_buffer.add_batch(make_batch(clustering_scheme=clustering_scheme))
+	local_replay_buffer.save(str(tmp_path))
+
+	# A buffer with different options is left untouched
+	other_clustering_scheme = H()
+	other_replay_buffer = make_local_replay_buffer(buffer_options=dict(buffer_options, max_clusters=4), clustering_scheme=other_clustering_scheme)
+	other_replay_buffer.add_batch(make_batch(clustering_scheme=other_clustering_scheme))
+	clusters = get_clusters(other_replay_buffer)
+	with pytest.raises(AssertionError):
+		other_replay_buffer.load(str(tmp_path))
+	assert get_clusters(other_replay_buffer) == clusters
+	assert other_replay_buffer.num_added == 1
+
+	# So is a clustering scheme with different options
+	with pytest.raises(AssertionError):
+		make_local_replay_buffer(clustering_scheme=H(batch_window_size=4)).load(str(tmp_path))
+
+def test_update_replayed_fn_runs_under_the_buffer_locks(make_batch, make_local_replay_buffer):
+	clustering_scheme = H()
+	local_replay_buffer = make_local_replay_buffer(ratio_of_samples_from_unclustered_buffer=0.5)
+	for _ in range(10):
+		local_replay_buffer.add_batch(make_batch(clustering_scheme=clustering_scheme))
+	buffer_locks = [
+		local_replay_buffer._get_buffer_lock(buffers, DEFAULT_POLICY_ID)
+		for buffers in (local_replay_buffer.replay_buffers, local_replay_buffer.buffer_of_recent_elements)
+	]
+	updated_batch_ids = []
+	def update_replayed_fn(batch):
+		assert all(buffer_lock._writer == threading.get_ident() for buffer_lock in buffer_locks)
+		batch['gains'] = batch['td_errors'] + 1 # changes the stored batch, as xappo_postprocess_trajectory does
+		local_replay_buffer.update_priorities({DEFAULT_POLICY_ID: batch}) # takes the locks again
+		updated_batch_ids.append(batch['batch_ids'][0])
+		return batch
+	batch_list = local_replay_buffer.replay(batch_count=4, update_replayed_fn=update_replayed_fn)
+	assert len(batch_list) == 4 and updated_batch_ids
+	stored_batch_dict = {
+		batch['batch_ids'][0]: batch
+		for buffers in (local_replay_buffer.replay_buffers, local_replay_buffer.buffer_of_recent_elements)
+		for type_batch in buffers[DEFAULT_POLICY_ID].batches
+		for batch in type_batch
+	}
+	for batch_id in updated_batch_ids:
+		assert 'gains' in stored_batch_dict[batch_id]
+	# The locks are released
+	for buffer_lock in buffer_locks:
+		assert buffer_lock._writer is None and buffer_lock._readers == 0
+
+def test_concurrent_replays_share_the_buffer_lock(make_batch, make_local_replay_buffer):
+	clustering_scheme = H()
+	local_replay_buffer = make_local_replay_buffer()
+	for _ in range(20):
+		local_replay_buffer.add_batch(make_batch(clustering_scheme=clustering_scheme))
+	local_replay_buffer.replay(batch_count=2) # refreshes the cached priorities, nothing is written afterwards
+	buffer_lock = local_replay_buffer._get_buffer_lock(local_replay_buffer.replay_buffers, DEFAULT_POLICY_ID)
+	replay_buffer = local_replay_buffer.replay_buffers[DEFAULT_POLICY_ID]
+	samplers_inside = threading.Barrier(2, timeout=5)
+	sample = replay_buffer.sample
+	def shared_sample(n=1, recompute_priorities=True):
+		assert not recompute_priorities and buffer_lock._readers > 0
+		samplers_inside.wait() # both samplers hold the lock at once
+		return sample(n, recompute_priorities=recompute_priorities)
+	replay_buffer.sample = shared_sample
+	result_list = []
+	thread_list = [
+		threading.Thread(target=lambda: result_list.append(list(local_replay_buffer.replay(batch_count=2))), daemon=True)
+		for _ in range(2)
+	]
+	for thread in thread_list:
+		thread.start()
+	for thread in thread_list:
+		thread.join(10)
+		assert not thread.is_alive()
+	assert [len(x) for x in result_list] == [2, 2]
@@ -0,0 +1,131 @@
+import threading
+import time
+import numpy as np
+import pytest
+
+pytest.importorskip("ray.rllib")
+
+from ray.rllib.policy.sample_batch import SampleBatch, MultiAgentBatch, DEFAULT_POLICY_ID
+from ray.rllib.policy.policy import LEARNER_STATS_KEY
+
+from xarl.experience_buffers.replay_ops import get_update_train_batch_priorities_fn, get_update_replayed_batch_fn, ReplayPrefetcher, PrefetchReplay
+
+def get_leaves(replay_buffer):
+	return [
+		[tree[i] for i in range(tree.inserted_elements)]
+		for tree in replay_buffer._sample_priority_tree
+	]
+
+def test_update_train_batch_priorities_fn_updates_replayed_batches(make_batch, make_local_replay_buffer, buffer_options):
+	config = {'prioritized_replay': True, 'buffer_options': buffer_options}
+	local_replay_buffer = make_local_replay_buffer()
+	for i in range(20):
+		local_replay_buffer.add_batch(make_batch(batch_type=i%2))
+	replay_buffer = local_replay_buffer.replay_buffers[DEFAULT_POLICY_ID]
+	leaves = get_leaves(replay_buffer)
+
+	# Replay a train batch, as xadqn's execution plan does, and compute new td-errors for it
+	batch_list = [x.policy_batches[DEFAULT_POLICY_ID] for x in local_replay_buffer.replay(batch_count=4)]
+	train_batch = SampleBatch.concat_samples(batch_list)
+	assert 'batch_ids' in train_batch
+	td_errors = np.asarray(train_batch['td_errors']) + 10
+	update_priorities = get_update_train_batch_priorities_fn(local_replay_buffer, config)
+	update_priorities((
+		MultiAgentBatch({DEFAULT_POLICY_ID: train_batch}, train_batch.count),
+		{DEFAULT_POLICY_ID: {'td_error': td_errors, LEARNER_STATS_KEY: {}}}, # the info dict of TrainOneStep
+	))
+
+	new_leaves = get_leaves(replay_buffer)
+	assert new_leaves != leaves
+	for batch in batch_list:
+		type_id, idx = replay_buffer._batch_index[batch['batch_ids'][0]]
+		new_priority = replay_buffer.get_priority(idx, type_id)
+		assert new_priority == pytest.approx(replay_buffer.normalize_priority(np.mean(batch['td_errors'])+10))
+
+@pytest.mark.parametrize("copying_option", ['columnar_storage', 'deduplicate_observations'])
+def test_update_replayed_batch_fn_warns_when_replayed_batches_are_copies(caplog, make_local_replay_buffer, buffer_options, copying_option):
+	postprocess_trajectory = lambda policy, batch: batch
+	get_update_replayed_batch_fn(make_local_replay_buffer(), None, postprocess_trajectory)
+	assert 'not written back' not in caplog.text
+	get_update_replayed_batch_fn(make_local_replay_buffer(buffer_options=dict(buffer_options, **{copying_option: True})), None, postprocess_trajectory)
+	assert 'not written back' in caplog.text and copying_option in caplog.text
+
+class CountingReplayBuffer:
+	"""A replay buffer counting the replay calls, that can be told to fail."""
+
+	def __init__(self, make_batch, error=None):
+		self.make_batch = make_batch
+		self.replay_count = 0
+		self.error = error
+		self.lock = threading.Lock()
+
+	def can_replay(self):
+		return True
+
+	def replay(self, batch_count=1, cluster_overview_size=None, update_replayed_fn=None):
+		if self.error is not None:
+			raise self.error
+		with self.lock:
+			self.replay_count += 1
+		batch_list = [self.make_batch() for _ in range(batch_count)]
+		if update_replayed_fn:
+			batch_list = list(map(update_replayed_fn, batch_list))
+		return batch_list
+
+def wait_for(condition, timeout=5):
+	deadline = time.time() + timeout
+	while not condition() and time.time() < deadline:
+		time.sleep(0.01)
+	return condition()
+
+def test_prefetcher_keeps_at_most_prefetch_size_plus_one_train_batches_in_flight(make_batch):
+	local_buffer = CountingReplayBuffer(make_batch)
+	prefetcher = ReplayPrefetcher(local_buffer, replay_batch_size=2, prefetch_size=2, update_replayed_fn=lambda batch: batch)
+	replay_op = PrefetchReplay(prefetcher)
+	try:
+		train_batch = next(replay_op) # being trained on
+		assert train_batch.count == 4
+		assert wait_for(lambda: local_buffer.replay_count == 3)
+		time.sleep(0.1)
+		assert local_buffer.replay_count == 3 # the train batch being trained on, and 2 prefetched ones
+		next(replay_op) # the previous train batch is done
+		assert wait_for(lambda: local_buffer.replay_count == 4)
+		time.sleep(0.1)
+		assert local_buffer.replay_count == 4
+	finally:
+		prefetcher.stop()
+	assert not prefetcher.is_running()
+
+def test_prefetcher_restarts_after_stop(make_batch):
+	local_buffer = CountingReplayBuffer(make_batch)
+	prefetcher = ReplayPrefetcher(local_buffer, prefetch_size=1)
+	replay_op = PrefetchReplay(prefetcher)
+	next(replay_op)
+	thread = prefetcher.thread
+	prefetcher.stop()
+	assert not thread.is_alive()
+	next(replay_op) # the train batches prefetched before stopping are dropped
+	assert prefetcher.is_running()
+	prefetcher.stop()
+
+def test_prefetcher_raises_the_exceptions_of_its_thread(make_batch):
+	prefetcher = ReplayPrefetcher(CountingReplayBuffer(make_batch, error=ValueError('replay failed')), prefetch_size=1)
+	replay_op = PrefetchReplay(prefetcher)
+	with pytest.raises(ValueError, match='replay failed'):
+		next(replay_op)
+	prefetcher.stop()
+
+def test_prefetcher_restarts_after_an_exception(make_batch):
+	local_buffer = CountingReplayBuffer(make_batch, error=ValueError('replay failed'))
+	prefetcher = ReplayPrefetcher(local_buffer, prefetch_size=1)
+	with pytest.raises(ValueError, match='replay failed'):
+		next(PrefetchReplay(prefetcher))
+	assert not prefetcher.is_running()
+	local_buffer.error = None
+	result_list = []
+	thread = threading.Thread(target=lambda: result_list.append(next(PrefetchReplay(prefetcher))), daemon=True)
+	thread.start()
+	thread.join(5)
+	assert not thread.is_alive() # the next replay does not wait for the failed thread
+	assert result_list[0].count == 2
+	prefetcher.stop()
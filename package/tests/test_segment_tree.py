@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from xarl.utils.segment_tree import segment_tree_backends
+
+BACKENDS = [backend for backend in segment_tree_backends if backend != 'python']
+
+def get_state(tree, prefixsums):
+	"""Returns what the buffers read from a sum tree: its leaves, some range sums, its minimum and the indexes sampled at prefixsums."""
+	n = tree.inserted_elements
+	return {
+		'inserted_elements': n,
+		'leaves': [tree[i] for i in range(n)],
+		'sums': [tree.sum()] + [tree.sum(i, n) for i in range(0, n, 3)] + [tree.sum(0, i) for i in range(1, n, 3)],
+		'min': tree.min_tree.min(),
+		'idx': tree.find_prefixsum_idx_batch(prefixsums),
+		'first_idx': tree.find_prefixsum_idx(lambda mass: prefixsums[0]*mass),
+	}
+
+def assert_same_state(state, expected_state):
+	assert state['inserted_elements'] == expected_state['inserted_elements']
+	assert state['leaves'] == pytest.approx(expected_state['leaves'])
+	assert state['sums'] == pytest.approx(expected_state['sums'])
+	assert state['min'][0] == pytest.approx(expected_state['min'][0])
+	assert state['min'][1] == expected_state['min'][1]
+	assert list(state['idx']) == list(expected_state['idx'])
+	assert state['first_idx'] == expected_state['first_idx']
+
+def run_operations(backend, seed, with_negative_priorities):
+	"""Applies the same random operations to a sum tree of backend and returns its states after each of them."""
+	sum_tree_class, _ = segment_tree_backends[backend]
+	rng = np.random.RandomState(seed)
+	low = -1 if with_negative_priorities else 0
+	prefixsums = (np.arange(16) + rng.random_sample(16))/16 # stratified
+	state_list = []
+	# Build from an array
+	tree = sum_tree_class.from_array(rng.uniform(low, 1, 13).tolist(), capacity=16)
+	state_list.append(get_state(tree, prefixsums))
+	# Set some leaves, one by one
+	for idx in rng.choice(13, 5, replace=False):
+		tree[int(idx)] = float(rng.uniform(low, 1))
+	state_list.append(get_state(tree, prefixsums))
+	# Append new leaves
+	for idx in range(13, 16):
+		tree[idx] = float(rng.uniform(low, 1))
+	state_list.append(get_state(tree, prefixsums))
+	# Grow, then append after the old capacity
+	tree.resize(32)
+	for idx in range(16, 21):
+		tree[idx] = float(rng.uniform(low, 1))
+	state_list.append(get_state(tree, prefixsums))
+	# Update many leaves at once
+	idx_list = rng.choice(21, 8, replace=False)
+	tree.update(idx_list, rng.uniform(low, 1, 8))
+	state_list.append(get_state(tree, prefixsums))
+	# Shift all the leaves
+	tree.shift(0.5)
+	state_list.append(get_state(tree, prefixsums))
+	return state_list
+
+@pytest.mark.parametrize("with_negative_priorities", [False, True])
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_sum_tree_backends_are_equivalent(backend, with_negative_priorities):
+	for seed in range(5):
+		expected_state_list = run_operations('python', seed, with_negative_priorities)
+		state_list = run_operations(backend, seed, with_negative_priorities)
+		assert len(state_list) == len(expected_state_list)
+		for state, expected_state in zip(state_list, expected_state_list):
+			assert_same_state(state, expected_state)
+
+@pytest.mark.parametrize("backend", list(segment_tree_backends))
+def test_sum_tree_matches_numpy(backend):
+	sum_tree_class, _ = segment_tree_backends[backend]
+	rng = np.random.RandomState(0)
+	values = rng.uniform(0, 1, 23)
+	tree = sum_tree_class(32)
+	for idx, value in enumerate(values):
+		tree[idx] = float(value)
+	assert tree.inserted_elements == len(values)
+	assert tree.sum() == pytest.approx(np.sum(values))
+	assert tree.sum(5, 17) == pytest.approx(np.sum(values[5:17]))
+	assert tree.min_tree.min()[1] == np.argmin(values)
+	# The sampled index is the one whose segment of the cumulative sum holds the prefixsum
+	cumsum = np.cumsum(values)
+	for prefixsum in rng.uniform(0, 1, 20):
+		assert tree.find_prefixsum_idx(lambda mass: prefixsum*mass) == np.searchsorted(cumsum, prefixsum*cumsum[-1], side='right')
+	# Every backend returns the same kind of numbers
+	assert isinstance(tree.sum(), (float, np.floating))
+
+@pytest.mark.parametrize("with_negative_priorities", [False, True])
+def test_batch_descent_matches_one_by_one(with_negative_priorities):
+	sum_tree_class, _ = segment_tree_backends['python']
+	rng = np.random.RandomState(0)
+	low = -1 if with_negative_priorities else 0
+	for capacity in [2, 64, 1024]:
+		tree = sum_tree_class.from_array(rng.uniform(low, 1, capacity).tolist())
+		prefixsums = (np.arange(256) + rng.random_sample(256))/256 # enough to descend the tree together
+		assert tree.find_prefixsum_idx_batch(prefixsums) == [tree.find_prefixsum_idx(lambda mass: p*mass) for p in prefixsums]
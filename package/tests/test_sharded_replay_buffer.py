@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+ray = pytest.importorskip("ray")
+pytest.importorskip("ray.rllib")
+
+from ray.rllib.policy.sample_batch import DEFAULT_POLICY_ID
+
+from xarl.experience_buffers.sharded_replay_buffer import ShardedReplayBuffer
+
+@pytest.fixture
+def buffer_options(buffer_options):
+	return dict(buffer_options, priority_lower_limit=0)
+
+@pytest.fixture(scope="module")
+def local_ray():
+	ray.init(local_mode=True, num_cpus=1, include_dashboard=False)
+	yield
+	ray.shutdown()
+
+def test_importance_weights_are_normalised_among_all_the_shards(local_ray, make_batch, buffer_options):
+	buffer = ShardedReplayBuffer(num_shards=2, buffer_options=buffer_options, learning_starts=1, seed=0)
+	for eps_id in range(40): # shard 0 gets the low priorities, shard 1 the high ones
+		buffer.add_batch(make_batch(priority=0.1+np.random.rand() if eps_id%2 == 0 else 10+np.random.rand(), eps_id=np.full(2, eps_id)))
+	shard_weights = {0: [], 1: []}
+	for _ in range(20):
+		for samples in buffer.replay(batch_count=8, cluster_overview_size=1):
+			batch = samples.policy_batches[DEFAULT_POLICY_ID]
+			shard_weights[int(batch['batch_ids'][0]) % 2].append(float(batch['weights'][0]))
+	assert shard_weights[0] and shard_weights[1]
+	assert max(shard_weights[0]+shard_weights[1]) <= 1 + 1e-6
+	assert max(shard_weights[1]) < 1 # the lowest transition probability is in shard 0, normalising every shard by its own would give weight 1 to the lowest-priority batch of shard 1
+
+def test_replay_and_stats_do_not_wait_for_the_priority_masses(local_ray, monkeypatch, make_batch, buffer_options):
+	buffer = ShardedReplayBuffer(num_shards=2, buffer_options=buffer_options, learning_starts=1, seed=0)
+	for eps_id in range(10):
+		buffer.add_batch(make_batch(priority=1., eps_id=np.full(2, eps_id)))
+	assert buffer.replay(batch_count=4)
+	def fetch_priority_states():
+		raise AssertionError('the priority masses shall come with the results of add_batch and replay')
+	monkeypatch.setattr(buffer, '_fetch_priority_states', fetch_priority_states)
+	priority_mass, _ = buffer.get_priority_mass()
+	for eps_id in range(10, 20):
+		buffer.add_batch(make_batch(priority=100., eps_id=np.full(2, eps_id)))
+	assert buffer.replay(batch_count=4)
+	new_priority_mass, _ = buffer.get_priority_mass()
+	assert (new_priority_mass > priority_mass).all()
+	buffer.stats()
+	assert 'shard_0' in buffer.stats() # the stats asked by the previous call
+
+def test_non_prioritized_shards(local_ray, make_batch):
+	buffer = ShardedReplayBuffer(num_shards=2, prioritized_replay=False, buffer_options={'global_size': 10}, learning_starts=1, seed=0)
+	assert buffer.buffer_size == 10
+	for eps_id in range(10):
+		buffer.add_batch(make_batch(priority=1., eps_id=np.full(2, eps_id)))
+	assert len(buffer.replay(batch_count=4)) == 4
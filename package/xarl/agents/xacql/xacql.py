@@ -1,6 +1,6 @@
 """CQL (derived from SAC).
 """
-from xarl.agents.xasac import xa_postprocess_nstep_and_prio, xadqn_execution_plan, XADQN_EXTRA_OPTIONS
+from xarl.agents.xasac import xa_postprocess_nstep_and_prio, xadqn_execution_plan, XADQN_EXTRA_OPTIONS, ReplayPrefetcherMixin
 from ray.rllib.agents.cql.cql import CQLTrainer, CQL_DEFAULT_CONFIG
 from ray.rllib.agents.cql.cql_torch_policy import CQLTorchPolicy
 from xarl.agents.xacql.xacql_torch_loss import cql_loss as torch_xacql_loss
@@ -32,4 +32,5 @@ XACQLTrainer = CQLTrainer.with_updates(
 	get_policy_class=get_policy_class,
 	after_init=None,
 	execution_plan=xadqn_execution_plan,
+	mixins=[ReplayPrefetcherMixin],
 )
@@ -6,7 +6,7 @@ Detailed documentation:
 https://docs.ray.io/en/master/rllib-algorithms.html#deep-deterministic-policy-gradients-ddpg-td3
 """  # noqa: E501
 
-from xarl.agents.xadqn import xa_postprocess_nstep_and_prio, xadqn_execution_plan, XADQN_EXTRA_OPTIONS
+from xarl.agents.xadqn import xa_postprocess_nstep_and_prio, xadqn_execution_plan, XADQN_EXTRA_OPTIONS, ReplayPrefetcherMixin
 from ray.rllib.agents.ddpg.ddpg import DDPGTrainer, DEFAULT_CONFIG as DDPG_DEFAULT_CONFIG
 from ray.rllib.agents.ddpg.td3 import TD3Trainer, TD3_DEFAULT_CONFIG
 from ray.rllib.agents.ddpg.ddpg_tf_policy import DDPGTFPolicy
@@ -50,6 +50,7 @@ XADDPGTrainer = DDPGTrainer.with_updates(
 	default_config=XADDPG_DEFAULT_CONFIG,
 	execution_plan=xadqn_execution_plan,
 	get_policy_class=lambda config: XADDPGTorchPolicy if config["framework"] == "torch" else XADDPGTFPolicy,
+	mixins=[ReplayPrefetcherMixin],
 )
 
 XATD3Trainer = TD3Trainer.with_updates(
@@ -57,4 +58,5 @@ XATD3Trainer = TD3Trainer.with_updates(
     default_config=XATD3_DEFAULT_CONFIG,
     execution_plan=xadqn_execution_plan,
 	get_policy_class=lambda config: XADDPGTorchPolicy if config["framework"] == "torch" else XADDPGTFPolicy,
+	mixins=[ReplayPrefetcherMixin],
 )
@@ -5,8 +5,7 @@ XADQN - eXplanation-Aware Deep Q-Networks (DQN, Rainbow, Parametric DQN)
 Detailed documentation:
 https://docs.ray.io/en/master/rllib-algorithms.html#deep-q-networks-dqn-rainbow-parametric-dqn
 """  # noqa: E501
-from more_itertools import unique_everseen
-from ray.rllib.agents.dqn.dqn import calculate_rr_weights, DQNTrainer, Concurrently, StandardMetricsReporting, LEARNER_STATS_KEY, DEFAULT_CONFIG as DQN_DEFAULT_CONFIG
+from ray.rllib.agents.dqn.dqn import calculate_rr_weights, DQNTrainer, Concurrently, StandardMetricsReporting, DEFAULT_CONFIG as DQN_DEFAULT_CONFIG
 from ray.rllib.agents.dqn.dqn_torch_policy import DQNTorchPolicy, compute_q_values as torch_compute_q_values, torch, F, FLOAT_MIN
 from ray.rllib.agents.dqn.dqn_tf_policy import DQNTFPolicy, compute_q_values as tf_compute_q_values, tf, _adjust_nstep
 from ray.rllib.utils.tf_ops import explained_variance as tf_explained_variance
@@ -16,8 +15,7 @@ from ray.rllib.policy.sample_batch import SampleBatch, MultiAgentBatch, DEFAULT_
 from ray.rllib.policy.view_requirement import ViewRequirement
 from ray.rllib.execution.train_ops import TrainOneStep, UpdateTargetNetwork, TrainTFMultiGPU
 
-from xarl.experience_buffers.replay_ops import StoreToReplayBuffer, Replay, get_clustered_replay_buffer, assign_types, add_buffer_metrics, clean_batch
-from xarl.experience_buffers.replay_buffer import get_batch_infos, get_batch_uid
+from xarl.experience_buffers.replay_ops import StoreToReplayBuffer, Replay, PrefetchReplay, ReplayPrefetcher, ReplayPrefetcherMixin, get_clustered_replay_buffer, assign_types, add_buffer_metrics, get_update_train_batch_priorities_fn
 
 import random
 import numpy as np
@@ -48,6 +46,17 @@ XADQN_EXTRA_OPTIONS = {
 		'clustering_xi': 1, # Let X be the minimum cluster's size, and C be the number of clusters, and q be clustering_xi, then the cluster's size is guaranteed to be in [X, X+(q-1)CX], with q >= 1, when all clusters have reached the minimum capacity X. This shall help having a buffer reflecting the real distribution of tasks (where each task is associated to a cluster), thus avoiding over-estimation of task's priority.
 		# 'clip_cluster_priority_by_max_capacity': False, # Default is False. Whether to clip the clusters priority so that the 'cluster_prioritisation_strategy' will not consider more elements than the maximum cluster capacity. In fact, until al the clusters have reached the minimum size, some clusters may have more elements than the maximum size, to avoid shrinking the buffer capacity with clusters having not enough transitions (i.e. 1 transition).
 		'max_age_window': None, # Consider only batches with a relative age within this age window, the younger is a batch the higher will be its importance. Set to None for no age weighting. # Idea from: Fedus, William, et al. "Revisiting fundamentals of experience replay." International Conference on Machine Learning. PMLR, 2020.
+		'segment_tree_backend': 'python', # Which data structure to use for the priority segment trees. One of the following: 'python' (nodes stored in Python lists), 'numpy' (nodes stored in contiguous float64/int64 arrays), 'fused' (like 'numpy', but every node of a priority tree holds sum, min and max together, updated in a single pass), 'kary' (16-ary sum trees, 4 times shallower than binary ones, whose descent scans one contiguous block of children per level).
+		'stratified_sampling': False, # Whether to sample the n batches of a cluster by drawing one batch from each of n equal-mass segments of the cluster (stratified sampling), rather than drawing n batches independently.
+		'shifted_priorities': False, # Used only if priority_lower_limit is None. Whether to store priorities offset by a running lower bound, so that sampling is a plain sum-tree descent without min-tree queries. When a priority falls below the bound, the bound is lowered and the clusters are lazily re-based in bulk. Batches are then sampled proportionally to their priority minus the bound, rather than minus the cluster's minimum priority.
+		'columnar_storage': False, # Whether to store the batches of every cluster column by column (obs, actions, rewards, etc.) in preallocated arrays, rather than as a list of batch objects. It requires all the batches to have the same columns and length (e.g. DQN with replay_sequence_length=1). Sampled batches are gathered copies, so changes made to them are not written back to the buffer: e.g. the advantages that XAPPO recomputes when replaying are used for training but not stored, and a warning is logged.
+		'empty_cluster_grace_period': None, # Default is None. If not None, a cluster that stays empty while this many batches are added to the buffer is removed, and the remaining clusters are re-indexed. Otherwise, empty clusters are kept forever and every operation looping over the clusters keeps paying for them.
+		'max_clusters': None, # Default is None. If not None, the maximum number of clusters. Once it is reached, a new label gets a cluster by removing an empty cluster, if any, or else by moving the batches of the rarest or stalest label (by a frequency decayed by half every global_size added batches) to a single 'overflow' cluster, if the new label is more frequent; otherwise its batches go to the overflow cluster. How many batches (and which labels) have been routed to the overflow cluster, and how many clusters have been moved there, is reported under 'cluster_routing' in the buffer stats, cumulatively.
+		'debug_checks': False, # Default is False. Whether to check, after every insertion, that the buffer occupancy counters match a full recount and do not exceed global_size. It costs O(number of clusters) per insertion.
+		'max_bytes': None, # Default is None. If not None, the maximum number of bytes taken by the arrays of the stored batches: before adding a batch, the less important batches are removed until it fits. Cluster sizes are then computed from the number of batches of average size that fit in max_bytes (or from global_size, if lower). The bytes of every cluster are reported under 'cluster_nbytes' in the buffer stats.
+		'deduplicate_observations': False, # Default is False. Whether to store every observation frame once: the new_obs of a stored batch is dropped, except for the frames that are not the next obs (i.e. at the last transition and at episode boundaries), and it is rebuilt from obs at sample time. It halves the memory taken by observations when batches have more than one transition (e.g. replay_sequence_length > 1). Batches with a single transition are stored as they are. The other sampled batches are copies, so changes made to them (e.g. by XAPPO when replaying) are not written back to the buffer.
+		'memmap_directory': None, # Default is None. If not None, the directory where the batches are stored on disk: every cluster keeps its columns (as with columnar_storage, with the same requirements) in numpy.memmap files under a temporary sub-directory, removed when the buffer is deleted. Priority trees and other metadata stay in RAM, as well as the columns of objects (e.g. infos) and the frames kept by deduplicate_observations. It allows for buffers much larger than RAM, at the cost of a slower sampling. As with columnar_storage, changes made to sampled batches (e.g. by XAPPO when replaying) are not written back to the buffer. max_bytes, if set, also counts the bytes on disk.
+		'memmap_cache_size': 256, # Default is 256. With memmap_directory, how many of the most recently added or sampled batches of every cluster are also kept in RAM, so that they are not read back from disk. 0 disables the cache.
 	},
 	"clustering_scheme": "HW", # Which scheme to use for building clusters. One of the following: "none", "positive_H", "H", "HW", "long_HW", "W", "long_W".
 	"clustering_scheme_options": {
@@ -60,6 +69,8 @@ XADQN_EXTRA_OPTIONS = {
 	"cluster_overview_size": 1, # cluster_overview_size <= train_batch_size. If None, then cluster_overview_size is automatically set to train_batch_size. -- When building a single train batch, do not sample a new cluster before x batches are sampled from it. The closer cluster_overview_size is to train_batch_size, the faster is the batch sampling procedure.
 	"collect_cluster_metrics": False, # Whether to collect metrics about the experience clusters. It consumes more resources.
 	"ratio_of_samples_from_unclustered_buffer": 0, # 0 for no, 1 for full. Whether to sample in a randomised fashion from both a non-prioritised buffer of most recent elements and the XA prioritised buffer.
+	"replay_buffer_num_shards": 1, # How many Ray actors to split the experience buffer into, each holding an equal share of global_size (and max_bytes). If greater than 1, rollouts are routed to a shard by their episode id, and every train batch is sampled in parallel from the shards, in proportion to their cluster priorities. Priorities are updated in the shard the batch comes from. It works also with ray.init(local_mode=True).
+	"replay_prefetch_size": 0, # How many train batches to sample in advance, on a background thread, while the learner trains on the current one. 0 disables prefetching. A train batch is sampled before the priorities of at most this many previous train batches are updated. The number of prefetched train batches is reported under 'replay_prefetch_queue_size' in the info, the time spent waiting for them under 'replay_prefetch_wait_time_ms' in the timers.
 }
 # The combination of update_insertion_time_when_sampling==True and prioritized_drop_probability==0 helps mantaining in the buffer only those batches with the most up-to-date priorities.
 XADQN_DEFAULT_CONFIG = DQNTrainer.merge_trainer_configs(
@@ -104,6 +115,7 @@ def xadqn_execution_plan(workers, config):
 		replay_batch_size = int(max(1, replay_batch_size // replay_sequence_length))
 	local_replay_buffer, clustering_scheme = get_clustered_replay_buffer(config)
 	local_worker = workers.local_worker()
+	local_worker.local_replay_buffer = local_replay_buffer # reachable from the trainer, for checkpointing
 
 	def add_view_requirements(w):
 		for policy in w.policy_map.values():
@@ -127,41 +139,7 @@ def xadqn_execution_plan(workers, config):
 	# (2) Read and train on experiences from the replay buffer. Every batch
 	# returned from the LocalReplay() iterator is passed to TrainOneStep to
 	# take a SGD step, and then we decide whether to update the target network.
-	def update_priorities(item):
-		local_replay_buffer.increase_train_steps()
-		samples, info_dict = item
-		if not config.get("prioritized_replay"):
-			return info_dict
-		priority_id = config["buffer_options"]["priority_id"]
-		samples = clean_batch(samples, keys_to_keep=[priority_id,'infos'], keep_only_keys_to_keep=True)
-		if priority_id == "td_errors":
-			for policy_id, info in info_dict.items():
-				td_errors = info.get("td_error", info[LEARNER_STATS_KEY].get("td_error"))
-				# samples.policy_batches[policy_id].set_get_interceptor(None)
-				samples.policy_batches[policy_id]["td_errors"] = td_errors
-		# IMPORTANT: split train-batch into replay-batches, using batch_uid, before updating priorities
-		policy_batch_list = []
-		for policy_id, batch in samples.policy_batches.items():
-			if replay_sequence_length > 1 and config["batch_mode"] == "complete_episodes":
-				sub_batch_indexes = [
-					i
-					for i,infos in enumerate(batch['infos'])
-					if "batch_uid" in infos
-				] + [batch.count]
-				sub_batch_iter = (
-					batch.slice(sub_batch_indexes[j], sub_batch_indexes[j+1])
-					for j in range(len(sub_batch_indexes)-1)
-				)
-			else:
-				sub_batch_iter = batch.timeslices(replay_sequence_length)
-			sub_batch_iter = unique_everseen(sub_batch_iter, key=get_batch_uid)
-			for i,sub_batch in enumerate(sub_batch_iter):
-				if i >= len(policy_batch_list):
-					policy_batch_list.append({})
-				policy_batch_list[i][policy_id] = sub_batch
-		for policy_batch in policy_batch_list:
-			local_replay_buffer.update_priorities(policy_batch)
-		return info_dict
+	update_priorities = get_update_train_batch_priorities_fn(local_replay_buffer, config)
 	post_fn = config.get("before_learn_on_batch") or (lambda b, *a: b)
 	if config.get("simple_optimizer",True):
 		train_step_op = TrainOneStep(workers)
@@ -174,14 +152,27 @@ def xadqn_execution_plan(workers, config):
 			shuffle_sequences=True,
 			_fake_gpus=config["_fake_gpus"],
 			framework=config.get("framework"))
-	replay_op = Replay(
+	if config["replay_prefetch_size"]:
+		replay_prefetcher = ReplayPrefetcher(
 			local_buffer=local_replay_buffer, 
 			replay_batch_size=replay_batch_size, 
-			cluster_overview_size=config["cluster_overview_size"]
-		) \
-		.flatten() \
-		.combine(ConcatBatches(min_batch_size=replay_batch_size)) \
-		.for_each(lambda x: post_fn(x, workers, config)) \
+			cluster_overview_size=config["cluster_overview_size"],
+			build_train_batch_fn=SampleBatch.concat_samples, # a replay is always enough for a train batch
+			prefetch_size=config["replay_prefetch_size"],
+		)
+		local_worker.replay_prefetcher = replay_prefetcher # stopped by the trainer, see ReplayPrefetcherMixin
+		replay_op = PrefetchReplay(replay_prefetcher) \
+			.for_each(lambda x: post_fn(x, workers, config)) # on the learner's thread, as it may use the workers
+	else:
+		replay_op = Replay(
+				local_buffer=local_replay_buffer, 
+				replay_batch_size=replay_batch_size, 
+				cluster_overview_size=config["cluster_overview_size"]
+			) \
+			.flatten() \
+			.combine(ConcatBatches(min_batch_size=replay_batch_size)) \
+			.for_each(lambda x: post_fn(x, workers, config))
+	replay_op = replay_op \
 		.for_each(train_step_op) \
 		.for_each(update_priorities) \
 		.for_each(UpdateTargetNetwork(workers, config["target_network_update_freq"]))
@@ -200,4 +191,5 @@ XADQNTrainer = DQNTrainer.with_updates(
 	default_config=XADQN_DEFAULT_CONFIG,
 	execution_plan=xadqn_execution_plan,
 	get_policy_class=lambda config: XADQNTorchPolicy if config["framework"] == "torch" else XADQNTFPolicy,
+	mixins=[ReplayPrefetcherMixin],
 )
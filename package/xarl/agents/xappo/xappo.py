@@ -22,7 +22,7 @@ from xarl.experience_buffers.replay_ops import MixInReplay, get_clustered_replay
 from xarl.utils.misc import accumulate
 from xarl.agents.xappo.xappo_tf_loss import xappo_surrogate_loss as tf_xappo_surrogate_loss
 from xarl.agents.xappo.xappo_torch_loss import xappo_surrogate_loss as torch_xappo_surrogate_loss
-from xarl.experience_buffers.replay_buffer import get_batch_infos, get_batch_uid
+from xarl.experience_buffers.replay_buffer import get_batch_infos, get_batch_id
 import random
 import numpy as np
 
@@ -57,6 +57,17 @@ XAPPO_EXTRA_OPTIONS = {
 		'clustering_xi': 4, # Let X be the minimum cluster's size, and C be the number of clusters, and q be clustering_xi, then the cluster's size is guaranteed to be in [X, X+(q-1)CX], with q >= 1, when all clusters have reached the minimum capacity X. This shall help having a buffer reflecting the real distribution of tasks (where each task is associated to a cluster), thus avoiding over-estimation of task's priority.
 		# 'clip_cluster_priority_by_max_capacity': False, # Default is False. Whether to clip the clusters priority so that the 'cluster_prioritisation_strategy' will not consider more elements than the maximum cluster capacity. In fact, until al the clusters have reached the minimum size, some clusters may have more elements than the maximum size, to avoid shrinking the buffer capacity with clusters having not enough transitions (i.e. 1 transition).
 		'max_age_window': None, # Consider only batches with a relative age within this age window, the younger is a batch the higher will be its importance. Set to None for no age weighting. # Idea from: Fedus, William, et al. "Revisiting fundamentals of experience replay." International Conference on Machine Learning. PMLR, 2020.
+		'segment_tree_backend': 'python', # Which data structure to use for the priority segment trees. One of the following: 'python' (nodes stored in Python lists), 'numpy' (nodes stored in contiguous float64/int64 arrays), 'fused' (like 'numpy', but every node of a priority tree holds sum, min and max together, updated in a single pass), 'kary' (16-ary sum trees, 4 times shallower than binary ones, whose descent scans one contiguous block of children per level).
+		'stratified_sampling': False, # Whether to sample the n batches of a cluster by drawing one batch from each of n equal-mass segments of the cluster (stratified sampling), rather than drawing n batches independently.
+		'shifted_priorities': False, # Used only if priority_lower_limit is None. Whether to store priorities offset by a running lower bound, so that sampling is a plain sum-tree descent without min-tree queries. When a priority falls below the bound, the bound is lowered and the clusters are lazily re-based in bulk. Batches are then sampled proportionally to their priority minus the bound, rather than minus the cluster's minimum priority.
+		'columnar_storage': False, # Whether to store the batches of every cluster column by column (obs, actions, rewards, etc.) in preallocated arrays, rather than as a list of batch objects. It requires all the batches to have the same columns and length (e.g. DQN with replay_sequence_length=1). Sampled batches are gathered copies, so changes made to them are not written back to the buffer: e.g. the advantages that XAPPO recomputes when replaying are used for training but not stored, and a warning is logged.
+		'empty_cluster_grace_period': None, # Default is None. If not None, a cluster that stays empty while this many batches are added to the buffer is removed, and the remaining clusters are re-indexed. Otherwise, empty clusters are kept forever and every operation looping over the clusters keeps paying for them.
+		'max_clusters': None, # Default is None. If not None, the maximum number of clusters. Once it is reached, a new label gets a cluster by removing an empty cluster, if any, or else by moving the batches of the rarest or stalest label (by a frequency decayed by half every global_size added batches) to a single 'overflow' cluster, if the new label is more frequent; otherwise its batches go to the overflow cluster. How many batches (and which labels) have been routed to the overflow cluster, and how many clusters have been moved there, is reported under 'cluster_routing' in the buffer stats, cumulatively.
+		'debug_checks': False, # Default is False. Whether to check, after every insertion, that the buffer occupancy counters match a full recount and do not exceed global_size. It costs O(number of clusters) per insertion.
+		'max_bytes': None, # Default is None. If not None, the maximum number of bytes taken by the arrays of the stored batches: before adding a batch, the less important batches are removed until it fits. Cluster sizes are then computed from the number of batches of average size that fit in max_bytes (or from global_size, if lower). The bytes of every cluster are reported under 'cluster_nbytes' in the buffer stats.
+		'deduplicate_observations': False, # Default is False. Whether to store every observation frame once: the new_obs of a stored batch is dropped, except for the frames that are not the next obs (i.e. at the last transition and at episode boundaries), and it is rebuilt from obs at sample time. It halves the memory taken by observations when batches have more than one transition (e.g. replay_sequence_length > 1). Batches with a single transition are stored as they are. The other sampled batches are copies, so changes made to them (e.g. by XAPPO when replaying) are not written back to the buffer.
+		'memmap_directory': None, # Default is None. If not None, the directory where the batches are stored on disk: every cluster keeps its columns (as with columnar_storage, with the same requirements) in numpy.memmap files under a temporary sub-directory, removed when the buffer is deleted. Priority trees and other metadata stay in RAM, as well as the columns of objects (e.g. infos) and the frames kept by deduplicate_observations. It allows for buffers much larger than RAM, at the cost of a slower sampling. As with columnar_storage, changes made to sampled batches (e.g. by XAPPO when replaying) are not written back to the buffer. max_bytes, if set, also counts the bytes on disk.
+		'memmap_cache_size': 256, # Default is 256. With memmap_directory, how many of the most recently added or sampled batches of every cluster are also kept in RAM, so that they are not read back from disk. 0 disables the cache.
 	},
 	"clustering_scheme": "HW", # Which scheme to use for building clusters. One of the following: "none", "positive_H", "H", "HW", "long_HW", "W", "long_W".
 	"clustering_scheme_options": {
@@ -69,6 +80,7 @@ XAPPO_EXTRA_OPTIONS = {
 	"cluster_overview_size": 1, # cluster_overview_size <= train_batch_size. If None, then cluster_overview_size is automatically set to train_batch_size. -- When building a single train batch, do not sample a new cluster before x batches are sampled from it. The closer cluster_overview_size is to train_batch_size, the faster is the batch sampling procedure.
 	"collect_cluster_metrics": False, # Whether to collect metrics about the experience clusters. It consumes more resources.
 	"ratio_of_samples_from_unclustered_buffer": 0, # 0 for no, 1 for full. Whether to sample in a randomised fashion from both a non-prioritised buffer of most recent elements and the XA prioritised buffer.
+	"replay_buffer_num_shards": 1, # How many Ray actors to split the experience buffer into, each holding an equal share of global_size (and max_bytes). If greater than 1, rollouts are routed to a shard by their episode id, and every train batch is sampled in parallel from the shards, in proportion to their cluster priorities. Priorities are updated in the shard the batch comes from. It works also with ray.init(local_mode=True).
 }
 # The combination of update_insertion_time_when_sampling==True and prioritized_drop_probability==0 helps mantaining in the buffer only those batches with the most up-to-date priorities.
 XAPPO_DEFAULT_CONFIG = APPOTrainer.merge_trainer_configs(
@@ -269,6 +281,7 @@ def xappo_execution_plan(workers, config):
 	local_replay_buffer, clustering_scheme = get_clustered_replay_buffer(config)
 	rollouts = ParallelRollouts(workers, mode="async", num_async=config["max_sample_requests_in_flight_per_worker"])
 	local_worker = workers.local_worker()
+	local_worker.local_replay_buffer = local_replay_buffer # reachable from the trainer, for checkpointing
 	
 	def add_view_requirements(w):
 		for policy in w.policy_map.values():
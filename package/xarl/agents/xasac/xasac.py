@@ -6,7 +6,7 @@ Detailed documentation:
 https://docs.ray.io/en/master/rllib-algorithms.html#deep-deterministic-policy-gradients-ddpg-td3
 """  # noqa: E501
 
-from xarl.agents.xadqn import xa_postprocess_nstep_and_prio, xadqn_execution_plan, XADQN_EXTRA_OPTIONS
+from xarl.agents.xadqn import xa_postprocess_nstep_and_prio, xadqn_execution_plan, XADQN_EXTRA_OPTIONS, ReplayPrefetcherMixin
 from ray.rllib.agents.sac.sac import SACTrainer, DEFAULT_CONFIG as SAC_DEFAULT_CONFIG
 from ray.rllib.agents.sac.sac_torch_policy import SACTorchPolicy
 from ray.rllib.agents.sac.sac_tf_policy import SACTFPolicy
@@ -46,4 +46,5 @@ XASACTrainer = SACTrainer.with_updates(
 	default_config=XASAC_DEFAULT_CONFIG,
 	execution_plan=xadqn_execution_plan,
 	get_policy_class=lambda config: XASACTorchPolicy if config["framework"] == "torch" else XASACTFPolicy,
+	mixins=[ReplayPrefetcherMixin],
 )
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import numpy as np
+
+def save_batches(directory, batch_list): # O(N)
+	"""Saves the batches (e.g. SampleBatch) in directory, with one .npy file per column holding the rows of all the batches having that column, instead of pickling every batch.
+	Columns of objects (e.g. 'infos') are pickled as a whole."""
+	os.makedirs(directory, exist_ok=True)
+	batch_list = list(batch_list)
+	keys = list(dict.fromkeys(k for batch in batch_list for k in batch.keys()))
+	object_keys = []
+	for i,k in enumerate(keys):
+		column = np.concatenate([np.asarray(batch[k]) for batch in batch_list if k in batch])
+		if column.dtype == object:
+			object_keys.append(k)
+		np.save(os.path.join(directory, f'{i}.npy'), column, allow_pickle=column.dtype == object)
+	with open(os.path.join(directory, 'batches.pkl'), 'wb') as f:
+		pickle.dump({
+			'batch_class': type(batch_list[0]) if batch_list else None,
+			'keys': keys,
+			'object_keys': object_keys,
+			'batch_lengths': [batch.count for batch in batch_list],
+			'batch_keys': np.array([[k in batch for k in keys] for batch in batch_list], dtype=bool).reshape(len(batch_list), len(keys)), # which columns every batch has
+		}, f)
+
+def load_batches(directory): # O(N)
+	"""Returns the batches saved in directory by save_batches, as a generator.
+	Columns are memory-mapped and every batch gets a copy of its rows, so that the whole columns are never in RAM."""
+	with open(os.path.join(directory, 'batches.pkl'), 'rb') as f:
+		meta = pickle.load(f)
+	columns = [
+		np.load(os.path.join(directory, f'{i}.npy'), mmap_mode=None if k in meta['object_keys'] else 'r', allow_pickle=k in meta['object_keys']).view(np.ndarray) # slicing a plain view of the map is much faster than slicing a memmap
+		for i,k in enumerate(meta['keys'])
+	]
+	offsets = [0]*len(columns)
+	key_lists = {} # Map from the columns of a batch (as a mask) to their indexes
+	for batch_length, batch_keys in zip(meta['batch_lengths'], map(tuple, meta['batch_keys'])):
+		if batch_keys not in key_lists:
+			key_lists[batch_keys] = [i for i,has_key in enumerate(batch_keys) if has_key]
+		batch_dict = {}
+		for i in key_lists[batch_keys]:
+			batch_dict[meta['keys'][i]] = columns[i][offsets[i]:offsets[i]+batch_length].copy()
+			offsets[i] += batch_length
+		yield meta['batch_class'](batch_dict)
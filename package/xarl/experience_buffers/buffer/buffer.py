@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
+import pickle
 import random
 import numpy as np
 from collections import deque
-import uuid
+import itertools
+from xarl.experience_buffers.buffer.batch_io import save_batches, load_batches
 
 logger = logging.getLogger(__name__)
 
+batch_id_counter = itertools.count() # Shared by all the buffers of a process, so that batch ids are unique also across buffers
+get_batch_id = lambda x: int(x["batch_ids"][0])
+
 class Buffer(object):
 	# __slots__ = ('cluster_size','global_size','types','batches','type_values','type_keys')
 	
@@ -96,13 +102,17 @@ class Buffer(object):
 	def add(self, batch, type_id=0, **args): # put batch into buffer
 		self._add_type_if_not_exist(type_id)
 		type_ = self.get_type(type_id)
-		batch["infos"][0]["batch_uid"] = str(uuid.uuid4()) # random unique id
+		batch["batch_ids"] = np.full(batch.count, next(batch_id_counter), dtype=np.int64) # unique id, as a column
 		if self.is_full_buffer():
 			biggest_cluster = max(self.type_values, key=self.count)
 			self.batches[biggest_cluster].popleft()
 		self.batches[type_].append(batch)
 
-	def sample(self, n=1):
+	def cache_priorities(self): # O(1)
+		"""Updates what sample(recompute_priorities=False) reads, so that many threads can then sample at once without changing the buffer. There are no priorities."""
+		pass
+
+	def sample(self, n=1, recompute_priorities=True): # recompute_priorities is ignored, there are no priorities
 		type_ = random.choice(self.type_values)
 		batch_list = [
 			random.choice(self.batches[type_])
@@ -110,7 +120,56 @@ class Buffer(object):
 		]
 		return batch_list
 
+	def get_priority_mass(self):
+		"""Returns the mass clusters are sampled from, i.e. the number of clusters, as they are sampled uniformly."""
+		return len(self.type_values) if not self.is_empty() else 0
+
 	def stats(self, debug=False):
 		return {
 			"added_count": self.count(),
 		}
+
+	def get_config(self):
+		"""Returns the options the saved state depends on, they shall be the same when loading it."""
+		return {
+			'cluster_size': self.cluster_size,
+			'global_size': self.global_size,
+		}
+
+	def get_state(self):
+		"""Returns the state of the buffer, except for its batches."""
+		return {
+			'config': self.get_config(),
+			'type_keys': self.type_keys,
+			'timesteps': self.timesteps,
+		}
+
+	def save(self, directory): # O(N)
+		"""Saves the buffer in directory: the batches of every cluster in bulk, one file per column, and the rest of the state in a single file."""
+		os.makedirs(directory, exist_ok=True)
+		for type_,type_batch in enumerate(self.batches):
+			save_batches(os.path.join(directory, f'cluster_{type_}'), type_batch)
+		with open(os.path.join(directory, 'buffer.pkl'), 'wb') as f:
+			pickle.dump(self.get_state(), f)
+
+	def load(self, directory): # O(N)
+		"""Replaces the content of the buffer with the one saved in directory by save. The restored batches get new ids."""
+		with open(os.path.join(directory, 'buffer.pkl'), 'rb') as f:
+			state = pickle.load(f)
+		assert state['config'] == self.get_config(), f"The buffer was saved with options {state['config']}, but its options are {self.get_config()}."
+		self.clean()
+		for type_,type_id in enumerate(state['type_keys']):
+			self._load_cluster(type_id, os.path.join(directory, f'cluster_{type_}'))
+		self.set_state(state)
+
+	def _load_cluster(self, type_id, directory): # O(N)
+		"""Adds the cluster saved in directory, appending its batches all at once rather than adding them one by one."""
+		self._add_type_if_not_exist(type_id)
+		type_batch = self.batches[self.get_type(type_id)]
+		for batch in load_batches(directory):
+			batch["batch_ids"] = np.full(batch.count, next(batch_id_counter), dtype=np.int64) # new ids, so that they do not clash with those of this process
+			type_batch.append(batch) # O(1)
+
+	def set_state(self, state):
+		"""Restores the state returned by get_state, once the batches are loaded."""
+		self.timesteps = state['timesteps']
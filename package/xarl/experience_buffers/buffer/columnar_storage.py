@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+class ColumnarBatchStorage(object):
+	"""A list-like container of batches (e.g. SampleBatch) where every column is stored in a single preallocated array, instead of keeping one object (with its own small arrays) per batch.
+	Row i of every column holds the i-th batch, so that moving a batch is a row copy and sampling many batches is a gather.
+	All the batches must have the same columns, with the same shape and dtype, e.g. DQN batches with replay_sequence_length=1.
+	The returned batches are copies: changes to them are not written back, except for the dictionaries in 'infos' that are shared with the storage.
+	"""
+	__slots__ = ('_max_rows','_rows','_columns','_batch_class')
+
+	def __init__(self, max_rows=None):
+		self._max_rows = max_rows
+		self._rows = 0
+		self._columns = None
+		self._batch_class = None
+
+	def __len__(self):
+		return self._rows
+
+	def __iter__(self):
+		return (self[i] for i in range(self._rows))
+
+	def _get_capacity(self):
+		return len(next(iter(self._columns.values()))) if self._columns else 0
+
+	def _new_column(self, key, shape, dtype): # O(1)
+		"""Returns a new (uninitialized) array for column key."""
+		return np.empty(shape, dtype=dtype)
+
+	def _allocate(self, batch): # O(1)
+		self._batch_class = type(batch)
+		self._columns = {}
+		for k,v in batch.items():
+			v = np.asarray(v)
+			self._columns[k] = self._new_column(k, (1, *v.shape), v.dtype)
+
+	def _grow(self): # O(N), amortized O(1) per append
+		capacity = self._get_capacity()
+		new_capacity = 2*capacity if not self._max_rows else max(capacity+1, min(2*capacity, self._max_rows))
+		for k,column in self._columns.items():
+			new_column = self._new_column(k, (new_capacity, *column.shape[1:]), column.dtype)
+			new_column[:self._rows] = column[:self._rows]
+			self._columns[k] = new_column
+
+	def append(self, batch): # O(1) amortized
+		if self._columns is None:
+			self._allocate(batch)
+		elif self._rows == self._get_capacity():
+			self._grow()
+		assert batch.keys() == self._columns.keys(), f"all the batches must have the same columns, expected {sorted(self._columns.keys())} but got {sorted(batch.keys())}"
+		for k,column in self._columns.items():
+			column[self._rows] = batch[k]
+		self._rows += 1
+
+	def pop(self): # O(1)
+		"""Removes the last batch."""
+		assert self._rows > 0, "pop from empty storage"
+		self._rows -= 1
+		for column in self._columns.values():
+			if column.dtype == object: # release the references
+				column[self._rows] = None
+
+	def move(self, src_idx, dst_idx): # O(1)
+		"""Overwrites the batch at dst_idx with a copy of the batch at src_idx."""
+		assert 0 <= src_idx < self._rows and 0 <= dst_idx < self._rows
+		for column in self._columns.values():
+			column[dst_idx] = column[src_idx]
+
+	def get_infos(self, idx): # O(1)
+		"""Returns batch['infos'][0] without building the batch."""
+		return self._columns['infos'][idx][0]
+
+	def get_count(self, idx): # O(1)
+		"""Returns the number of rows (e.g. transitions) of the batch at idx, without building the batch."""
+		return len(next(iter(self._columns.values()))[idx])
+
+	def __getitem__(self, idx): # O(1)
+		assert 0 <= idx < self._rows
+		return self._batch_class({
+			k: column[idx].copy()
+			for k,column in self._columns.items()
+		})
+
+	def gather(self, idx_list): # O(len(idx_list))
+		"""Returns the batches at idx_list, gathering every column once."""
+		idx_list = np.asarray(idx_list, dtype=np.int64)
+		columns = {
+			k: column[idx_list]
+			for k,column in self._columns.items()
+		}
+		return [
+			self._batch_class({
+				k: column[i]
+				for k,column in columns.items()
+			})
+			for i in range(len(idx_list))
+		]
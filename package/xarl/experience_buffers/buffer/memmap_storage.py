@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from xarl.experience_buffers.buffer.columnar_storage import ColumnarBatchStorage
+
+class MemmapBatchStorage(ColumnarBatchStorage):
+	"""A ColumnarBatchStorage whose columns are numpy.memmap files, in a new sub-directory of directory (or of the system's temporary directory), so that the bulk of the batches (e.g. observations) is kept on disk rather than in RAM.
+	Columns of objects (e.g. 'infos') cannot be mapped and stay in RAM.
+	The last cache_size batches that were added or read are also kept in RAM, so that recent and frequently sampled batches are not read back from disk.
+	The files are removed when the storage is garbage collected.
+	Reading batches changes the cache, which has its own lock, so that many threads can read at once.
+	"""
+	__slots__ = ('_directory','_column_files','_file_counter','_cache','_cache_lock','_cache_size','_finalizer','__weakref__')
+
+	def __init__(self, max_rows=None, directory=None, cache_size=0):
+		super().__init__(max_rows=max_rows)
+		if directory is not None:
+			os.makedirs(directory, exist_ok=True)
+		self._directory = tempfile.mkdtemp(prefix='cluster_', dir=directory)
+		self._finalizer = weakref.finalize(self, shutil.rmtree, self._directory, ignore_errors=True)
+		self._column_files = {} # Map from column to its file
+		self._file_counter = 0
+		self._cache = OrderedDict() # LRU cache of rows, from idx to {column: row}
+		self._cache_lock = threading.Lock()
+		self._cache_size = cache_size
+
+	def _new_column(self, key, shape, dtype): # O(1)
+		if dtype == object or np.prod(shape) == 0: # objects cannot be mapped, and empty files cannot be mapped
+			return super()._new_column(key, shape, dtype)
+		self._file_counter += 1
+		self._column_files[key] = column_file = os.path.join(self._directory, f'{self._file_counter}.dat')
+		return np.memmap(column_file, dtype=dtype, mode='w+', shape=shape)
+
+	def _grow(self): # O(N), amortized O(1) per append
+		old_files = set(self._column_files.values())
+		super()._grow()
+		for old_file in old_files - set(self._column_files.values()):
+			os.remove(old_file) # the old arrays are not referenced anymore
+
+	def _cache_row(self, idx, row): # O(1)
+		if not self._cache_size:
+			return
+		with self._cache_lock:
+			self._cache[idx] = row
+			self._cache.move_to_end(idx)
+			if len(self._cache) > self._cache_size:
+				self._cache.popitem(last=False) # drop the least recently used
+
+	def _get_cached_row(self, idx): # O(1)
+		with self._cache_lock:
+			row = self._cache.get(idx, None)
+			if row is not None:
+				self._cache.move_to_end(idx)
+		return row
+
+	def _read_row(self, idx): # O(number of columns)
+		row = self._get_cached_row(idx)
+		if row is None:
+			row = {
+				k: np.array(column[idx]) # a copy in RAM
+				for k,column in self._columns.items()
+			}
+			self._cache_row(idx, row)
+		return row
+
+	def append(self, batch): # O(1) amortized
+		super().append(batch)
+		if self._cache_size: # recently added batches are likely to be sampled soon
+			self._read_row(self._rows-1)
+
+	def pop(self): # O(1)
+		super().pop()
+		self._cache.pop(self._rows, None)
+
+	def move(self, src_idx, dst_idx): # O(1)
+		super().move(src_idx, dst_idx)
+		self._cache.pop(dst_idx, None)
+		row = self._cache.get(src_idx, None)
+		if row is not None:
+			self._cache[dst_idx] = row
+
+	def __getitem__(self, idx): # O(1)
+		assert 0 <= idx < self._rows
+		return self._batch_class({
+			k: v.copy() # the cached row must not change
+			for k,v in self._read_row(idx).items()
+		})
+
+	def gather(self, idx_list): # O(len(idx_list))
+		"""Returns the batches at idx_list, reading from disk (once per column) only the ones that are not cached."""
+		row_list = [self._get_cached_row(idx) for idx in idx_list]
+		missing_list = [i for i,row in enumerate(row_list) if row is None]
+		if missing_list:
+			missing_idx_list = np.asarray([idx_list[i] for i in missing_list], dtype=np.int64)
+			columns = {
+				k: column[missing_idx_list] # a single read from disk
+				for k,column in self._columns.items()
+			}
+			for j,i in enumerate(missing_list):
+				row_list[i] = {
+					k: column[j].copy() # do not keep the whole gathered column alive in the cache
+					for k,column in columns.items()
+				}
+				self._cache_row(int(idx_list[i]), row_list[i])
+		return [
+			self._batch_class({
+				k: v.copy() # the cached row must not change
+				for k,v in row.items()
+			})
+			for row in row_list
+		]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+def can_deduplicate_obs(batch):
+	"""Whether new_obs of batch can be rebuilt from its obs, i.e. both are arrays of the same shape and dtype."""
+	if 'obs' not in batch or 'new_obs' not in batch:
+		return False
+	obs, new_obs = batch['obs'], batch['new_obs']
+	return isinstance(obs, np.ndarray) and isinstance(new_obs, np.ndarray) and obs.shape == new_obs.shape and obs.dtype == new_obs.dtype and obs.dtype != object and len(obs) > 0
+
+def split_new_obs(batch): # O(n)
+	"""Returns (rows, frames), where rows are the rows t of a contiguous batch whose new_obs[t] is not obs[t+1] (i.e. the last row and the episode boundaries) and frames are new_obs[rows].
+	All the other frames of new_obs are already in obs."""
+	obs, new_obs = batch['obs'], batch['new_obs']
+	n = len(obs)
+	is_new_frame = np.ones(n, dtype=bool)
+	if n > 1:
+		is_new_frame[:-1] = np.any((new_obs[:-1] != obs[1:]).reshape(n-1, -1), axis=1)
+	rows = np.flatnonzero(is_new_frame)
+	return rows, new_obs[rows] # a copy, it does not keep new_obs alive
+
+def merge_new_obs(obs, rows, frames): # O(n)
+	"""Rebuilds new_obs from obs and the output of split_new_obs."""
+	new_obs = np.empty_like(obs)
+	new_obs[:-1] = obs[1:]
+	new_obs[rows] = frames
+	return new_obs
@@ -1,19 +1,33 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
 import random
 import numpy as np
+from collections import deque, Counter
 import time
-from xarl.experience_buffers.buffer.buffer import Buffer
-from xarl.utils.segment_tree import SumSegmentTree, MinSegmentTree, MaxSegmentTree
+from xarl.experience_buffers.buffer.buffer import Buffer, batch_id_counter, get_batch_id
+from xarl.experience_buffers.buffer.columnar_storage import ColumnarBatchStorage
+from xarl.experience_buffers.buffer.memmap_storage import MemmapBatchStorage
+from xarl.experience_buffers.buffer.batch_io import load_batches
+from xarl.experience_buffers.buffer.obs_deduplication import can_deduplicate_obs, split_new_obs, merge_new_obs
+from xarl.utils.segment_tree import segment_tree_backends, uniform_prefixsums, stratified_prefixsums
 import copy
-import uuid
 from xarl.utils.running_statistics import RunningStats
 
 logger = logging.getLogger(__name__)
 
 get_batch_infos = lambda x: x["infos"][0]
-get_batch_indexes = lambda x: get_batch_infos(x)['batch_index']
-get_batch_uid = lambda x: get_batch_infos(x)['batch_uid']
+get_batch_nbytes = lambda x: sum(v.nbytes for _,v in x.items() if isinstance(v, np.ndarray)) # Bytes of the batch's arrays, not counting the objects they may reference (e.g. infos)
+
+OVERFLOW_CLUSTER_ID = 'overflow' # The cluster of the batches whose label has no cluster of its own, when max_clusters is reached
+
+# Segment reductions equivalent to some priority_aggregation_fn, they reduce a flat column of priorities given the first index of every segment
+segment_reductions = {
+	'np.sum': lambda x, starts: np.add.reduceat(x, starts),
+	'np.mean': lambda x, starts: np.add.reduceat(x, starts)/np.diff(np.append(starts, len(x))),
+	'np.max': lambda x, starts: np.maximum.reduceat(x, starts),
+	'np.min': lambda x, starts: np.minimum.reduceat(x, starts),
+}
 
 class PseudoPrioritizedBuffer(Buffer):
 	
@@ -35,15 +49,35 @@ class PseudoPrioritizedBuffer(Buffer):
 		# clip_cluster_priority_by_max_capacity=False,
 		priority_lower_limit=None,
 		max_age_window=None,
+		segment_tree_backend='python',
+		stratified_sampling=False,
+		shifted_priorities=False,
+		columnar_storage=False,
+		empty_cluster_grace_period=None,
+		max_clusters=None,
+		debug_checks=False,
+		max_bytes=None,
+		deduplicate_observations=False,
+		memmap_directory=None,
+		memmap_cache_size=256,
 		seed=None,
 	): # O(1)
+		assert not memmap_cache_size or memmap_cache_size > 0, f"memmap_cache_size must be > 0, but it is {memmap_cache_size}"
+		assert not max_bytes or max_bytes > 0, f"max_bytes must be > 0, but it is {max_bytes}"
+		assert not max_clusters or max_clusters > 0, f"max_clusters must be > 0, but it is {max_clusters}"
+		assert not empty_cluster_grace_period or empty_cluster_grace_period > 0, f"empty_cluster_grace_period must be > 0, but it is {empty_cluster_grace_period}"
 		assert not prioritization_importance_beta or prioritization_importance_beta > 0., f"prioritization_importance_beta must be > 0, but it is {prioritization_importance_beta}"
 		assert not prioritization_importance_eta or prioritization_importance_eta > 0, f"prioritization_importance_eta must be > 0, but it is {prioritization_importance_eta}"
 		assert clustering_xi >= 1, f"clustering_xi must be >= 1, but it is {clustering_xi}"
+		assert segment_tree_backend in segment_tree_backends, f"segment_tree_backend must be one of {list(segment_tree_backends.keys())}, but it is {segment_tree_backend}"
+		self._SumSegmentTree, self._MinSegmentTree = segment_tree_backends[segment_tree_backend]
 		self._priority_id = priority_id
 		self._priority_lower_limit = priority_lower_limit
 		self._priority_can_be_negative = priority_lower_limit is None or priority_lower_limit < 0
 		self._priority_aggregation_fn = eval(priority_aggregation_fn) if self._priority_can_be_negative else (lambda x: eval(priority_aggregation_fn)(np.abs(x)))
+		self._priority_segment_reduction = segment_reductions.get(priority_aggregation_fn, None)
+		self._shifted_priorities = shifted_priorities and priority_lower_limit is None # Whether to store priorities offset by a running lower bound, so that the trees never contain negative values
+		self._stored_priority_can_be_negative = priority_lower_limit is None and not self._shifted_priorities
 		self._prioritization_alpha = prioritization_alpha # How much prioritization is used (0 - no prioritization, 1 - full prioritization)
 		self._prioritization_importance_beta = prioritization_importance_beta # To what degree to use importance weights (0 - no corrections, 1 - full correction).
 		self._prioritization_importance_eta = prioritization_importance_eta # Eta is a value > 0 that enables eta-weighting, thus allowing for importance weighting with priorities lower than 0. Eta is used to avoid importance weights equal to 0 when the sampled batch is the one with the highest priority. The closer eta is to 0, the closer to 0 would be the importance weight of the highest-priority batch.
@@ -56,15 +90,24 @@ class PseudoPrioritizedBuffer(Buffer):
 		self._clustering_xi = clustering_xi
 		# self._clip_cluster_priority_by_max_capacity = clip_cluster_priority_by_max_capacity
 		self._weight_importance_by_update_time = self._max_age_window = max_age_window
+		self._stratified_sampling = stratified_sampling # Whether to draw one batch from each of n equal-mass segments of a cluster, when sampling n batches from it
+		self._memmap_directory = memmap_directory # Where to keep the columns of the clusters as memory-mapped files, if anywhere
+		self._memmap_cache_size = memmap_cache_size # How many recently added or read batches of every cluster to keep in RAM, when memory-mapped
+		self._columnar_storage = columnar_storage or memmap_directory is not None # Whether to store the batches of a cluster column by column, in preallocated arrays
+		self._empty_cluster_grace_period = empty_cluster_grace_period # After how many added batches an empty cluster is removed, if ever
+		self._max_clusters = max_clusters # Maximum number of clusters, including the overflow one
+		self._max_bytes = max_bytes # Maximum number of bytes of the stored batches, if any
+		self._deduplicate_observations = deduplicate_observations # Whether to store new_obs only where it differs from the next obs, rebuilding it at sample time
+		self._debug_checks = debug_checks # Whether to check the occupancy counters against a full recount after every add
+		self._track_empty_clusters = bool(empty_cluster_grace_period or max_clusters)
+		self._fifo_eviction = prioritized_drop_probability == 0 # Without prioritized dropping the oldest batch is always evicted, so insertion order is tracked with queues instead of timestamp trees
 		super().__init__(cluster_size=cluster_size, global_size=global_size, seed=seed)
-		self._it_capacity = 1
-		while self._it_capacity < self.cluster_size:
-			self._it_capacity *= 2
 		# self.priority_stats = RunningStats(window_size=self.global_size)
 		self._base_time = time.time()
 		self.min_cluster_size = 1
 		self.max_cluster_size = self.cluster_size
 		self.__historical_min_priority = float('inf')
+		self._priority_offset = 0 # Running lower bound of all the (normalized) priorities, used only with shifted_priorities
 
 	def is_weighting_expected_values(self):
 		return self._prioritization_importance_beta
@@ -76,12 +119,45 @@ class PseudoPrioritizedBuffer(Buffer):
 	def clean(self): # O(1)
 		super().clean()
 		self._sample_priority_tree = []
+		self._batch_ids = [] # Per-cluster id of every batch, aligned with self.batches
+		self._batch_index = {} # Map from batch id to (type_id, idx) of every stored batch
+		self._batch_nbytes = [] # Per-cluster bytes of every batch, aligned with self.batches
+		self._cluster_nbytes = [] # Bytes of every cluster
+		self._stored_nbytes = 0
+		if self._deduplicate_observations:
+			self._new_obs_frames = [] # Per-cluster (rows, frames) of new_obs not in obs, or None, aligned with self.batches
 		if self._prioritized_drop_probability > 0:
 			self._drop_priority_tree = []
-		if self._prioritized_drop_probability < 1:
+		if self._fifo_eviction:
+			self._insertion_counter = 0 # Global insertion counter, the stamp of the next added batch
+			self._insertion_order = [] # Per-cluster queue of stamps, from the oldest to the newest batch
+			self._insertion_stamps = [] # Per-cluster stamp of every batch, aligned with self.batches
+			self._insertion_index = [] # Per-cluster map from stamp to batch index
+		elif self._prioritized_drop_probability < 1:
 			self._insertion_time_tree = []
 		if self._weight_importance_by_update_time:
 			self._update_times = []
+		self._added_batches = 0
+		self._stored_batches = 0 # Running occupancy counters, updated on insert and remove
+		self._non_empty_clusters = 0
+		self._routed_batches = 0 # Batches added to the overflow cluster because their label had no cluster
+		self._routed_labels = Counter() # Labels routed to the overflow cluster since the last call to reset_routing_stats
+		self._demoted_clusters = 0 # Clusters moved to the overflow cluster because their label was rarer than a new one
+		self._label_frequency = {} # Map from label to (frequency, value of self._added_batches when it was last updated), of the labels with a cluster and of the most frequent ones without
+		self._empty_clusters = {} # The value of self._added_batches when each empty cluster was emptied, from the first emptied cluster
+		self._dirty_clusters = set() # Clusters whose cached aggregates (min, sum, count, priority) have to be refreshed
+		self._cluster_min_priority_tree = None # Top-level trees of the clusters' aggregates, built when caching priorities
+		self._cluster_tot_priority_tree = None
+		self._cluster_min_probability_tree = None
+		self._drop_eviction_tree = None # Top-level trees of the less important batch of every cluster, used to pick the batch to evict
+		self._insertion_time_eviction_tree = None
+		self._eviction_dirty_clusters = set() # Clusters whose less important batch has to be updated in the eviction trees
+		if self._cluster_prioritisation_strategy is not None:
+			self._cluster_priority_tree = None # Top-level tree of cluster priorities, built when caching priorities
+			self._cluster_priority_tree_min_priority = None
+		if self._shifted_priorities:
+			self._cluster_priority_offset = [] # The lower bound each cluster's trees are currently based on
+			self._clusters_to_rebase = set() # Clusters whose trees are based on an outdated lower bound
 			
 	def _add_type_if_not_exist(self, type_id): # O(1)
 		if type_id in self.types: # check it to avoid double insertion
@@ -89,25 +165,170 @@ class PseudoPrioritizedBuffer(Buffer):
 		self.types[type_id] = type_ = len(self.type_keys)
 		self.type_values.append(type_)
 		self.type_keys.append(type_id)
-		self.batches.append([])
-		new_sample_priority_tree = SumSegmentTree(
-			self._it_capacity, 
-			with_min_tree=self._prioritization_importance_beta or self._cluster_prioritisation_strategy is not None or self._priority_can_be_negative or (self._prioritized_drop_probability > 0 and not self._global_distribution_matching), 
-			with_max_tree=self._priority_can_be_negative, 
-		)
+		if self._memmap_directory is not None:
+			self.batches.append(MemmapBatchStorage(max_rows=self.cluster_size, directory=self._memmap_directory, cache_size=self._memmap_cache_size))
+		elif self._columnar_storage:
+			self.batches.append(ColumnarBatchStorage(max_rows=self.cluster_size))
+		else:
+			self.batches.append([])
+		new_sample_priority_tree = self._new_sample_priority_tree() # the trees of a cluster grow with its occupancy
 		self._sample_priority_tree.append(new_sample_priority_tree)
+		self._batch_ids.append([])
+		self._batch_nbytes.append([])
+		self._cluster_nbytes.append(0)
+		if self._deduplicate_observations:
+			self._new_obs_frames.append([])
 		if self._prioritized_drop_probability > 0:
 			self._drop_priority_tree.append(
-				MinSegmentTree(self._it_capacity,neutral_element=(float('inf'),-1))
+				self._MinSegmentTree(1,neutral_element=(float('inf'),-1))
 				if self._global_distribution_matching else
 				new_sample_priority_tree.min_tree
 			)
-		if self._prioritized_drop_probability < 1:
-			self._insertion_time_tree.append(MinSegmentTree(self._it_capacity,neutral_element=(float('inf'),-1)))
+		if self._fifo_eviction:
+			self._insertion_order.append(deque())
+			self._insertion_stamps.append([])
+			self._insertion_index.append({})
+		elif self._prioritized_drop_probability < 1:
+			self._insertion_time_tree.append(self._MinSegmentTree(1,neutral_element=(float('inf'),-1)))
 		if self._weight_importance_by_update_time:
 			self._update_times.append([])
+		self._reset_cluster_trees() # the top-level trees have to be rebuilt with one more leaf
+		if self._shifted_priorities:
+			self._cluster_priority_offset.append(self._priority_offset)
 		return True
 
+	def _new_sample_priority_tree(self, priority_list=()): # O(N)
+		return self._SumSegmentTree.from_array(
+			priority_list,
+			with_min_tree=self._prioritization_importance_beta or self._cluster_prioritisation_strategy is not None or self._stored_priority_can_be_negative or (self._prioritized_drop_probability > 0 and not self._global_distribution_matching), 
+			with_max_tree=self._stored_priority_can_be_negative, 
+		)
+
+	def _get_label_frequency(self, type_id): # O(1)
+		"""Returns how often label type_id has been seen, as a count decayed by half every global_size added batches, so that it is low for both rare and stale labels."""
+		frequency, last_update = self._label_frequency.get(type_id, (0,0))
+		return frequency*0.5**((self._added_batches-last_update)/(self.global_size or self.cluster_size))
+
+	def _update_label_frequency(self, type_id): # O(1) amortized
+		frequency = self._get_label_frequency(type_id) + 1
+		self._label_frequency[type_id] = (frequency, self._added_batches)
+		if len(self._label_frequency) > len(self.type_keys) + 2*self._max_clusters: # forget the rarest labels without a cluster, keeping max_clusters of them
+			unclustered_labels = sorted((x for x in self._label_frequency if x not in self.types), key=self._get_label_frequency) # O(max_clusters*log)
+			for x in unclustered_labels[:-self._max_clusters]:
+				del self._label_frequency[x]
+		return frequency
+
+	def _route_cluster(self, type_id): # O(1) amortized, O(N) when a cluster is demoted
+		"""Returns the id of the cluster where to add a batch labelled type_id. 
+		That is type_id itself, unless max_clusters is reached and type_id has no cluster. Then the least recently emptied cluster is removed to make room for type_id, if any, otherwise the rarest or stalest label cluster is moved to the overflow cluster, if its label is less frequent than type_id, otherwise the batch goes to the overflow cluster."""
+		if not self._max_clusters:
+			return type_id
+		frequency = self._update_label_frequency(type_id)
+		if type_id in self.types:
+			return type_id
+		max_label_clusters = self._max_clusters-1 # one cluster is reserved to the overflow
+		label_clusters = lambda: len(self.type_keys) - (OVERFLOW_CLUSTER_ID in self.types)
+		if label_clusters() >= max_label_clusters and self._empty_clusters:
+			self._compact_clusters({next(iter(self._empty_clusters))}) # O(|self.type_keys|)
+		if label_clusters() < max_label_clusters:
+			return type_id
+		rarest_type_id = min((x for x in self.type_keys if x != OVERFLOW_CLUSTER_ID), key=self._get_label_frequency, default=None) # O(|self.type_keys|)
+		if rarest_type_id is not None and self._get_label_frequency(rarest_type_id) < frequency:
+			self._demote_cluster(rarest_type_id) # O(N)
+			return type_id
+		self._routed_batches += 1
+		self._routed_labels[type_id] += 1
+		return OVERFLOW_CLUSTER_ID
+
+	def _demote_cluster(self, type_id): # O(N)
+		"""Moves the batches of cluster type_id to the overflow cluster, with their ids, priorities and insertion times, and removes the cluster. 
+		The less important batches of the larger of the two clusters are evicted first, until they fit together in max_cluster_size."""
+		self._add_type_if_not_exist(OVERFLOW_CLUSTER_ID)
+		src_type, dst_type = self.get_type(type_id), self.get_type(OVERFLOW_CLUSTER_ID)
+		max_cluster_size = min(self.cluster_size, self.max_cluster_size)
+		while self.count(src_type) > 0 and self.count(src_type) + self.count(dst_type) > max_cluster_size: # O(log) per evicted batch
+			type_ = src_type if self.count(src_type) >= self.count(dst_type) else dst_type
+			self.remove_batch(type_, self.get_less_important_batch(type_))
+		src_batches, dst_batches = self.batches[src_type], self.batches[dst_type]
+		if len(src_batches) > 0:
+			if self._shifted_priorities: # base the priorities of both clusters on the same lower bound
+				self._rebase_cluster(src_type)
+				self._rebase_cluster(dst_type)
+			src_arrays, dst_arrays = self._get_cluster_tree_arrays(src_type), self._get_cluster_tree_arrays(dst_type) # O(N)
+			offset = len(dst_batches)
+			for idx, batch_id in enumerate(self._batch_ids[src_type]):
+				dst_batches.append(src_batches[idx])
+				self._batch_index[batch_id] = (OVERFLOW_CLUSTER_ID, offset+idx)
+			self._batch_ids[dst_type] += self._batch_ids[src_type]
+			self._batch_nbytes[dst_type] += self._batch_nbytes[src_type]
+			self._cluster_nbytes[dst_type] += self._cluster_nbytes[src_type]
+			if self._deduplicate_observations:
+				self._new_obs_frames[dst_type] += self._new_obs_frames[src_type]
+			if self._weight_importance_by_update_time:
+				self._update_times[dst_type] += self._update_times[src_type]
+			if offset > 0:
+				self._non_empty_clusters -= 1 # two non-empty clusters become one
+			elif self._track_empty_clusters:
+				self._empty_clusters.pop(dst_type, None)
+			self._build_cluster_trees(dst_type, {k: np.concatenate((dst_arrays[k], src_arrays[k])) for k in dst_arrays}) # O(N), FIFO stamps are sorted again so the moved batches keep their age
+			self._demoted_clusters += 1
+			logger.warning(f'Moved the {len(src_batches)} batches of the cluster with id {type_id} to the overflow cluster, as its label is the rarest.')
+		self._compact_clusters({src_type}) # O(|self.type_keys|), src_type is empty or its batches are in the overflow cluster
+
+	def _reset_cluster_trees(self): # O(1)
+		"""Drops the top-level trees, so that they are rebuilt from scratch when needed."""
+		self._cluster_min_priority_tree = None
+		self._cluster_min_probability_tree = None
+		self._drop_eviction_tree = self._insertion_time_eviction_tree = None
+		if self._cluster_prioritisation_strategy is not None:
+			self._cluster_priority_tree = None
+
+	def _collect_empty_clusters(self): # O(1) amortized
+		"""Removes the clusters that have been empty for at least empty_cluster_grace_period added batches."""
+		expired_clusters = set()
+		for type_, emptied_at in self._empty_clusters.items(): # O(|expired_clusters|), from the first emptied cluster
+			if self._added_batches - emptied_at < self._empty_cluster_grace_period:
+				break
+			expired_clusters.add(type_)
+		if expired_clusters:
+			self._compact_clusters(expired_clusters)
+
+	def _compact_clusters(self, removed_clusters): # O(|self.type_keys|)
+		"""Removes the given (empty) clusters, re-indexing the remaining ones densely and in the same order."""
+		kept_clusters = [x for x in self.type_values if x not in removed_clusters]
+		new_type = {old_type:new_type for new_type,old_type in enumerate(kept_clusters)}
+		keep = lambda cluster_list: [cluster_list[x] for x in kept_clusters]
+		remap = lambda cluster_set: set(new_type[x] for x in cluster_set if x in new_type)
+		removed_ids = [self.type_keys[x] for x in removed_clusters]
+		self.type_keys = keep(self.type_keys)
+		self.type_values = list(range(len(kept_clusters)))
+		self.types = dict(zip(self.type_keys, self.type_values))
+		self.batches = keep(self.batches)
+		self._sample_priority_tree = keep(self._sample_priority_tree)
+		self._batch_ids = keep(self._batch_ids)
+		self._batch_nbytes = keep(self._batch_nbytes)
+		self._cluster_nbytes = keep(self._cluster_nbytes)
+		if self._deduplicate_observations:
+			self._new_obs_frames = keep(self._new_obs_frames)
+		if self._prioritized_drop_probability > 0:
+			self._drop_priority_tree = keep(self._drop_priority_tree)
+		if self._fifo_eviction:
+			self._insertion_order = keep(self._insertion_order)
+			self._insertion_stamps = keep(self._insertion_stamps)
+			self._insertion_index = keep(self._insertion_index)
+		elif self._prioritized_drop_probability < 1:
+			self._insertion_time_tree = keep(self._insertion_time_tree)
+		if self._weight_importance_by_update_time:
+			self._update_times = keep(self._update_times)
+		if self._shifted_priorities:
+			self._cluster_priority_offset = keep(self._cluster_priority_offset)
+			self._clusters_to_rebase = remap(self._clusters_to_rebase)
+		self._empty_clusters = {new_type[x]:t for x,t in self._empty_clusters.items() if x in new_type}
+		self._dirty_clusters = remap(self._dirty_clusters)
+		self._eviction_dirty_clusters = remap(self._eviction_dirty_clusters)
+		self._reset_cluster_trees() # the top-level trees have to be rebuilt without the removed leaves
+		logger.warning(f'Garbage-collected the empty clusters with ids {removed_ids}, now there are {len(self.type_values)} clusters.')
+
 	def resize_buffer(self):
 		# print(random.random())
 		# self.min_cluster_size, self.max_cluster_size = self.get_cluster_min_max_size(count_only_valid_clusters=False)
@@ -119,8 +340,12 @@ class PseudoPrioritizedBuffer(Buffer):
 			elements_to_remove = max(0, self.count(t)-new_max_cluster_size)
 			for _ in range(elements_to_remove):
 				self.remove_batch(t, self.get_less_important_batch(t))
+		if new_min_cluster_size != self.min_cluster_size:
+			self._drop_eviction_tree = self._insertion_time_eviction_tree = None # clusters' eligibility for eviction depends on min_cluster_size
 		self.min_cluster_size = new_min_cluster_size
 		self.max_cluster_size = new_max_cluster_size
+		if self._cluster_prioritisation_strategy == 'weighted_avg':
+			self._cluster_priority_tree = None # cluster priorities depend on max_cluster_size
 	
 	def normalize_priority(self, priority): # O(1)
 		# always add self._prioritization_epsilon so that there is no priority equal to the neutral value of a SumSegmentTree
@@ -128,42 +353,116 @@ class PseudoPrioritizedBuffer(Buffer):
 
 	def get_priority(self, idx, type_id):
 		type_ = self.get_type(type_id)
+		if self._shifted_priorities:
+			return self._sample_priority_tree[type_][idx] + self._cluster_priority_offset[type_]
 		return self._sample_priority_tree[type_][idx]
 
+	def _shift_priority(self, priority, type_): # O(1) amortized
+		"""Returns priority offset by the running lower bound, so that it is > 0."""
+		self._update_priority_offset(priority, type_)
+		return priority - self._priority_offset
+
+	def _update_priority_offset(self, min_priority, type_): # O(1) amortized
+		"""If min_priority is not above the lower bound, the bound is lowered to 2*min_priority (min_priority is < 0 here), and the clusters are lazily re-based on the new bound. 
+		Doubling the bound's magnitude keeps the number of re-bases logarithmic in the range of the priorities."""
+		if min_priority <= self._priority_offset:
+			self._priority_offset = 2*min_priority - self._prioritization_epsilon
+			self._clusters_to_rebase.update(self.type_values) # O(|self.type_keys|), only when the bound changes
+		self._rebase_cluster(type_)
+
+	def _rebase_cluster(self, type_): # O(1) if already based on the current lower bound, otherwise O(N)
+		if type_ not in self._clusters_to_rebase:
+			return
+		self._clusters_to_rebase.remove(type_)
+		delta = self._cluster_priority_offset[type_] - self._priority_offset
+		self._sample_priority_tree[type_].shift(delta) # O(N), it also shifts the drop tree when it is the sample tree's min tree
+		self._cluster_priority_offset[type_] = self._priority_offset
+		self._mark_cluster_as_dirty(type_)
+
+	def _rebase_clusters(self): # O(N) only for the clusters based on an outdated lower bound
+		if self._shifted_priorities:
+			for type_ in tuple(self._clusters_to_rebase):
+				self._rebase_cluster(type_)
+
+	def _resize_cluster_trees(self, type_): # O(1) amortized
+		"""Doubles the trees of a cluster when its batches do not fit anymore, and halves them when it is less than a quarter full, so that their memory is proportional to the cluster occupancy rather than to cluster_size."""
+		sample_tree = self._sample_priority_tree[type_]
+		capacity = sample_tree._capacity
+		occupancy = len(self.batches[type_])
+		if occupancy > capacity:
+			new_capacity = 2*capacity
+		elif capacity > 1 and 4*occupancy <= capacity:
+			new_capacity = capacity//2
+		else:
+			return
+		inserted_elements = sample_tree.inserted_elements
+		sample_tree.resize(new_capacity) # O(N), min and max trees included
+		sample_tree.inserted_elements = inserted_elements # resizing keeps all the batches, also those whose stored priority is 0 (i.e. the neutral element)
+		if self._prioritized_drop_probability > 0 and self._global_distribution_matching:
+			self._drop_priority_tree[type_].resize(new_capacity) # O(N)
+		if self._prioritized_drop_probability < 1 and not self._fifo_eviction:
+			self._insertion_time_tree[type_].resize(new_capacity) # O(N)
+
 	def remove_batch(self, type_, idx): # O(log)
 		last_idx = len(self.batches[type_])-1
 		assert idx <= last_idx, 'idx cannot be greater than last_idx'
 		type_id = self.type_keys[type_]
-		del get_batch_indexes(self.batches[type_][idx])[type_id]
+		batch_ids = self._batch_ids[type_]
+		del self._batch_index[batch_ids[idx]]
+		batch_nbytes = self._batch_nbytes[type_]
+		self._cluster_nbytes[type_] -= batch_nbytes[idx]
+		self._stored_nbytes -= batch_nbytes[idx]
+		if self._fifo_eviction:
+			self._remove_insertion_stamp(type_, idx, last_idx) # O(1)
 		if idx == last_idx: # idx is the last, remove it
 			if self._prioritized_drop_probability > 0 and self._global_distribution_matching:
 				self._drop_priority_tree[type_][idx] = None # O(log)
-			if self._prioritized_drop_probability < 1:
+			if self._prioritized_drop_probability < 1 and not self._fifo_eviction:
 				self._insertion_time_tree[type_][idx] = None # O(log)
 			if self._weight_importance_by_update_time:
 				self._update_times[type_].pop()
 			self._sample_priority_tree[type_][idx] = None # O(log)
+			batch_ids.pop()
+			batch_nbytes.pop()
+			if self._deduplicate_observations:
+				self._new_obs_frames[type_].pop()
 			self.batches[type_].pop()
 		elif idx < last_idx: # swap idx with the last element and then remove it
 			if self._prioritized_drop_probability > 0 and self._global_distribution_matching:
 				self._drop_priority_tree[type_][idx] = (self._drop_priority_tree[type_][last_idx][0],idx) # O(log)
 				self._drop_priority_tree[type_][last_idx] = None # O(log)
-			if self._prioritized_drop_probability < 1:
+			if self._prioritized_drop_probability < 1 and not self._fifo_eviction:
 				self._insertion_time_tree[type_][idx] = (self._insertion_time_tree[type_][last_idx][0],idx) # O(log)
 				self._insertion_time_tree[type_][last_idx] = None # O(log)
 			if self._weight_importance_by_update_time:
 				self._update_times[type_][idx] = self._update_times[type_].pop()
 			self._sample_priority_tree[type_][idx] = self._sample_priority_tree[type_][last_idx] # O(log)
 			self._sample_priority_tree[type_][last_idx] = None # O(log)
-			batch = self.batches[type_][idx] = self.batches[type_].pop()
-			get_batch_indexes(batch)[type_id] = idx
+			if self._columnar_storage:
+				self.batches[type_].move(last_idx, idx) # O(1), a row copy
+				self.batches[type_].pop()
+			else:
+				self.batches[type_][idx] = self.batches[type_].pop()
+			batch_ids[idx] = batch_ids.pop()
+			batch_nbytes[idx] = batch_nbytes.pop()
+			if self._deduplicate_observations:
+				self._new_obs_frames[type_][idx] = self._new_obs_frames[type_].pop()
+			self._batch_index[batch_ids[idx]] = (type_id, idx)
+		self._stored_batches -= 1
+		if last_idx == 0:
+			self._non_empty_clusters -= 1
+			if self._track_empty_clusters:
+				self._empty_clusters[type_] = self._added_batches
+		self._resize_cluster_trees(type_) # O(1) amortized
+		self._mark_cluster_as_dirty(type_) # O(log)
 
-	def count(self, type_=None):
+	def count(self, type_=None): # O(1)
 		if type_ is None:
-			if len(self.batches) == 0:
-				return 0
-			return sum(t.inserted_elements for t in self._sample_priority_tree)
-		return self._sample_priority_tree[type_].inserted_elements
+			return self._stored_batches
+		return len(self.batches[type_])
+
+	def count_available_clusters(self): # O(1)
+		return self._non_empty_clusters
 
 	def get_available_clusters(self):
 		return [x for x in self.type_values if not self.is_empty(x)]
@@ -175,10 +474,10 @@ class PseudoPrioritizedBuffer(Buffer):
 		return int(np.floor(self.global_size/len(self.type_values)))
 
 	def get_cluster_min_max_size(self, count_only_valid_clusters=False):
-		C = len(self.get_available_clusters() if not count_only_valid_clusters else self.get_valid_clusters())
+		C = self.count_available_clusters() if not count_only_valid_clusters else len(self.get_valid_clusters())
 		S_min = int(np.floor(max(
 			1,
-			self.global_size/(C*self._clustering_xi)
+			self.get_batch_capacity()/(C*self._clustering_xi)
 		)))
 		S_max = int(np.ceil(min(
 			self.cluster_size,
@@ -186,6 +485,18 @@ class PseudoPrioritizedBuffer(Buffer):
 		)))
 		return S_min, S_max
 
+	def get_batch_capacity(self): # O(1)
+		"""Returns how many batches the buffer can hold: global_size, or the number of batches of average size that fit in max_bytes, if lower."""
+		if not self._max_bytes or self._stored_batches == 0:
+			return self.global_size
+		bytes_capacity = max(1, int(self._max_bytes*self._stored_batches/self._stored_nbytes))
+		return min(self.global_size, bytes_capacity) if self.global_size else bytes_capacity
+
+	def _has_evictable_clusters(self): # O(|self._eviction_dirty_clusters|*log)
+		self._refresh_eviction_trees()
+		eviction_tree = self._drop_eviction_tree if self._prioritized_drop_probability > 0 else self._insertion_time_eviction_tree
+		return eviction_tree.min(0, len(self.type_keys))[1] >= 0
+
 	def get_cluster_capacity(self, segment_tree):
 		return segment_tree.inserted_elements/self.max_cluster_size
 
@@ -215,6 +526,25 @@ class PseudoPrioritizedBuffer(Buffer):
 			return sum_cluster_priority
 		return build_full_priority()**self._cluster_prioritization_alpha
 
+	def _mark_cluster_as_dirty(self, type_): # O(1)
+		self._dirty_clusters.add(type_)
+		self._eviction_dirty_clusters.add(type_)
+
+	def _get_cluster_priority_tree(self, min_priority): # O(|self._dirty_clusters|*log)
+		"""Returns the top-level tree of cluster priorities, updating only the clusters changed since the last call. The whole tree is rebuilt, in O(|self.type_keys|), only if a cluster was added or if min_priority has changed."""
+		get_cluster_priority = lambda x: self.get_cluster_priority(x, min_priority) if x.inserted_elements > 0 else 0 # O(log)
+		if self._cluster_priority_tree is None or min_priority != self._cluster_priority_tree_min_priority:
+			self._cluster_priority_tree_min_priority = min_priority
+			self._cluster_priority_tree = self._SumSegmentTree.from_array(
+				list(map(get_cluster_priority, self._sample_priority_tree)), 
+				with_min_tree=False
+			)
+		else:
+			for type_ in self._dirty_clusters:
+				cluster_priority = get_cluster_priority(self._sample_priority_tree[type_])
+				self._cluster_priority_tree[type_] = cluster_priority if cluster_priority > 0 else None # O(log)
+		return self._cluster_priority_tree
+
 	def get_cluster_capacity_dict(self):
 		return dict(map(
 			lambda x: (str(self.type_keys[x[0]]), self.get_cluster_capacity(x[1])), 
@@ -222,57 +552,110 @@ class PseudoPrioritizedBuffer(Buffer):
 		))
 
 	def get_cluster_priority_dict(self):
-		min_priority = min(map(lambda x: x.min_tree.min()[0], self._sample_priority_tree)) if self._priority_lower_limit is None else 0 # O(log)
+		self._rebase_clusters()
+		min_priority = min(map(lambda x: x.min_tree.min()[0], self._sample_priority_tree)) if self._stored_priority_can_be_negative else 0 # O(log)
 		return dict(map(
 			lambda x: (str(self.type_keys[x[0]]), self.get_cluster_priority(x[1], min_priority)), 
 			enumerate(self._sample_priority_tree)
 		))
 
+	def _add_insertion_stamp(self, type_, idx): # O(1)
+		stamp = self._insertion_counter
+		self._insertion_counter += 1
+		self._insertion_order[type_].append(stamp)
+		self._insertion_stamps[type_].append(stamp)
+		self._insertion_index[type_][stamp] = idx
+
+	def _remove_insertion_stamp(self, type_, idx, last_idx): # O(1) when removing the oldest batch
+		stamps = self._insertion_stamps[type_]
+		index = self._insertion_index[type_]
+		stamp = stamps[idx]
+		del index[stamp]
+		order = self._insertion_order[type_]
+		if order[0] == stamp:
+			order.popleft() # O(1)
+		else: # never happens with FIFO eviction, unless remove_batch is called directly
+			order.remove(stamp) # O(n)
+		if idx < last_idx: # the last batch is moved to idx
+			stamps[idx] = stamps[last_idx]
+			index[stamps[idx]] = idx
+		stamps.pop()
+
+	def _get_oldest_batch(self, type_): # O(1) with FIFO eviction, O(log) otherwise
+		"""Returns (insertion key, idx) of the oldest batch of the cluster."""
+		if self._fifo_eviction:
+			stamp = self._insertion_order[type_][0]
+			return stamp, self._insertion_index[type_][stamp]
+		return self._insertion_time_tree[type_].min()
+
 	def get_less_important_batch(self, type_):
-		ptree = self._drop_priority_tree[type_] if random.random() <= self._prioritized_drop_probability else self._insertion_time_tree[type_]
-		_,idx = ptree.min() # O(log)
+		if random.random() <= self._prioritized_drop_probability:
+			_,idx = self._drop_priority_tree[type_].min() # O(log)
+		else:
+			_,idx = self._get_oldest_batch(type_)
 		return idx
 
-	def remove_less_important_batches(self, n):
+	def _get_eviction_tree(self, get_min, eviction_tree): # O(|self._eviction_dirty_clusters|*log)
+		"""Returns the top-level tree of (value, type_), where (value, idx) = get_min(type_) is the less important batch of the cluster, for every cluster that can be evicted (i.e. with at least min_cluster_size elements). 
+		Only the clusters changed since the last call are updated. The whole tree is rebuilt, in O(|self.type_keys|), only if a cluster was added or min_cluster_size has changed."""
+		get_less_important_batch = lambda x: (get_min(x)[0], x) if self.has_atleast(self.min_cluster_size, x) else None # O(log)
+		if eviction_tree is None:
+			return self._MinSegmentTree.from_array(
+				[get_less_important_batch(x) or (float('inf'),-1) for x in self.type_values], 
+				neutral_element=(float('inf'),-1)
+			)
+		for type_ in self._eviction_dirty_clusters:
+			eviction_tree[type_] = get_less_important_batch(type_) # O(log)
+		return eviction_tree
+
+	def _refresh_eviction_trees(self): # O(|self._eviction_dirty_clusters|*log)
+		if self._prioritized_drop_probability > 0:
+			self._drop_eviction_tree = self._get_eviction_tree(lambda x: self._drop_priority_tree[x].min(), self._drop_eviction_tree)
+		if self._prioritized_drop_probability < 1:
+			self._insertion_time_eviction_tree = self._get_eviction_tree(self._get_oldest_batch, self._insertion_time_eviction_tree)
+		self._eviction_dirty_clusters.clear()
+
+	def remove_less_important_batches(self, n): # O(n*log)
 		# Pick the right tree list
 		if random.random() <= self._prioritized_drop_probability: 
 			# Remove the batch with lowest priority
-			tree_list = self._drop_priority_tree
+			get_min = lambda x: self._drop_priority_tree[x].min() # O(log)
+			if not self._global_distribution_matching:
+				self._rebase_clusters() # priorities of different clusters are compared
+			self._refresh_eviction_trees()
+			eviction_tree = self._drop_eviction_tree
 		else: 
 			# Remove the oldest batch
-			tree_list = self._insertion_time_tree
-		# Build the generator of the less important batch in every cluster
+			get_min = self._get_oldest_batch
+			self._refresh_eviction_trees()
+			eviction_tree = self._insertion_time_eviction_tree
+		# The eviction tree holds the less important batch of every cluster with at least min_cluster_size elements
 		# For all cluster to have the same size Y, we have that Y = N/C.
 		# If we want to guarantee that every cluster contains at least pY elements while still reaching the maximum capacity of the whole buffer, then pY is the minimum size of a cluster.
 		# If we want to constrain the maximum size of a cluster, we have to constrain with q the remaining (1-p)YC = (1-p)N elements so that (1-p)N = qpY, having that the size of a cluster is in [pY, pY+qpY].
 		# Hence (1-p)N = qpN/C, then 1-p = qp/C, then p = 1/(1+q/C) = C/(C+q).
 		# Therefore, we have that the minimum cluster's size pY = N/(C+q).
-		less_important_batch_gen = (
-			(*tree_list[type_].min(), type_) # O(log)
-			for type_ in self.type_values
-			if self.has_atleast(self.min_cluster_size, type_)
-			# if not self.is_empty(type_)
-		)
-		less_important_batch_gen_len = len(self.type_values)
+		batches_to_remove = []
+		for _ in range(n): # Pick the first N less important batches, at most one per cluster
+			_, type_ = eviction_tree.min(0, len(self.type_keys)) # O(log)
+			if type_ < 0:
+				break
+			_, idx = get_min(type_) # O(log)
+			batches_to_remove.append((type_, idx))
+			eviction_tree[type_] = None # O(log), the cluster is updated again at the next refresh because removing a batch makes it dirty
+		assert len(batches_to_remove) > 0, "Cannot remove any batch from this buffer, it has too few elements"
 		# Remove the first N less important batches
-		assert less_important_batch_gen_len > 0, "Cannot remove any batch from this buffer, it has too few elements"
-		if n > 1 and less_important_batch_gen_len > 1:
-			batches_to_remove = sorted(less_important_batch_gen, key=lambda x: x[0])
-			n = min(n, len(batches_to_remove))
-			for i in range(n):
-				_, idx, type_ = batches_to_remove[i]
-				self.remove_batch(type_, idx)
-		else:
-			_, idx, type_ = min(less_important_batch_gen, key=lambda x: x[0])
+		for type_, idx in batches_to_remove:
 			self.remove_batch(type_, idx)
 		if len(self.batches[type_]) == 0:
-			logger.warning(f'Removed an old cluster with id {self.type_keys[type_]}, now there are {len(self.get_available_clusters())} different clusters.')
+			logger.warning(f'Removed an old cluster with id {self.type_keys[type_]}, now there are {self.count_available_clusters()} different clusters.')
 			self.resize_buffer()
 
 	def _is_full_cluster(self, type_):
 		return self.has_atleast(min(self.cluster_size,self.max_cluster_size), type_)
 		
 	def add(self, batch, type_id=0, update_prioritisation_weights=False): # O(log)
+		type_id = self._route_cluster(type_id)
 		self._add_type_if_not_exist(type_id)
 		type_ = self.get_type(type_id)
 		type_batch = self.batches[type_]
@@ -294,145 +677,299 @@ class PseudoPrioritizedBuffer(Buffer):
 		# 	if self._weight_importance_by_update_time:
 		# 		self._update_times[type_][idx] = self._max_age_window
 		################################
+		batch_id = next(batch_id_counter)
+		batch["batch_ids"] = np.full(batch.count, batch_id, dtype=np.int64) # before appending, columnar storage copies the columns
+		if self._prioritization_importance_beta and 'weights' not in batch: # Add default weights, before counting the bytes of the batch
+			batch['weights'] = np.ones(batch.count, dtype=np.float32)
+		if self._deduplicate_observations and batch.count > 1 and can_deduplicate_obs(batch): # store only the frames of new_obs that are not in obs
+			new_obs_frames = split_new_obs(batch) # O(n)
+			stored_batch = type(batch)({k:v for k,v in batch.items() if k != 'new_obs'})
+			nbytes = get_batch_nbytes(stored_batch) + sum(x.nbytes for x in new_obs_frames) # O(number of columns)
+		else: # e.g. single-transition batches, nothing to deduplicate
+			new_obs_frames = None
+			stored_batch = batch
+			nbytes = get_batch_nbytes(batch) # O(number of columns)
 		if self._is_full_cluster(type_) or self.is_full_buffer(): # if full buffer, remove the less important batch in the whole buffer
 			self.remove_less_important_batches(1)
+		if self._max_bytes: # remove the less important batches until the new one fits in max_bytes
+			while self._stored_batches > 0 and self._stored_nbytes + nbytes > self._max_bytes and self._has_evictable_clusters():
+				self.remove_less_important_batches(1)
 		# Add new element to buffer
 		idx = len(type_batch)
-		type_batch.append(batch)
+		type_batch.append(stored_batch)
+		self._batch_ids[type_].append(batch_id)
+		if self._deduplicate_observations:
+			self._new_obs_frames[type_].append(new_obs_frames)
+		self._batch_nbytes[type_].append(nbytes)
+		self._cluster_nbytes[type_] += nbytes
+		self._stored_nbytes += nbytes
+		self._batch_index[batch_id] = (type_id, idx)
+		self._added_batches += 1
+		self._stored_batches += 1
+		if idx == 0:
+			self._non_empty_clusters += 1
+			if self._track_empty_clusters:
+				self._empty_clusters.pop(type_, None)
+		self._resize_cluster_trees(type_) # O(1) amortized
 		if self._weight_importance_by_update_time:
 			self._update_times[type_].append(self._max_age_window)
 		################################
-		# Update batch infos
-		batch_infos = get_batch_infos(batch)
-		if 'batch_index' not in batch_infos:
-			batch_infos['batch_index'] = {}
-		batch_infos['batch_index'][type_id] = idx
-		batch_infos['batch_uid'] = str(uuid.uuid4()) # random unique id
 		# Set insertion time
-		if self._prioritized_drop_probability < 1:
+		if self._fifo_eviction:
+			self._add_insertion_stamp(type_, idx) # O(1)
+		elif self._prioritized_drop_probability < 1:
 			self._insertion_time_tree[type_][idx] = (self.get_relative_time(), idx) # O(log)
 		# Set drop priority
 		if self._prioritized_drop_probability > 0 and self._global_distribution_matching:
 			self._drop_priority_tree[type_][idx] = (random.random(), idx) # O(log)
 		# Set priority
-		self.update_priority(batch, idx, type_id) # add batch
+		self.update_priority(batch) # add batch
 		# Resize buffer
 		if len(type_batch) == 1:
-			logger.warning(f'Added a new cluster with id {type_id}, now there are {len(self.get_available_clusters())} different clusters.')
+			logger.warning(f'Added a new cluster with id {type_id}, now there are {self.count_available_clusters()} different clusters.')
+			self.resize_buffer()
+		elif self._max_bytes: # the capacity in batches depends on their average size
 			self.resize_buffer()
 		if self._prioritization_importance_beta:
 			if update_prioritisation_weights: # Update weights after updating priority
 				self._cache_priorities()
 				self.update_beta_weights(batch, idx, type_)
-			elif 'weights' not in batch: # Add default weights
-				batch['weights'] = np.ones(batch.count, dtype=np.float32)
-		if self.global_size:
-			assert self.count() <= self.global_size, 'Memory leak in replay buffer; v1'
-			assert super().count() <= self.global_size, 'Memory leak in replay buffer; v2'
+		if self._empty_cluster_grace_period:
+			self._collect_empty_clusters()
+		if self._debug_checks: # O(|self.type_keys|)
+			assert self.count() == super().count(), 'Memory leak in replay buffer; wrong global counter'
+			assert self.count_available_clusters() == len(self.get_available_clusters()), 'Memory leak in replay buffer; wrong cluster counter'
+			assert self._stored_nbytes == sum(self._cluster_nbytes) == sum(map(sum, self._batch_nbytes)), 'Memory leak in replay buffer; wrong bytes counter'
+			if self._deduplicate_observations:
+				assert list(map(len, self._new_obs_frames)) == list(map(len, self.batches)), 'Memory leak in replay buffer; misaligned new_obs frames'
+			if self.global_size:
+				assert self.count() <= self.global_size, 'Memory leak in replay buffer; v1'
 		return idx, type_id
 
-	def _cache_priorities(self):
+	def _refresh_cluster_aggregates(self): # O(|self._dirty_clusters|*log)
+		"""Updates the cached min, sum and count of the clusters changed since the last call. Everything is recomputed, in O(|self.type_keys|), only if a cluster was added."""
+		if self._cluster_min_priority_tree is None:
+			self.__min_priority_list = [x.min_tree.min()[0] for x in self._sample_priority_tree] # O(log)
+			self.__tot_priority_list = [x.sum() for x in self._sample_priority_tree] # O(log)
+			self.__tot_elements_list = [x.inserted_elements for x in self._sample_priority_tree] # O(1)
+			self.__tot_elements = sum(self.__tot_elements_list)
+			self._cluster_min_priority_tree = self._MinSegmentTree.from_array(
+				[(p,x) for x,p in enumerate(self.__min_priority_list)], 
+				neutral_element=(float('inf'),-1)
+			)
+			self._cluster_tot_priority_tree = self._SumSegmentTree.from_array(self.__tot_priority_list, with_min_tree=False)
+			return
+		for type_ in self._dirty_clusters:
+			cluster_sum_tree = self._sample_priority_tree[type_]
+			self.__min_priority_list[type_] = cluster_sum_tree.min_tree.min()[0] # O(log)
+			self.__tot_priority_list[type_] = cluster_sum_tree.sum() # O(log)
+			self.__tot_elements += cluster_sum_tree.inserted_elements - self.__tot_elements_list[type_]
+			self.__tot_elements_list[type_] = cluster_sum_tree.inserted_elements
+			self._cluster_min_priority_tree[type_] = (self.__min_priority_list[type_], type_) # O(log)
+			self._cluster_tot_priority_tree[type_] = self.__tot_priority_list[type_] # O(log)
+
+	def _get_cluster_min_probability_tree(self, cluster_priority_tree): # O(|self._dirty_clusters|*log)
+		"""Returns the top-level tree of (p, type_), where p is the transition probability of the cluster's min priority times the total cluster priority, which is the same for all the clusters. 
+		The whole tree is rebuilt, in O(|self.type_keys|), only if the cluster priority tree was rebuilt or the historical min priority (used to normalise priorities) has changed."""
+		historical_min_priority = self.__historical_min_priority if self._stored_priority_can_be_negative else None
+		norm_fn = self._get_priority_norm_fn()
+		def get_min_probability(type_): # O(1)
+			if self.is_empty(type_):
+				return None
+			return cluster_priority_tree[type_] * norm_fn(self.__min_priority_list[type_], 1) / norm_fn(self.__tot_priority_list[type_], self.__tot_elements_list[type_])
+		if self._cluster_min_probability_tree is None or self._cluster_min_probability_tree_keys != (cluster_priority_tree, historical_min_priority):
+			self._cluster_min_probability_tree_keys = (cluster_priority_tree, historical_min_priority)
+			self._cluster_min_probability_tree = self._MinSegmentTree.from_array(
+				[(get_min_probability(x),x) if not self.is_empty(x) else (float('inf'),-1) for x in self.type_values], 
+				neutral_element=(float('inf'),-1)
+			)
+		else:
+			for type_ in self._dirty_clusters:
+				p = get_min_probability(type_)
+				self._cluster_min_probability_tree[type_] = (p, type_) if p is not None else None # O(log)
+		return self._cluster_min_probability_tree
+
+	def _cache_priorities(self): # O(|self._dirty_clusters|*log)
+		self._rebase_clusters()
 		if self._prioritization_importance_beta or self._cluster_prioritisation_strategy is not None:
-			self.__min_priority_list = tuple(map(lambda x: x.min_tree.min()[0], self._sample_priority_tree)) # O(log)
-			self.__min_priority = min(self.__min_priority_list)
+			self._refresh_cluster_aggregates()
+			self.__min_priority = self._cluster_min_priority_tree.min(0, len(self.type_keys))[0] # O(log)
 			self.__historical_min_priority = min(self.__min_priority,self.__historical_min_priority)
 		if self._prioritization_importance_beta:
-			self.__tot_priority_list = tuple(map(lambda x: x.sum(), self._sample_priority_tree)) # O(log)
-			self.__tot_priority = sum(self.__tot_priority_list)
-			self.__tot_elements_list = tuple(map(lambda x: x.inserted_elements, self._sample_priority_tree)) # O(1)
-			self.__tot_elements = sum(self.__tot_elements_list)
+			self.__tot_priority = self._cluster_tot_priority_tree.sum(0, len(self.type_keys)) # O(log)
 		# if self._prioritization_importance_beta and self._priority_lower_limit is None:
 		# 	self.__max_priority_list = tuple(map(lambda x: x.max_tree.max()[0], self._sample_priority_tree)) # O(log)
 		# 	self.__max_priority = max(self.__max_priority_list)
 		if self._cluster_prioritisation_strategy is not None:
-			self.__cluster_priority_list = tuple(map(lambda x: self.get_cluster_priority(x, self.__min_priority if self._priority_lower_limit is None else 0), self._sample_priority_tree)) # always > 0
-			self.__tot_cluster_priority = sum(self.__cluster_priority_list)
-			# eta_normalise = lambda x: self.eta_normalisation(x, np.min(x), np.max(x), np.abs(np.std(x)/np.mean(x))) # using the coefficient of variation as eta
-			# self.__cluster_priority_list = eta_normalise(eta_normalise(self.__cluster_priority_list)) # first eta-normalisation makes priorities in (0,1], but it inverts their magnitude # second eta-normalisation guarantees original priorities magnitude is preserved
-			self.__min_cluster_priority = min(self.__cluster_priority_list)
+			cluster_priority_tree = self._get_cluster_priority_tree(self.__min_priority if self._stored_priority_can_be_negative else 0)
+			self.__tot_cluster_priority = cluster_priority_tree.sum(0, len(self.type_keys)) # O(log) # always > 0
+		if self._prioritization_importance_beta: # the lowest transition probability, used by all the importance weights until the next call
+			if self._cluster_level_weighting and self._cluster_prioritisation_strategy is not None:
+				_,type_ = self._get_cluster_min_probability_tree(cluster_priority_tree).min(0, len(self.type_keys)) # O(log)
+				self.__min_probability = self.get_transition_probability(self.__min_priority_list[type_], type_)
+			else:
+				self.__min_probability = self.get_transition_probability(self.__min_priority)
+		self._dirty_clusters.clear()
+
+	def cache_priorities(self): # O(|self._dirty_clusters|*log)
+		"""Updates the cached cluster priorities and min probability, so that many threads can then call sample(recompute_priorities=False) at once without changing the buffer."""
+		self._cache_priorities()
 
 	def sample_cluster(self):
 		if self._cluster_prioritisation_strategy is not None:
-			type_cumsum = np.cumsum(self.__cluster_priority_list) # O(|self.type_keys|)
-			type_mass = random.random() * type_cumsum[-1] # O(1)
+			type_mass = random.random() * self.__tot_cluster_priority # O(1)
 			assert 0 <= type_mass, f'type_mass {type_mass} should be greater than 0'
-			assert type_mass <= type_cumsum[-1], f'type_mass {type_mass} should be lower than {type_cumsum[-1]}'
-			type_,_ = next(filter(lambda x: x[-1] >= type_mass and not self.is_empty(x[0]), enumerate(type_cumsum))) # O(|self.type_keys|)
+			type_ = self._cluster_priority_tree.find_prefixsum_leaf(type_mass) # O(log)
+			if type_ >= len(self.type_values) or self.is_empty(type_): # all the clusters have priority 0, or rounding errors
+				type_ = next(filter(lambda x: not self.is_empty(x), self.type_values)) # O(|self.type_keys|)
 		else:
 			type_ = random.choice(tuple(filter(lambda x: not self.is_empty(x), self.type_values)))
 		type_id = self.type_keys[type_]
 		return type_id, type_
 
+	def get_priority_mass(self): # O(|self._dirty_clusters|*log)
+		"""Returns the mass clusters are sampled from: the sum of the cluster priorities, or the number of non-empty clusters if they are sampled uniformly.
+		Picking one of many buffers (e.g. replay buffer shards) with probability proportional to its mass, and then sampling from it, draws clusters and batches as a single buffer holding all of them would, with the 'sum' cluster_prioritisation_strategy and a cluster_prioritization_alpha of 1."""
+		if self.is_empty():
+			return 0
+		if self._cluster_prioritisation_strategy is None:
+			return self.count_available_clusters()
+		self._cache_priorities()
+		return self.__tot_cluster_priority
+
+	def get_min_probability(self): # O(|self._dirty_clusters|*log)
+		"""Returns the lowest transition probability, the one the importance weights of the sampled batches are normalised by, or None if there are no importance weights."""
+		if self.is_empty() or not self._prioritization_importance_beta:
+			return None
+		self._cache_priorities()
+		return self.__min_probability
+
 	def sample(self, n=1, recompute_priorities=True): # O(log)
 		if recompute_priorities:
 			self._cache_priorities()
 		type_id, type_ = self.sample_cluster()
 		cluster_sum_tree = self._sample_priority_tree[type_]
 		type_batch = self.batches[type_]
-		idx_list = [
-			cluster_sum_tree.find_prefixsum_idx(prefixsum_fn=lambda mass: mass*random.random(), check_min=self._priority_can_be_negative) # O(log)
-			for _ in range(n)
-		]
-		batch_list = [
-			type_batch[idx] # O(1)
-			for idx in idx_list
-		]
+		idx_list = cluster_sum_tree.find_prefixsum_idx_batch(
+			prefixsums=stratified_prefixsums(n) if self._stratified_sampling else uniform_prefixsums(n), 
+			check_min=self._stored_priority_can_be_negative
+		) # O(log)
+		if self._columnar_storage:
+			batch_list = type_batch.gather(idx_list) # O(n)
+		else:
+			batch_list = [
+				type_batch[idx] # O(1)
+				for idx in idx_list
+			]
+		if self._deduplicate_observations:
+			batch_list = [
+				self._restore_new_obs(batch, type_, idx) # O(n)
+				for batch,idx in zip(batch_list,idx_list)
+			]
 		# Update weights
 		if self._prioritization_importance_beta: # Update weights
-			for batch,idx in zip(batch_list,idx_list):
-				self.update_beta_weights(batch, idx, type_)
+			count_list = [batch.count for batch in batch_list]
+			weights = np.repeat(self.get_importance_weights(idx_list, type_).astype(np.float32), count_list) # O(n), a single array for all the batches
+			offset = 0
+			for batch,count in zip(batch_list,count_list):
+				batch['weights'] = weights[offset:offset+count]
+				offset += count
 		return batch_list
 
+	def _restore_new_obs(self, batch, type_, idx): # O(n)
+		"""Returns batch with the new_obs column rebuilt from its obs, without changing the stored batch."""
+		new_obs_frames = self._new_obs_frames[type_][idx]
+		if new_obs_frames is None:
+			return batch
+		if not self._columnar_storage: # the stored batch is not a copy
+			batch = type(batch)(dict(batch.items()))
+		batch['new_obs'] = merge_new_obs(batch['obs'], *new_obs_frames)
+		return batch
+
 	def get_age_weight(self, type_, idx):
 		return max(1,self._update_times[type_][idx])/self._max_age_window
 
 	@staticmethod
 	def normalise_priority(priority, historical_min_priority, n=1):
 		historical_min_priority *= n
-		assert priority >= historical_min_priority, f"priority must be >= historical_min_priority, but it is {priority} while historical_min_priority is {historical_min_priority}"
+		assert np.all(priority >= historical_min_priority), f"priority must be >= historical_min_priority, but it is {priority} while historical_min_priority is {historical_min_priority}"
 		return (priority - historical_min_priority)#/(upper_min_priority - lower_min_priority)
 
+	def _get_priority_norm_fn(self):
+		return (lambda p,n: p) if not self._stored_priority_can_be_negative else (lambda x,n: self.normalise_priority(x, self.__historical_min_priority, n=n))
+
 	def get_transition_probability(self, priority, type_=None, norm_fn=None):
 		if norm_fn is None:
-			norm_fn = (lambda p,n: p) if self._priority_lower_limit is not None else (lambda x,n: self.normalise_priority(x, self.__historical_min_priority, n=n))
+			norm_fn = self._get_priority_norm_fn()
 		if type_ is None:
 			return norm_fn(priority, 1) / norm_fn(self.__tot_priority, self.__tot_elements)
-		p_cluster = self.__cluster_priority_list[type_] / self.__tot_cluster_priority # clusters priorities are already > 0
+		p_cluster = self._cluster_priority_tree[type_] / self.__tot_cluster_priority # clusters priorities are already > 0
 		p_transition_given_cluster = norm_fn(priority, 1) / norm_fn(self.__tot_priority_list[type_], self.__tot_elements_list[type_])
 		# print(p_cluster, p_transition_given_cluster)
 		return p_cluster*p_transition_given_cluster # joint probability of dependent events
 
-	def update_beta_weights(self, batch, idx, type_):
+	def get_importance_weights(self, idx_list, type_): # O(n)
+		"""Returns the importance weights of the batches at idx_list in cluster type_, computed with a single array expression."""
 		##########
 		# Get priority weight
-		this_priority = self._sample_priority_tree[type_][idx]
+		cluster_sum_tree = self._sample_priority_tree[type_]
+		priorities = np.array([cluster_sum_tree[idx] for idx in idx_list], dtype=np.float64)
 		# assert self.__min_priority_list == tuple(map(lambda x: x.min_tree.min()[0], self._sample_priority_tree)), "Wrong beta updates"
 		if self._cluster_level_weighting and self._cluster_prioritisation_strategy is not None:
-			this_probability = self.get_transition_probability(this_priority, type_)
-			min_probability = min((self.get_transition_probability(self.__min_priority_list[x], x) for x in self.type_values))
+			probabilities = self.get_transition_probability(priorities, type_)
 		else:
-			this_probability = self.get_transition_probability(this_priority)
-			min_probability = self.get_transition_probability(self.__min_priority)
-		weight = min_probability/this_probability
-		weight = weight**self._prioritization_importance_beta
+			probabilities = self.get_transition_probability(priorities)
+		weights = self.__min_probability/probabilities
+		weights = weights**self._prioritization_importance_beta
 		##########
 		# Add age weight
 		# if self._weight_importance_by_update_time:
-		# 	weight *= self.get_age_weight(type_, idx) # batches with outdated priorities should have a lower weight, they might be just noise
+		# 	weights *= self.get_age_weight(type_, idx) # batches with outdated priorities should have a lower weight, they might be just noise
 		##########
+		return weights
+
+	def update_beta_weights(self, batch, idx, type_):
+		weight = self.get_importance_weights([idx], type_)[0]
 		batch['weights'] = np.full(batch.count, weight, dtype=np.float32)
 
 	def get_batch_priority(self, batch):
 		return self._priority_aggregation_fn(batch[self._priority_id])
 	
-	def update_priority(self, new_batch, idx, type_id=0): # O(log)
-		type_ = self.get_type(type_id)
-		if type_ is None:
-			return
-		if idx >= len(self.batches[type_]):
-			return
-		if get_batch_uid(new_batch) != get_batch_uid(self.batches[type_][idx]):
+	def get_batch_location(self, batch_id): # O(1)
+		"""Returns (type_, idx) of the stored batch with the given id, or None if it is no longer in the buffer."""
+		location = self._batch_index.get(batch_id, None)
+		if location is None:
+			return None
+		type_id, idx = location
+		return self.get_type(type_id), idx
+
+	def get_batch_length(self, batch_id): # O(1)
+		"""Returns the number of rows of the stored batch with the given id, or None if it is no longer in the buffer."""
+		location = self.get_batch_location(batch_id)
+		if location is None:
+			return None
+		type_, idx = location
+		type_batch = self.batches[type_]
+		return type_batch.get_count(idx) if self._columnar_storage else type_batch[idx].count
+
+	def get_batch_starts(self, row_batch_ids): # O(n)
+		"""Returns the index of the first row of every batch in a concatenation of batches (e.g. a train batch), given its batch_ids column.
+		Consecutive copies of the same batch are told apart by the length of the stored batch."""
+		row_batch_ids = np.asarray(row_batch_ids)
+		run_starts = np.flatnonzero(np.concatenate(([True], row_batch_ids[1:] != row_batch_ids[:-1])))
+		run_ends = np.append(run_starts[1:], len(row_batch_ids))
+		batch_starts = []
+		for start, end in zip(run_starts.tolist(), run_ends.tolist()):
+			batch_length = self.get_batch_length(int(row_batch_ids[start])) or end-start
+			batch_starts.extend(range(start, end, batch_length))
+		return np.array(batch_starts, dtype=np.int64)
+
+	def update_priority(self, new_batch): # O(log)
+		"""Updates the priority of the stored batch with the same id of new_batch, if it is still in the buffer."""
+		location = self.get_batch_location(get_batch_id(new_batch))
+		if location is None:
 			return
+		type_, idx = location
 		# for k,v in self.batches[type_][idx].data.items():
 		# 	if not np.array_equal(new_batch[k],v):
 		# 		print(k,v,new_batch[k])
@@ -445,17 +982,233 @@ class PseudoPrioritizedBuffer(Buffer):
 		# Update priority
 		if self._weight_importance_by_update_time:
 			normalized_priority *= self.get_age_weight(type_, idx) # batches with outdated priorities should have a lower weight, they might be just noise
+		if self._shifted_priorities:
+			normalized_priority = self._shift_priority(normalized_priority, type_)
 		self._sample_priority_tree[type_][idx] = normalized_priority # O(log)
+		self._mark_cluster_as_dirty(type_) # O(log)
 		if self._weight_importance_by_update_time:
 			self._update_times[type_][idx] = self._update_times[type_][idx] - 1 # O(1)
 
+	def aggregate_priorities(self, priorities, batch_starts): # O(n)
+		"""Returns the priority of every batch, given the flat column of priorities of many concatenated batches and the index of the first row of every batch.
+		If priority_aggregation_fn has an equivalent segment reduction (e.g. np.mean), all the batches are aggregated at once."""
+		priorities = np.asarray(priorities)
+		batch_starts = np.asarray(batch_starts, dtype=np.int64)
+		if self._priority_segment_reduction is not None and priorities.ndim == 1:
+			if not self._priority_can_be_negative:
+				priorities = np.abs(priorities)
+			return self._priority_segment_reduction(priorities, batch_starts)
+		return np.array([
+			self._priority_aggregation_fn(x)
+			for x in np.split(priorities, batch_starts[1:])
+		], dtype=np.float64)
+
+	def update_priorities(self, new_priorities, batch_id_list): # O(n*log)
+		"""Same as calling update_priority for every batch, given its aggregated priority (e.g. see aggregate_priorities) and its id.
+		Batches that are no longer in the buffer and duplicates are skipped, then the priorities of every cluster are normalized and written to its trees at once."""
+		cluster_dict = {}
+		for priority, batch_id in zip(new_priorities, batch_id_list):
+			location = self.get_batch_location(batch_id) # O(1)
+			if location is None:
+				continue
+			type_, idx = location
+			cluster_priorities = cluster_dict.get(type_, None)
+			if cluster_priorities is None:
+				cluster_priorities = cluster_dict[type_] = {}
+			if idx not in cluster_priorities: # keep the first occurrence
+				cluster_priorities[idx] = priority
+		for type_, cluster_priorities in cluster_dict.items():
+			cluster_idx_list = np.fromiter(cluster_priorities.keys(), dtype=np.int64, count=len(cluster_priorities))
+			new_priority = np.fromiter(cluster_priorities.values(), dtype=np.float64, count=len(cluster_priorities))
+			if self._priority_lower_limit is not None:
+				assert np.all(new_priority >= self._priority_lower_limit), f"new_priority must be > priority_lower_limit, but it is {new_priority.min()}"
+				new_priority -= self._priority_lower_limit
+			normalized_priority = np.where(new_priority < 0, -1, 1)*(np.absolute(new_priority) + self._prioritization_epsilon)**self._prioritization_alpha
+			if self._weight_importance_by_update_time:
+				update_times = self._update_times[type_]
+				normalized_priority *= np.maximum(1, np.array([update_times[idx] for idx in cluster_idx_list]))/self._max_age_window
+				for idx in cluster_idx_list:
+					update_times[idx] -= 1
+			if self._shifted_priorities:
+				self._update_priority_offset(float(normalized_priority.min()), type_)
+				normalized_priority -= self._priority_offset
+			self._sample_priority_tree[type_].update(cluster_idx_list, normalized_priority) # O(n*log)
+			self._mark_cluster_as_dirty(type_) # O(1)
+
 	def get_relative_time(self):
 		return time.time()-self._base_time
 
+	def get_config(self):
+		config = super().get_config()
+		config.update({
+			'max_clusters': self._max_clusters,
+			'clustering_xi': self._clustering_xi,
+			'max_bytes': self._max_bytes,
+			'prioritization_alpha': self._prioritization_alpha,
+			'priority_lower_limit': self._priority_lower_limit,
+			'shifted_priorities': self._shifted_priorities,
+			'prioritized_drop_probability': self._prioritized_drop_probability,
+			'global_distribution_matching': self._global_distribution_matching,
+			'max_age_window': self._max_age_window,
+			'deduplicate_observations': self._deduplicate_observations,
+		})
+		return config
+
+	def get_state(self):
+		state = super().get_state()
+		state.update({
+			'relative_time': self.get_relative_time(),
+			'historical_min_priority': self.__historical_min_priority,
+			'priority_offset': self._priority_offset,
+			'min_cluster_size': self.min_cluster_size,
+			'max_cluster_size': self.max_cluster_size,
+			'added_batches': self._added_batches,
+			'routed_batches': self._routed_batches,
+			'demoted_clusters': self._demoted_clusters,
+			'label_frequency': self._label_frequency,
+			'empty_clusters': self._empty_clusters,
+		})
+		if self._fifo_eviction:
+			state['insertion_counter'] = self._insertion_counter
+		if self._shifted_priorities:
+			state['cluster_priority_offset'] = self._cluster_priority_offset
+			state['clusters_to_rebase'] = self._clusters_to_rebase
+		return state
+
+	def set_state(self, state):
+		super().set_state(state)
+		self._base_time = time.time()-state['relative_time']
+		self.__historical_min_priority = state['historical_min_priority']
+		self._priority_offset = state['priority_offset']
+		self.min_cluster_size = state['min_cluster_size']
+		self.max_cluster_size = state['max_cluster_size']
+		self._added_batches = state['added_batches']
+		self._routed_batches = state['routed_batches']
+		self._demoted_clusters = state['demoted_clusters']
+		self._label_frequency = state['label_frequency']
+		self._empty_clusters = state['empty_clusters']
+		if self._fifo_eviction:
+			self._insertion_counter = state['insertion_counter']
+		if self._shifted_priorities:
+			self._cluster_priority_offset = state['cluster_priority_offset']
+			self._clusters_to_rebase = state['clusters_to_rebase']
+		self._reset_cluster_trees() # O(1), the top-level trees are rebuilt from the loaded clusters
+
+	def _get_cluster_tree_arrays(self, type_): # O(N)
+		"""Returns the leaves of the trees of a cluster (priorities, insertion times, etc.) as arrays."""
+		idx_list = range(len(self.batches[type_]))
+		cluster_arrays = {
+			'priorities': np.array([self._sample_priority_tree[type_][idx] for idx in idx_list], dtype=np.float64),
+		}
+		if self._prioritized_drop_probability > 0 and self._global_distribution_matching:
+			cluster_arrays['drop_priorities'] = np.array([self._drop_priority_tree[type_][idx][0] for idx in idx_list], dtype=np.float64)
+		if self._fifo_eviction:
+			cluster_arrays['insertion_stamps'] = np.array(self._insertion_stamps[type_], dtype=np.int64)
+		elif self._prioritized_drop_probability < 1:
+			cluster_arrays['insertion_times'] = np.array([self._insertion_time_tree[type_][idx][0] for idx in idx_list], dtype=np.float64)
+		return cluster_arrays
+
+	def _build_cluster_trees(self, type_, cluster_arrays): # O(N)
+		"""Builds the trees of a cluster from the leaves returned by _get_cluster_tree_arrays, in O(N) rather than setting them one by one."""
+		occupancy = len(self.batches[type_])
+		sample_tree = self._sample_priority_tree[type_] = self._new_sample_priority_tree(cluster_arrays['priorities'].tolist()) # O(N)
+		sample_tree.inserted_elements = occupancy # also the batches whose stored priority is 0 (i.e. the neutral element)
+		if self._prioritized_drop_probability > 0:
+			self._drop_priority_tree[type_] = (
+				self._MinSegmentTree.from_array(list(zip(cluster_arrays['drop_priorities'].tolist(), range(occupancy))), neutral_element=(float('inf'),-1)) # O(N)
+				if self._global_distribution_matching else
+				sample_tree.min_tree
+			)
+		if self._fifo_eviction:
+			insertion_stamps = cluster_arrays['insertion_stamps'].tolist()
+			self._insertion_stamps[type_] = insertion_stamps
+			self._insertion_order[type_] = deque(sorted(insertion_stamps)) # O(N*log)
+			self._insertion_index[type_] = {stamp:idx for idx,stamp in enumerate(insertion_stamps)}
+		elif self._prioritized_drop_probability < 1:
+			self._insertion_time_tree[type_] = self._MinSegmentTree.from_array(list(zip(cluster_arrays['insertion_times'].tolist(), range(occupancy))), neutral_element=(float('inf'),-1)) # O(N)
+		self._mark_cluster_as_dirty(type_)
+
+	def _get_cluster_arrays(self, type_): # O(N)
+		"""Returns the per-batch state of a cluster (priorities, insertion times, etc.) as arrays."""
+		cluster_arrays = self._get_cluster_tree_arrays(type_)
+		if self._weight_importance_by_update_time:
+			cluster_arrays['update_times'] = np.array(self._update_times[type_], dtype=np.int64)
+		if self._deduplicate_observations:
+			new_obs_frames_list = self._new_obs_frames[type_]
+			cluster_arrays['new_obs_rows_count'] = np.array([-1 if x is None else len(x[0]) for x in new_obs_frames_list], dtype=np.int64) # -1 when new_obs is stored in the batch
+			new_obs_frames_list = [x for x in new_obs_frames_list if x is not None]
+			if new_obs_frames_list:
+				cluster_arrays['new_obs_rows'] = np.concatenate([rows for rows,_ in new_obs_frames_list])
+				cluster_arrays['new_obs_frames'] = np.concatenate([frames for _,frames in new_obs_frames_list])
+		return cluster_arrays
+
+	@staticmethod
+	def _iter_new_obs_frames(cluster_arrays): # O(N)
+		offset = 0
+		for rows_count in cluster_arrays['new_obs_rows_count'].tolist():
+			if rows_count < 0:
+				yield None
+				continue
+			yield (
+				cluster_arrays['new_obs_rows'][offset:offset+rows_count].copy(), 
+				cluster_arrays['new_obs_frames'][offset:offset+rows_count].copy(),
+			)
+			offset += rows_count
+
+	def save(self, directory): # O(N)
+		super().save(directory)
+		for type_ in self.type_values:
+			np.savez(os.path.join(directory, f'cluster_{type_}', 'cluster.npz'), **self._get_cluster_arrays(type_))
+
+	def _load_cluster(self, type_id, directory): # O(N)
+		"""Adds the cluster saved in directory, building its trees from the saved leaves in O(N) rather than adding its batches one by one."""
+		with np.load(os.path.join(directory, 'cluster.npz')) as cluster_file:
+			cluster_arrays = dict(cluster_file)
+		self._add_type_if_not_exist(type_id)
+		type_ = self.get_type(type_id)
+		type_batch = self.batches[type_]
+		if self._deduplicate_observations:
+			new_obs_frames_iter = self._iter_new_obs_frames(cluster_arrays)
+		for idx,batch in enumerate(load_batches(directory)):
+			batch_id = next(batch_id_counter) # new ids, so that they do not clash with those of this process
+			batch["batch_ids"] = np.full(batch.count, batch_id, dtype=np.int64)
+			nbytes = get_batch_nbytes(batch) # O(number of columns)
+			if self._deduplicate_observations:
+				new_obs_frames = next(new_obs_frames_iter)
+				if new_obs_frames is not None:
+					nbytes += sum(x.nbytes for x in new_obs_frames)
+				self._new_obs_frames[type_].append(new_obs_frames)
+			type_batch.append(batch)
+			self._batch_ids[type_].append(batch_id)
+			self._batch_nbytes[type_].append(nbytes)
+			self._cluster_nbytes[type_] += nbytes
+			self._stored_nbytes += nbytes
+			self._batch_index[batch_id] = (type_id, idx)
+		occupancy = len(type_batch)
+		self._stored_batches += occupancy
+		if occupancy > 0:
+			self._non_empty_clusters += 1
+		self._build_cluster_trees(type_, cluster_arrays) # O(N)
+		if self._weight_importance_by_update_time:
+			self._update_times[type_] = cluster_arrays['update_times'].tolist()
+
 	def stats(self, debug=False):
 		stats_dict = super().stats(debug)
 		stats_dict.update({
 			'cluster_capacity':self.get_cluster_capacity_dict(),
 			'cluster_priority': self.get_cluster_priority_dict(),
+			'cluster_nbytes': dict(zip(map(str, self.type_keys), self._cluster_nbytes)),
+			'stored_nbytes': self._stored_nbytes,
 		})
+		if self._max_clusters:
+			stats_dict['cluster_routing'] = {
+				'overflow_cluster_size': self.get_cluster_size(OVERFLOW_CLUSTER_ID) or 0,
+				'routed_batches': self._routed_batches,
+				'routed_labels': {str(k):v for k,v in self._routed_labels.items()},
+				'demoted_clusters': self._demoted_clusters,
+			}
 		return stats_dict
+
+	def reset_routing_stats(self): # O(1)
+		"""Resets the per-label counts of the batches routed to the overflow cluster, reported by stats."""
+		self._routed_labels.clear()
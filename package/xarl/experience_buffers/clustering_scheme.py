@@ -16,6 +16,18 @@ class none():
 	def get_batch_type(self, batch, episode_type='none'):
 		return ((episode_type,'none'),)
 
+	def get_config(self):
+		"""Returns the options the learned state depends on, they shall be the same when restoring it."""
+		return {'class': type(self).__name__}
+
+	def get_state(self):
+		"""Returns what the scheme learned from the labelled batches, e.g. to save it along with a replay buffer."""
+		return {'config': self.get_config()}
+
+	def set_state(self, state):
+		"""Restores the state returned by get_state."""
+		assert state['config'] == self.get_config(), f"The clustering scheme was saved with options {state['config']}, but its options are {self.get_config()}."
+
 class positive_H(none):
 	def get_episode_type(self, episode):
 		episode_extrinsic_reward = sum((np.sum(batch["rewards"]) for batch in episode))
@@ -47,6 +59,27 @@ class H(none):
 	def get_batch_type(self, batch, episode_type='none'):
 		return ((episode_type, self.get_H(batch)),)
 
+	def get_config(self):
+		config = super().get_config()
+		config.update({
+			'episode_window_size': self.episode_stats.window_size,
+			'batch_window_size': self.batch_stats.window_size,
+		})
+		return config
+
+	def get_state(self):
+		state = super().get_state()
+		state.update({
+			'episode_stats': self.episode_stats,
+			'batch_stats': self.batch_stats,
+		})
+		return state
+
+	def set_state(self, state):
+		super().set_state(state)
+		self.episode_stats = state['episode_stats']
+		self.batch_stats = state['batch_stats']
+
 class W(H):
 	def __init__(self, episode_window_size=2**6, batch_window_size=2**8, n_clusters=8, **args):
 		super().__init__(episode_window_size, batch_window_size)
@@ -74,6 +107,24 @@ class W(H):
 		explanation_iter = map(lambda x:(episode_type, x), explanation_iter)
 		return tuple(explanation_iter)
 
+	def get_config(self):
+		config = super().get_config()
+		config['n_clusters'] = self.n_clusters
+		return config
+
+	def get_state(self):
+		state = super().get_state()
+		state.update({
+			'clusterer': self.clusterer,
+			'explanation_vector_labels': self.explanation_vector_labels,
+		})
+		return state
+
+	def set_state(self, state):
+		super().set_state(state)
+		self.clusterer = state['clusterer']
+		self.explanation_vector_labels = state['explanation_vector_labels']
+
 	# def get_batch_type(self, batch, episode_type='none'):
 	# 	explanation_iter = map(lambda x: x.get("explanation",'None'), batch["infos"])
 	# 	explanation_iter = map(lambda x: x if isinstance(x,(list,tuple)) else [x], explanation_iter)
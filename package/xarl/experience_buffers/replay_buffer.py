@@ -1,20 +1,24 @@
 import collections
 import logging
 import numpy as np
+import os
+import pickle
 import platform
 from more_itertools import unique_everseen
 from itertools import islice
 import copy
 import threading 
+import time
+from contextlib import contextmanager
 import random
 
 # Import ray before psutil will make sure we use psutil's bundled version
 import ray  # noqa F401
 import psutil  # noqa E402
 
-from xarl.experience_buffers.buffer.pseudo_prioritized_buffer import PseudoPrioritizedBuffer, get_batch_infos, get_batch_indexes, get_batch_uid
-from xarl.experience_buffers.buffer.buffer import Buffer
-from xarl.utils import ReadWriteLock
+from xarl.experience_buffers.buffer.pseudo_prioritized_buffer import PseudoPrioritizedBuffer, get_batch_infos
+from xarl.experience_buffers.buffer.buffer import Buffer, get_batch_id
+from xarl.utils.read_write_lock import LightReadWriteLock
 
 from ray.rllib.policy.sample_batch import SampleBatch, MultiAgentBatch, DEFAULT_POLICY_ID
 from ray.util.iter import ParallelIteratorWorker
@@ -24,10 +28,10 @@ logger = logging.getLogger(__name__)
 
 def apply_to_batch_once(fn, batch_list):
 	updated_batch_dict = {
-		get_batch_uid(x): fn(x) 
-		for x in unique_everseen(batch_list, key=get_batch_uid)
+		get_batch_id(x): fn(x) 
+		for x in unique_everseen(batch_list, key=get_batch_id)
 	}
-	return list(map(lambda x: updated_batch_dict[get_batch_uid(x)], batch_list))
+	return list(map(lambda x: updated_batch_dict[get_batch_id(x)], batch_list))
 
 class SimpleReplayBuffer:
 	"""Simple replay buffer that operates over batches."""
@@ -71,15 +75,18 @@ class LocalReplayBuffer(ParallelIteratorWorker):
 		seed=None,
 		cluster_selection_policy='random_uniform',
 		ratio_of_samples_from_unclustered_buffer=0,
+		clustering_scheme=None,
 	):
 		self.prioritized_replay = prioritized_replay
 		self.buffer_options = {} if not buffer_options else buffer_options
-		dummy_buffer = PseudoPrioritizedBuffer(**self.buffer_options)
+		dummy_buffer = PseudoPrioritizedBuffer(**self.buffer_options) if self.prioritized_replay else Buffer(**self.buffer_options)
 		self.buffer_size = dummy_buffer.global_size
 		self.is_weighting_expected_values = dummy_buffer.is_weighting_expected_values()
 		self.replay_starts = learning_starts
-		self._buffer_lock = ReadWriteLock()
+		self._cached_priorities_versions = {} # The version of every buffer lock when the cached priorities of its buffer were last refreshed
+		self._buffer_locks = {} # One lock per buffer (i.e. per policy, and per kind of buffer), so that different buffers never wait for each other. Samplers share it, after refreshing the cached priorities under the write lock
 		self._cluster_selection_policy = cluster_selection_policy
+		self.clustering_scheme = clustering_scheme # The scheme labelling the added batches, saved along with the buffers
 		
 		random.seed(seed)
 		np.random.seed(seed)
@@ -105,57 +112,107 @@ class LocalReplayBuffer(ParallelIteratorWorker):
 			batch = MultiAgentBatch({DEFAULT_POLICY_ID: batch}, batch.count)
 		self.num_added += len(batch.policy_batches)
 		with self.add_batch_timer:
-			self._buffer_lock.acquire_write()
 			for policy_id, sub_batch in batch.policy_batches.items():
 				batch_type = get_batch_infos(sub_batch)["batch_type"]
-				####################################
-				if not isinstance(batch_type,(tuple,list)):
-					sub_type_list = (batch_type,)
-				elif len(batch_type) == 1:
-					sub_type_list = (batch_type[0],)
-				elif self._cluster_selection_policy == 'random_uniform_after_filling':
-					sub_type_list = tuple(filter(lambda x: not self.replay_buffers[policy_id].is_valid_cluster(x), batch_type))
-					if len(sub_type_list) == 0:
+				with self._get_buffer_lock(self.replay_buffers, policy_id).writing():
+					####################################
+					if not isinstance(batch_type,(tuple,list)):
+						sub_type_list = (batch_type,)
+					elif len(batch_type) == 1:
+						sub_type_list = (batch_type[0],)
+					elif self._cluster_selection_policy == 'random_uniform_after_filling':
+						sub_type_list = tuple(filter(lambda x: not self.replay_buffers[policy_id].is_valid_cluster(x), batch_type))
+						if len(sub_type_list) == 0:
+							sub_type_list = (random.choice(batch_type),)
+					elif self._cluster_selection_policy == 'random_uniform':
+						# # If has_multiple_types is True: no need for duplicating the batch across multiple clusters unless they are invalid, just insert into one of them, randomly. It is a prioritised buffer, clusters will be fairly represented, with minimum overhead.
 						sub_type_list = (random.choice(batch_type),)
-				elif self._cluster_selection_policy == 'random_uniform':
-					# # If has_multiple_types is True: no need for duplicating the batch across multiple clusters unless they are invalid, just insert into one of them, randomly. It is a prioritised buffer, clusters will be fairly represented, with minimum overhead.
-					sub_type_list = (random.choice(batch_type),)
-				elif self._cluster_selection_policy == 'random_max':
-					cluster_cumsum = np.cumsum(list(map(lambda x: self.replay_buffers[policy_id].get_cluster_size(x)+1, batch_type)))
-					cluster_mass = random.random() * cluster_cumsum[-1] # O(1)
-					batch_type_idx,_ = next(filter(lambda x: x[-1] >= cluster_mass, enumerate(cluster_cumsum))) # O(|self.type_keys|)
-					sub_type_list = (batch_type[batch_type_idx],)
-				elif self._cluster_selection_policy == 'max':
-					sub_type_list = (max(
-						batch_type, 
-						key=lambda x: (self.replay_buffers[policy_id].get_cluster_size(x),random.random())
-					),)
-				elif self._cluster_selection_policy == 'min':
-					sub_type_list = (min(
-						batch_type, 
-						key=lambda x: (self.replay_buffers[policy_id].get_cluster_size(x),random.random())
-					),)
-				else: #if self._cluster_selection_policy == 'none':
-					sub_type_list = batch_type
-				####################################
-				for sub_type in sub_type_list: 
-					# Make a deep copy so the replay buffer doesn't pin plasma memory.
-					sub_batch = sub_batch.copy()
-					# Make a deep copy of infos so that for every sub_type the infos dictionary is different
-					sub_batch['infos'] = copy.deepcopy(sub_batch['infos'])
-					self.replay_buffers[policy_id].add(batch=sub_batch, type_id=sub_type, update_prioritisation_weights=update_prioritisation_weights)
-					if self.buffer_of_recent_elements is not None:
+					elif self._cluster_selection_policy == 'random_max':
+						cluster_cumsum = np.cumsum(list(map(lambda x: self.replay_buffers[policy_id].get_cluster_size(x)+1, batch_type)))
+						cluster_mass = random.random() * cluster_cumsum[-1] # O(1)
+						batch_type_idx,_ = next(filter(lambda x: x[-1] >= cluster_mass, enumerate(cluster_cumsum))) # O(|self.type_keys|)
+						sub_type_list = (batch_type[batch_type_idx],)
+					elif self._cluster_selection_policy == 'max':
+						sub_type_list = (max(
+							batch_type, 
+							key=lambda x: (self.replay_buffers[policy_id].get_cluster_size(x),random.random())
+						),)
+					elif self._cluster_selection_policy == 'min':
+						sub_type_list = (min(
+							batch_type, 
+							key=lambda x: (self.replay_buffers[policy_id].get_cluster_size(x),random.random())
+						),)
+					else: #if self._cluster_selection_policy == 'none':
+						sub_type_list = batch_type
+					####################################
+					for sub_type in sub_type_list: 
 						# Make a deep copy so the replay buffer doesn't pin plasma memory.
 						sub_batch = sub_batch.copy()
 						# Make a deep copy of infos so that for every sub_type the infos dictionary is different
 						sub_batch['infos'] = copy.deepcopy(sub_batch['infos'])
-						self.buffer_of_recent_elements[policy_id].add(batch=sub_batch, update_prioritisation_weights=update_prioritisation_weights)
-			self._buffer_lock.release_write()
+						self.replay_buffers[policy_id].add(batch=sub_batch, type_id=sub_type, update_prioritisation_weights=update_prioritisation_weights)
+						if self.buffer_of_recent_elements is not None:
+							# Make a deep copy so the replay buffer doesn't pin plasma memory.
+							sub_batch = sub_batch.copy()
+							# Make a deep copy of infos so that for every sub_type the infos dictionary is different
+							sub_batch['infos'] = copy.deepcopy(sub_batch['infos'])
+							with self._get_buffer_lock(self.buffer_of_recent_elements, policy_id).writing():
+								self.buffer_of_recent_elements[policy_id].add(batch=sub_batch, update_prioritisation_weights=update_prioritisation_weights)
 		return batch
 
+	def _get_buffer_lock(self, buffers, policy_id): # O(1)
+		"""Returns the lock of buffers[policy_id]. Locks are always taken in the same order (the main buffer before the one of recent elements), to avoid deadlocks."""
+		key = (buffers is self.buffer_of_recent_elements, policy_id)
+		buffer_lock = self._buffer_locks.get(key, None)
+		if buffer_lock is None: # setdefault is atomic, so threads asking for a new lock at the same time get the same one
+			buffer_lock = self._buffer_locks.setdefault(key, LightReadWriteLock())
+		return buffer_lock
+
+	@contextmanager
+	def _get_policy_write_locks(self, policy_id):
+		"""Holds the write locks of all the buffers of policy_id, in the same order as add_batch."""
+		with self._get_buffer_lock(self.replay_buffers, policy_id).writing():
+			if self.buffer_of_recent_elements is None:
+				yield
+				return
+			with self._get_buffer_lock(self.buffer_of_recent_elements, policy_id).writing():
+				yield
+
+	@contextmanager
+	def _get_sampling_lock(self, buffers, policy_id):
+		"""Holds the read lock of buffers[policy_id], after refreshing the cached priorities of the buffer if it was written since their last refresh. 
+		Sampling with recompute_priorities=False only reads the buffer, so that many threads can sample at once."""
+		buffer_lock = self._get_buffer_lock(buffers, policy_id)
+		buffer_lock.acquire_read()
+		if self._cached_priorities_versions.get(buffer_lock, None) != buffer_lock.version:
+			buffer_lock.release_read()
+			buffer_lock.acquire_write()
+			try:
+				if self._cached_priorities_versions.get(buffer_lock, None) != buffer_lock.version-1 and not buffers[policy_id].is_empty(): # unless another thread refreshed them just before this write lock
+					buffers[policy_id].cache_priorities()
+				self._cached_priorities_versions[buffer_lock] = buffer_lock.version
+			except:
+				buffer_lock.release_write()
+				raise
+			buffer_lock.downgrade() # no writer can get in between
+		try:
+			yield
+		finally:
+			buffer_lock.release_read()
+
 	def can_replay(self):
 		return self.num_added >= self.replay_starts
 
+	def get_priority_mass(self):
+		"""Returns the sum of the priority masses (see PseudoPrioritizedBuffer.get_priority_mass) of the buffers of every policy, and how many batches they hold."""
+		priority_mass = 0
+		batch_count = 0
+		for policy_id, replay_buffer in list(self.replay_buffers.items()):
+			with self._get_buffer_lock(self.replay_buffers, policy_id).writing():
+				priority_mass += replay_buffer.get_priority_mass()
+				batch_count += replay_buffer.count()
+		return priority_mass, batch_count
+
 	def replay(self, batch_count=1, cluster_overview_size=None, update_replayed_fn=None):
 		output_batches = []
 		if self.buffer_of_recent_elements is not None:
@@ -191,46 +248,114 @@ class LocalReplayBuffer(ParallelIteratorWorker):
 		else:
 			cluster_overview_size = min(cluster_overview_size,batch_count)
 
-		with self.replay_timer:
-			batch_list = [{} for _ in range(batch_count)]
-			for policy_id, replay_buffer in buffer_list.items():
-				if replay_buffer.is_empty():
-					continue
-				# batch_iter = replay_buffer.sample(batch_count)
-				batch_size_list = [cluster_overview_size]*(batch_count//cluster_overview_size)
-				if batch_count%cluster_overview_size > 0:
-					batch_size_list.append(batch_count%cluster_overview_size)
-				self._buffer_lock.acquire_read()
-				batch_iter = []
-				for i,n in enumerate(batch_size_list):
-					batch_iter += replay_buffer.sample(n,recompute_priorities=i==0)
-				self._buffer_lock.release_read()
-				if update_replayed_fn:
-					self._buffer_lock.acquire_write()
+		start_time = time.time()
+		batch_list = [{} for _ in range(batch_count)]
+		for policy_id, replay_buffer in list(buffer_list.items()): # a copy, other threads may add policies
+			# batch_iter = replay_buffer.sample(batch_count)
+			batch_size_list = [cluster_overview_size]*(batch_count//cluster_overview_size)
+			if batch_count%cluster_overview_size > 0:
+				batch_size_list.append(batch_count%cluster_overview_size)
+			if update_replayed_fn: # it changes the replayed batches, that may be the stored ones, and updates the priorities of the main buffer and of the one of recent elements
+				with self._get_policy_write_locks(policy_id):
+					if replay_buffer.is_empty():
+						continue
+					batch_iter = []
+					for i,n in enumerate(batch_size_list):
+						batch_iter += replay_buffer.sample(n,recompute_priorities=i==0)
 					batch_iter = apply_to_batch_once(update_replayed_fn, batch_iter)
-					self._buffer_lock.release_write()
-				for i,batch in enumerate(batch_iter):
-					batch_list[i][policy_id] = batch
+			else:
+				with self._get_sampling_lock(buffer_list, policy_id):
+					if replay_buffer.is_empty():
+						continue
+					batch_iter = []
+					for n in batch_size_list:
+						batch_iter += replay_buffer.sample(n,recompute_priorities=False)
+			for i,batch in enumerate(batch_iter):
+				batch_list[i][policy_id] = batch
+		self.replay_timer.push(time.time()-start_time) # not timed with a with-block, replays of different threads can overlap
 		return (
 			MultiAgentBatch(samples, max(map(lambda x:x.count, samples.values())))
 			for samples in batch_list
 		)
 
 	def increase_train_steps(self, t=1):
-		for replay_buffer in self.replay_buffers.values():
+		for replay_buffer in list(self.replay_buffers.values()):
 			replay_buffer.increase_steps(t)
 
 	def update_priorities(self, prio_dict):
 		if not self.prioritized_replay:
 			return
-		with self.update_priorities_timer:
-			self._buffer_lock.acquire_write()
-			for policy_id, new_batch in prio_dict.items():
-				for type_id,batch_index in get_batch_indexes(new_batch).items():
-					self.replay_buffers[policy_id].update_priority(new_batch, batch_index, type_id)
-					if self.buffer_of_recent_elements is not None:
-						self.buffer_of_recent_elements[policy_id].update_priority(new_batch, batch_index)
-			self._buffer_lock.release_write()
+		start_time = time.time()
+		for policy_id, new_batch in prio_dict.items():
+			with self._get_buffer_lock(self.replay_buffers, policy_id).writing():
+				self.replay_buffers[policy_id].update_priority(new_batch)
+			if self.buffer_of_recent_elements is not None:
+				with self._get_buffer_lock(self.buffer_of_recent_elements, policy_id).writing():
+					self.buffer_of_recent_elements[policy_id].update_priority(new_batch)
+		self.update_priorities_timer.push(time.time()-start_time) # not timed with a with-block, updates of different threads can overlap
+
+	def update_train_batch_priorities(self, prio_dict):
+		"""Same as update_priorities, but every batch in prio_dict can be a whole train batch, i.e. a concatenation of replayed batches.
+		Replayed batches are told apart by their batch_ids column, their priorities are aggregated and written to the buffers in bulk."""
+		if not self.prioritized_replay:
+			return
+		start_time = time.time()
+		for policy_id, train_batch in prio_dict.items():
+			if 'batch_ids' not in train_batch:
+				continue
+			row_batch_ids = np.asarray(train_batch['batch_ids'])
+			if len(row_batch_ids) == 0:
+				continue
+			buffers_list = [self.replay_buffers]
+			if self.buffer_of_recent_elements is not None:
+				buffers_list.append(self.buffer_of_recent_elements)
+			for buffers in buffers_list:
+				with self._get_buffer_lock(buffers, policy_id).writing():
+					replay_buffer = buffers[policy_id]
+					batch_starts = replay_buffer.get_batch_starts(row_batch_ids) # O(n)
+					batch_priorities = replay_buffer.aggregate_priorities(train_batch[self.buffer_options['priority_id']], batch_starts)
+					replay_buffer.update_priorities(batch_priorities, row_batch_ids[batch_starts])
+		self.update_priorities_timer.push(time.time()-start_time) # not timed with a with-block, updates of different threads can overlap
+
+	def save(self, directory): # O(N)
+		"""Saves the buffers of every policy and the clustering scheme in directory, so that they can be restored with load after a restart."""
+		os.makedirs(directory, exist_ok=True)
+		buffer_dict = {'replay_buffers': self.replay_buffers}
+		if self.buffer_of_recent_elements is not None:
+			buffer_dict['buffer_of_recent_elements'] = self.buffer_of_recent_elements
+		policy_dict = {}
+		for buffer_name, buffers in buffer_dict.items():
+			policy_dict[buffer_name] = list(buffers.keys())
+			for i, policy_id in enumerate(policy_dict[buffer_name]):
+				with self._get_buffer_lock(buffers, policy_id).writing():
+					buffers[policy_id].save(os.path.join(directory, f'{buffer_name}_{i}'))
+		with open(os.path.join(directory, 'local_replay_buffer.pkl'), 'wb') as f:
+			pickle.dump({
+				'policy_dict': policy_dict,
+				'num_added': self.num_added,
+				'clustering_scheme': self.clustering_scheme.get_state() if self.clustering_scheme is not None else None,
+			}, f)
+
+	def load(self, directory): # O(N)
+		"""Replaces the buffers of every policy and the state of the clustering scheme with the ones saved in directory by save. 
+		It is meant to be called before training, while no other thread is using the buffers."""
+		with open(os.path.join(directory, 'local_replay_buffer.pkl'), 'rb') as f:
+			state = pickle.load(f)
+		buffer_dict = {'replay_buffers': self.replay_buffers}
+		if self.buffer_of_recent_elements is not None:
+			buffer_dict['buffer_of_recent_elements'] = self.buffer_of_recent_elements
+		loaded_buffer_dict = {}
+		for buffer_name, buffers in buffer_dict.items(): # load into new buffers, so that nothing is replaced if their options differ from the saved ones
+			loaded_buffer_dict[buffer_name] = {}
+			for i, policy_id in enumerate(state['policy_dict'].get(buffer_name, [])):
+				loaded_buffer_dict[buffer_name][policy_id] = buffers.default_factory()
+				loaded_buffer_dict[buffer_name][policy_id].load(os.path.join(directory, f'{buffer_name}_{i}'))
+		if self.clustering_scheme is not None and state['clustering_scheme'] is not None:
+			self.clustering_scheme.set_state(state['clustering_scheme']) # restored in place, it is shared with the execution plan
+		for buffer_name, buffers in buffer_dict.items():
+			buffers.clear()
+			buffers.update(loaded_buffer_dict[buffer_name])
+		self.num_added = state['num_added']
 
 	def stats(self, debug=False):
 		stat = {
@@ -238,8 +363,9 @@ class LocalReplayBuffer(ParallelIteratorWorker):
 			"replay_time_ms": round(1000 * self.replay_timer.mean, 3),
 			"update_priorities_time_ms": round(1000 * self.update_priorities_timer.mean, 3),
 		}
-		for policy_id, replay_buffer in self.replay_buffers.items():
-			stat.update({
-				policy_id: replay_buffer.stats(debug=debug)
-			})
+		for policy_id, replay_buffer in list(self.replay_buffers.items()):
+			with self._get_buffer_lock(self.replay_buffers, policy_id).writing():
+				stat.update({
+					policy_id: replay_buffer.stats(debug=debug)
+				})
 		return stat
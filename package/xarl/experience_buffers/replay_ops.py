@@ -1,5 +1,9 @@
 from typing import List
+import logging
 import random
+import threading
+import queue
+import time
 import numpy as np
 from more_itertools import unique_everseen
 
@@ -7,12 +11,17 @@ from ray.util.iter import LocalIterator, _NextValueNotReady
 from ray.util.iter_metrics import SharedMetrics
 from ray.rllib.utils.typing import SampleBatchType
 from ray.rllib.policy.sample_batch import SampleBatch, MultiAgentBatch, DEFAULT_POLICY_ID
+from ray.rllib.policy.policy import LEARNER_STATS_KEY
+from ray.rllib.execution.common import SAMPLE_TIMER, _get_shared_metrics
 from ray.rllib.execution.learner_thread import LearnerThread, get_learner_stats
 from ray.rllib.execution.multi_gpu_learner import TFMultiGPULearner, get_learner_stats as get_gpu_learner_stats
 
 from xarl.experience_buffers.replay_buffer import SimpleReplayBuffer, LocalReplayBuffer, get_batch_infos
+from xarl.experience_buffers.sharded_replay_buffer import ShardedReplayBuffer
 from xarl.experience_buffers.clustering_scheme import *
 
+logger = logging.getLogger(__name__)
+
 def get_clustered_replay_buffer(config):
 	assert config["batch_mode"] == "complete_episodes" or not config["cluster_with_episode_type"], f"This algorithm requires 'complete_episodes' as batch_mode when 'cluster_with_episode_type' is True"
 	clustering_scheme_type = config.get("clustering_scheme", None)
@@ -20,15 +29,20 @@ def get_clustered_replay_buffer(config):
 		clustering_scheme_type = 'none'
 	# no need for unclustered_buffer if clustering_scheme_type is none
 	ratio_of_samples_from_unclustered_buffer = config["ratio_of_samples_from_unclustered_buffer"] if clustering_scheme_type != 'none' else 0
-	local_replay_buffer = LocalReplayBuffer(
+	clustering_scheme = eval(clustering_scheme_type)(**config["clustering_scheme_options"])
+	replay_buffer_args = dict(
 		prioritized_replay=config["prioritized_replay"],
 		buffer_options=config["buffer_options"], 
 		learning_starts=config["learning_starts"], 
 		seed=config["seed"],
 		cluster_selection_policy=config["cluster_selection_policy"],
 		ratio_of_samples_from_unclustered_buffer=ratio_of_samples_from_unclustered_buffer,
+		clustering_scheme=clustering_scheme,
 	)
-	clustering_scheme = eval(clustering_scheme_type)(**config["clustering_scheme_options"])
+	if config["replay_buffer_num_shards"] > 1:
+		local_replay_buffer = ShardedReplayBuffer(num_shards=config["replay_buffer_num_shards"], **replay_buffer_args)
+	else:
+		local_replay_buffer = LocalReplayBuffer(**replay_buffer_args)
 	return local_replay_buffer, clustering_scheme
 
 def assign_types(batch, clustering_scheme, batch_fragment_length, with_episode_type=True):
@@ -63,6 +77,9 @@ def assign_types(batch, clustering_scheme, batch_fragment_length, with_episode_t
 	return batch_list
 
 def get_update_replayed_batch_fn(local_replay_buffer, local_worker, postprocess_trajectory_fn):
+	copying_options = [k for k in ('columnar_storage', 'memmap_directory', 'deduplicate_observations') if local_replay_buffer.buffer_options.get(k, None)]
+	if copying_options: # the replayed batches are copies of the stored ones
+		logger.warning(f'With {copying_options} in buffer_options, the columns that {postprocess_trajectory_fn.__name__} changes in a replayed batch (e.g. the advantages) go into the train batch, but they are not written back to the replay buffer.')
 	def update_replayed_fn(samples):
 		if isinstance(samples, MultiAgentBatch):
 			for pid, batch in samples.policy_batches.items():
@@ -95,6 +112,24 @@ def clean_batch(batch, keys_to_keep=None, keep_only_keys_to_keep=False):
 				del batch.data[k]
 	return batch
 
+def get_update_train_batch_priorities_fn(local_replay_buffer, config):
+	def update_priorities(item):
+		local_replay_buffer.increase_train_steps()
+		samples, info_dict = item
+		if not config.get("prioritized_replay"):
+			return info_dict
+		priority_id = config["buffer_options"]["priority_id"]
+		samples = clean_batch(samples, keys_to_keep=[priority_id,'infos','batch_ids'], keep_only_keys_to_keep=True)
+		if priority_id == "td_errors":
+			for policy_id, info in info_dict.items():
+				td_errors = info.get("td_error", info[LEARNER_STATS_KEY].get("td_error"))
+				# samples.policy_batches[policy_id].set_get_interceptor(None)
+				samples.policy_batches[policy_id]["td_errors"] = td_errors
+		# The train-batch is a concatenation of replay-batches, their priorities are aggregated and updated in bulk
+		local_replay_buffer.update_train_batch_priorities(samples.policy_batches)
+		return info_dict
+	return update_priorities
+
 def add_buffer_metrics(results, buffer):
 	results['buffer']=buffer.stats()
 	return results
@@ -121,6 +156,117 @@ def Replay(local_buffer, replay_batch_size=1, cluster_overview_size=None, update
 				yield batch_list
 	return LocalIterator(gen_replay, SharedMetrics())
 
+class ReplayPrefetcher:
+	"""Builds the next train batches from a replay buffer on a background thread, while the learner trains on the current one.
+	At most prefetch_size+1 train batches are in flight (the one being trained on and the prefetched ones), so a train batch is always sampled before the priorities of at most prefetch_size previous train batches are updated.
+	The thread runs from start to stop (e.g. when the trainer stops, or before loading the buffer), stop drops the prefetched train batches and the prefetcher can be started again."""
+
+	def __init__(self, local_buffer, replay_batch_size=1, cluster_overview_size=None, build_train_batch_fn=None, prefetch_size=1, update_replayed_fn=None):
+		self.local_buffer = local_buffer
+		self.replay_batch_size = replay_batch_size
+		self.cluster_overview_size = cluster_overview_size
+		self.build_train_batch_fn = build_train_batch_fn or SampleBatch.concat_samples # called on the background thread, it shall be thread-safe
+		self.prefetch_size = prefetch_size
+		self.update_replayed_fn = update_replayed_fn # called on the background thread
+		self.thread = None
+		self.stop_event = None
+		self.outqueue = None
+		self.in_flight = None
+
+	def is_running(self):
+		return self.thread is not None
+
+	def start(self):
+		if self.is_running():
+			return
+		# Every run has its own stop event, queue and tokens, so that a stopped thread and the train batches it built do not affect the next run
+		self.stop_event = threading.Event()
+		self.outqueue = queue.Queue()
+		self.in_flight = threading.Semaphore(self.prefetch_size+1) # One token per train batch that is built, or whose priorities are not updated yet
+		self.thread = threading.Thread(target=self.run, args=(self.stop_event, self.outqueue, self.in_flight), daemon=True)
+		self.thread.start()
+
+	def stop(self, timeout=None):
+		"""Stops the thread and waits for it, for at most timeout seconds."""
+		if not self.is_running():
+			return
+		self.stop_event.set()
+		self.in_flight.release() # wake the thread up, if it is waiting for a token
+		self.thread.join(timeout)
+		self.outqueue.put((None, None)) # wake the consumer up, if it is waiting for a train batch
+		self.thread = None
+
+	def run(self, stop_event, outqueue, in_flight):
+		while True:
+			in_flight.acquire()
+			if stop_event.is_set():
+				return
+			try:
+				start_time = time.perf_counter()
+				batch_list = self.local_buffer.replay(
+					batch_count=self.replay_batch_size, 
+					cluster_overview_size=self.cluster_overview_size,
+					update_replayed_fn=self.update_replayed_fn,
+				)
+				train_batch = self.build_train_batch_fn(batch_list) if batch_list else None
+				outqueue.put((train_batch, time.perf_counter()-start_time))
+			except Exception as e: # raised again by the consumer
+				outqueue.put((e, None))
+				return
+
+def PrefetchReplay(prefetcher):
+	"""Same as Replay followed by ConcatBatches and build_train_batch_fn, but the next prefetch_size train batches are built by a ReplayPrefetcher, while the current one goes through the rest of the execution plan.
+	The prefetcher is started as soon as its buffer can replay, and again after being stopped or after its thread has raised an exception.
+	The prefetched train batches are counted in the 'replay_prefetch_queue_size' info, and the time spent waiting for them in the 'replay_prefetch_wait' timer."""
+	def gen_replay(_):
+		while True:
+			if not prefetcher.is_running():
+				if not prefetcher.local_buffer.can_replay(): # do not spin until learning starts
+					yield _NextValueNotReady()
+					continue
+				prefetcher.start()
+			outqueue = prefetcher.outqueue
+			in_flight = prefetcher.in_flight # the tokens of this run, the prefetcher may be restarted before the train batch is done
+			queue_size = outqueue.qsize()
+			wait_start_time = time.perf_counter()
+			train_batch, build_time = outqueue.get()
+			if isinstance(train_batch, Exception): # the thread has returned, stop the prefetcher so that it is started again by the next replay
+				prefetcher.stop()
+				raise train_batch
+			if train_batch is None:
+				in_flight.release()
+				yield _NextValueNotReady()
+				continue
+			yield train_batch, build_time, time.perf_counter()-wait_start_time, queue_size
+			in_flight.release() # the rest of the execution plan, including the priority update, is done with it
+	def update_metrics(item): # the metrics are reachable only from the functions applied to the iterator
+		train_batch, build_time, wait_time, queue_size = item
+		metrics = _get_shared_metrics()
+		metrics.info["replay_prefetch_queue_size"] = queue_size
+		metrics.timers["replay_prefetch_wait"].push(wait_time)
+		sample_timer = metrics.timers[SAMPLE_TIMER]
+		sample_timer.push(build_time)
+		sample_timer.push_units_processed(train_batch.count)
+		return train_batch
+	return LocalIterator(gen_replay, SharedMetrics()).for_each(update_metrics)
+
+class ReplayPrefetcherMixin:
+	"""Trainer mixin stopping the ReplayPrefetcher of the execution plan, if any, when the trainer stops or restores a checkpoint.
+	The execution plan shall set it as the replay_prefetcher attribute of the local worker."""
+
+	def stop_replay_prefetcher(self):
+		prefetcher = getattr(self.workers.local_worker(), 'replay_prefetcher', None) if hasattr(self, 'workers') else None
+		if prefetcher is not None:
+			prefetcher.stop()
+
+	def cleanup(self):
+		self.stop_replay_prefetcher()
+		super().cleanup()
+
+	def load_checkpoint(self, checkpoint_path):
+		self.stop_replay_prefetcher() # the prefetched train batches were sampled with the replaced weights, and from the buffer that is going to be replaced
+		super().load_checkpoint(checkpoint_path)
+
 class MixInReplay:
 	"""This operator adds replay to a stream of experiences.
 
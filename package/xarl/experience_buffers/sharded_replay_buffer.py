@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+import copy
+import inspect
+import numpy as np
+import os
+import pickle
+from more_itertools import unique_everseen
+
+import ray
+from ray.rllib.policy.sample_batch import SampleBatch, MultiAgentBatch, DEFAULT_POLICY_ID
+from ray.rllib.utils.timer import TimerStat
+
+from xarl.experience_buffers.buffer.pseudo_prioritized_buffer import PseudoPrioritizedBuffer
+from xarl.experience_buffers.buffer.buffer import Buffer, get_batch_id
+from xarl.experience_buffers.replay_buffer import LocalReplayBuffer, apply_to_batch_once
+
+class ReplayShard(LocalReplayBuffer):
+	"""A LocalReplayBuffer living in a Ray actor. 
+	The results of add_batch and replay carry the priority state of the shard (see get_priority_state), so that the caller does not have to ask for it."""
+
+	def __init__(self, shard_index=0, **args):
+		super().__init__(**args)
+		self.shard_index = shard_index
+		self._priority_state_stamp = 0
+
+	def get_priority_state(self):
+		"""Returns the priority mass of the shard (see LocalReplayBuffer.get_priority_mass), how many batches it holds, and the lowest transition probability of the buffer of every policy (see PseudoPrioritizedBuffer.get_min_probability).
+		The state is stamped with an increasing number, the calls to an actor being executed in order the most recent state is the one with the highest stamp."""
+		self._priority_state_stamp += 1
+		priority_mass, batch_count = self.get_priority_mass()
+		min_probability_dict = {}
+		if self.prioritized_replay:
+			for policy_id, replay_buffer in list(self.replay_buffers.items()):
+				with self._get_buffer_lock(self.replay_buffers, policy_id).writing():
+					min_probability = replay_buffer.get_min_probability()
+				if min_probability is not None:
+					min_probability_dict[policy_id] = min_probability
+		return {
+			'shard_index': self.shard_index,
+			'stamp': self._priority_state_stamp,
+			'priority_mass': priority_mass,
+			'batch_count': batch_count,
+			'min_probability': min_probability_dict,
+		}
+
+	def add_batch(self, batch, update_prioritisation_weights=False):
+		super().add_batch(batch, update_prioritisation_weights=update_prioritisation_weights) # do not return the batch, it would be sent back to the caller
+		return self.get_priority_state()
+
+	def replay(self, batch_count=1, cluster_overview_size=None, update_replayed_fn=None):
+		batch_list = list(super().replay(batch_count=batch_count, cluster_overview_size=cluster_overview_size, update_replayed_fn=update_replayed_fn))
+		return batch_list, self.get_priority_state()
+
+ReplayActor = ray.remote(num_cpus=0)(ReplayShard)
+
+class ShardedReplayBuffer:
+	"""A replay buffer split into num_shards LocalReplayBuffer actors (possibly on different nodes), with the same interface of LocalReplayBuffer.
+
+	Added batches are routed to a shard by the hash of their episode id, and the shards store them in parallel, asynchronously.
+	Every replay request is split among the shards proportionally to their priority mass (see PseudoPrioritizedBuffer.get_priority_mass), and the shards sample in parallel.
+	The priority masses are those sent back by the shards along with the results of the last add_batch and replay calls, replay waits for them only until every shard has sent one.
+	The importance weights of the replayed batches are normalised by the lowest transition probability among all the shards, as in a single buffer.
+	The ids of the replayed batches encode their shard, so that priority updates are routed back to it.
+	It works also with ray.init(local_mode=True), where the actors live in the driver process."""
+
+	def __init__(self,
+		num_shards=2,
+		prioritized_replay=True,
+		buffer_options=None,
+		learning_starts=1000,
+		seed=None,
+		cluster_selection_policy='random_uniform',
+		ratio_of_samples_from_unclustered_buffer=0,
+		clustering_scheme=None,
+		max_pending_adds_per_shard=16,
+	):
+		assert num_shards > 0, 'num_shards shall be greater than 0.'
+		self.num_shards = num_shards
+		self.prioritized_replay = prioritized_replay
+		self.buffer_options = {} if not buffer_options else buffer_options
+		buffer_class = PseudoPrioritizedBuffer if prioritized_replay else Buffer # the class of the shards' buffers
+		self.buffer_size = self.buffer_options.get('global_size', inspect.signature(buffer_class).parameters['global_size'].default)
+		self.prioritization_importance_beta = self.buffer_options.get('prioritization_importance_beta', inspect.signature(buffer_class).parameters['prioritization_importance_beta'].default) if prioritized_replay else 0
+		self.replay_starts = learning_starts
+		self.clustering_scheme = clustering_scheme # The scheme labelling the added batches runs in the driver, it is saved along with the shards
+		self._max_pending_adds = max_pending_adds_per_shard*num_shards
+
+		# Every shard holds an equal share of the buffer
+		shard_buffer_options = dict(self.buffer_options)
+		if self.buffer_size:
+			shard_buffer_options['global_size'] = int(np.ceil(self.buffer_size/num_shards))
+		if shard_buffer_options.get('max_bytes', None):
+			shard_buffer_options['max_bytes'] = int(np.ceil(shard_buffer_options['max_bytes']/num_shards))
+		self.shards = [
+			ReplayActor.remote(
+				shard_index=i,
+				prioritized_replay=prioritized_replay,
+				buffer_options=shard_buffer_options,
+				learning_starts=0, # the driver decides when to start replaying, counting the batches added to all the shards
+				seed=seed+i if seed is not None else None,
+				cluster_selection_policy=cluster_selection_policy,
+				ratio_of_samples_from_unclustered_buffer=ratio_of_samples_from_unclustered_buffer,
+			)
+			for i in range(num_shards)
+		]
+		self._pending_adds = []
+		self._priority_states = [None]*num_shards # The last priority state sent by every shard
+		self._pending_stats = {} # Stats requested to every shard, and not received yet
+		self._shard_stats = [None]*num_shards
+
+		# Metrics
+		self.add_batch_timer = TimerStat()
+		self.replay_timer = TimerStat()
+		self.update_priorities_timer = TimerStat()
+		self.num_added = 0
+
+	def get_shard_index(self, batch): # O(1)
+		"""Returns the shard of a (multi-agent) batch, given by its episode id, or by the number of added batches if it has no episode id."""
+		sub_batch = next(iter(batch.policy_batches.values()))
+		if SampleBatch.EPS_ID not in sub_batch or sub_batch.count == 0:
+			return self.num_added % self.num_shards
+		return int(sub_batch[SampleBatch.EPS_ID][0]) % self.num_shards
+
+	def add_batch(self, batch, update_prioritisation_weights=False):
+		# Handle everything as if multiagent
+		if isinstance(batch, SampleBatch):
+			batch = MultiAgentBatch({DEFAULT_POLICY_ID: batch}, batch.count)
+		with self.add_batch_timer:
+			shard = self.shards[self.get_shard_index(batch)]
+			self._pending_adds.append(shard.add_batch.remote(batch, update_prioritisation_weights=update_prioritisation_weights)) # calls to the same shard are executed in order, thus the batch is stored before the next replay
+			if len(self._pending_adds) > self._max_pending_adds: # wait for the slowest shards, instead of queuing batches without limit
+				self._collect_pending_adds(num_returns=len(self._pending_adds)-self._max_pending_adds)
+		self.num_added += len(batch.policy_batches)
+		return batch
+
+	def can_replay(self):
+		return self.num_added >= self.replay_starts
+
+	def _update_priority_states(self, priority_state_list): # O(num_shards)
+		for priority_state in priority_state_list:
+			last_priority_state = self._priority_states[priority_state['shard_index']]
+			if last_priority_state is None or last_priority_state['stamp'] < priority_state['stamp']:
+				self._priority_states[priority_state['shard_index']] = priority_state
+
+	def _collect_pending_adds(self, num_returns=None):
+		"""Updates the priority states with the results of the finished add_batch calls, waiting for num_returns of them if not None."""
+		if not self._pending_adds:
+			return
+		if num_returns is None:
+			ready, self._pending_adds = ray.wait(self._pending_adds, num_returns=len(self._pending_adds), timeout=0)
+		else:
+			ready, self._pending_adds = ray.wait(self._pending_adds, num_returns=num_returns)
+		self._update_priority_states(ray.get(ready))
+
+	def _fetch_priority_states(self):
+		"""Asks every shard for its priority state, waiting for the answers."""
+		self._update_priority_states(ray.get([shard.get_priority_state.remote() for shard in self.shards]))
+
+	def get_priority_mass(self):
+		"""Returns the last known priority mass of every shard, and how many batches every shard holds. 
+		The shards are asked for them only if some shard never sent its priority state, or if all the shards looked empty."""
+		self._collect_pending_adds()
+		if None in self._priority_states or not any(priority_state['batch_count'] > 0 for priority_state in self._priority_states):
+			self._fetch_priority_states()
+		return (
+			np.array([priority_state['priority_mass'] for priority_state in self._priority_states], dtype=np.float64), 
+			np.array([priority_state['batch_count'] for priority_state in self._priority_states], dtype=np.int64),
+		)
+
+	def get_weight_scale(self, policy_id, shard_probability): # O(num_shards)
+		"""Returns, for every shard, the factor turning the importance weights of its batches of policy_id into those of a single buffer holding all the shards, given the probability of sampling from every shard.
+		The weights of a shard are normalised by its lowest transition probability, while the probability of a batch in the whole buffer is the one of its shard times the one of the batch in the shard."""
+		min_probability = np.array([
+			priority_state['min_probability'].get(policy_id, np.nan)
+			for priority_state in self._priority_states
+		], dtype=np.float64)*shard_probability
+		valid_shards = np.isfinite(min_probability) & (min_probability > 0)
+		weight_scale = np.ones(self.num_shards, dtype=np.float64)
+		if valid_shards.any():
+			weight_scale[valid_shards] = (np.min(min_probability[valid_shards])/min_probability[valid_shards])**self.prioritization_importance_beta
+		return weight_scale
+
+	def _set_shard_index(self, batch, shard_index, weight_scale=1): # O(n)
+		"""Returns a shallow copy of a batch replayed by the given shard, whose batch_ids are unique among all the shards and whose importance weights are scaled by weight_scale."""
+		batch = copy.copy(batch) # the columns are shared, in local mode they may belong to the stored batch
+		batch.data = dict(batch.data)
+		batch['batch_ids'] = batch['batch_ids']*self.num_shards + shard_index
+		if weight_scale != 1 and 'weights' in batch:
+			batch['weights'] = (batch['weights']*weight_scale).astype(batch['weights'].dtype)
+		return batch
+
+	def _get_shard_batch(self, batch, row_mask=None): # O(n)
+		"""Returns a batch with the priorities of batch (in the rows selected by row_mask) and the ids its shard gave to them."""
+		priority_id = self.buffer_options['priority_id']
+		batch_ids = np.asarray(batch['batch_ids'])
+		priorities = np.asarray(batch[priority_id])
+		if row_mask is not None:
+			batch_ids = batch_ids[row_mask]
+			priorities = priorities[row_mask]
+		return SampleBatch({
+			priority_id: priorities,
+			'batch_ids': batch_ids//self.num_shards,
+		})
+
+	def replay(self, batch_count=1, cluster_overview_size=None, update_replayed_fn=None):
+		if not self.can_replay():
+			return []
+		if not cluster_overview_size:
+			cluster_overview_size = batch_count
+		else:
+			cluster_overview_size = min(cluster_overview_size,batch_count)
+
+		with self.replay_timer:
+			# Every group of cluster_overview_size batches comes from a cluster, whose shard is picked proportionally to its priority mass
+			priority_mass, batch_count_array = self.get_priority_mass()
+			is_weighted_by_priority_mass = priority_mass.sum() > 0
+			if not is_weighted_by_priority_mass: # e.g. all the priorities are 0
+				priority_mass = (batch_count_array > 0).astype(np.float64)
+				if not priority_mass.sum() > 0:
+					return []
+			shard_probability = priority_mass/priority_mass.sum()
+			group_size_list = [cluster_overview_size]*(batch_count//cluster_overview_size)
+			if batch_count%cluster_overview_size > 0:
+				group_size_list.append(batch_count%cluster_overview_size)
+			group_shard_list = np.random.choice(self.num_shards, size=len(group_size_list), p=shard_probability)
+			shard_batch_count = np.bincount(group_shard_list, weights=group_size_list, minlength=self.num_shards).astype(np.int64)
+			shard_index_list = np.flatnonzero(shard_batch_count)
+			# Sample from the shards in parallel
+			shard_batch_list, priority_state_list = zip(*ray.get([
+				self.shards[shard_index].replay.remote(
+					batch_count=int(shard_batch_count[shard_index]),
+					cluster_overview_size=cluster_overview_size,
+				)
+				for shard_index in shard_index_list
+			]))
+			self._update_priority_states(priority_state_list) # the min probabilities the weights of the replayed batches are normalised by
+			weight_scale_dict = {}
+			if self.prioritization_importance_beta and is_weighted_by_priority_mass:
+				for policy_id in unique_everseen(policy_id for samples_list in shard_batch_list for samples in samples_list for policy_id in samples.policy_batches.keys()):
+					weight_scale_dict[policy_id] = self.get_weight_scale(policy_id, shard_probability)
+			batch_list = [
+				{
+					policy_id: self._set_shard_index(batch, shard_index, weight_scale_dict[policy_id][shard_index] if policy_id in weight_scale_dict else 1)
+					for policy_id, batch in samples.policy_batches.items()
+				}
+				for shard_index, samples_list in zip(shard_index_list, shard_batch_list)
+				for samples in samples_list
+			]
+			if update_replayed_fn: # in the driver, where the policies are
+				for policy_id in unique_everseen(policy_id for samples in batch_list for policy_id in samples.keys()):
+					policy_batch_list = [samples for samples in batch_list if policy_id in samples]
+					updated_batch_list = apply_to_batch_once(update_replayed_fn, [samples[policy_id] for samples in policy_batch_list])
+					for samples, batch in zip(policy_batch_list, updated_batch_list):
+						samples[policy_id] = batch
+		return [
+			MultiAgentBatch(samples, max(map(lambda x:x.count, samples.values())))
+			for samples in batch_list
+		]
+
+	def increase_train_steps(self, t=1):
+		for shard in self.shards:
+			shard.increase_train_steps.remote(t)
+
+	def update_priorities(self, prio_dict):
+		if not self.prioritized_replay:
+			return
+		with self.update_priorities_timer:
+			shard_prio_dict_list = [{} for _ in range(self.num_shards)]
+			for policy_id, new_batch in prio_dict.items():
+				shard_prio_dict_list[get_batch_id(new_batch) % self.num_shards][policy_id] = self._get_shard_batch(new_batch)
+			for shard, shard_prio_dict in zip(self.shards, shard_prio_dict_list):
+				if shard_prio_dict:
+					shard.update_priorities.remote(shard_prio_dict)
+
+	def update_train_batch_priorities(self, prio_dict):
+		"""Same as LocalReplayBuffer.update_train_batch_priorities, the rows of every train batch are sent to the shard of their batch."""
+		if not self.prioritized_replay:
+			return
+		with self.update_priorities_timer:
+			shard_prio_dict_list = [{} for _ in range(self.num_shards)]
+			for policy_id, train_batch in prio_dict.items():
+				if 'batch_ids' not in train_batch:
+					continue
+				row_shard_index = np.asarray(train_batch['batch_ids']) % self.num_shards
+				for shard_index in np.unique(row_shard_index).tolist():
+					shard_prio_dict_list[shard_index][policy_id] = self._get_shard_batch(train_batch, row_shard_index == shard_index) # the rows of a batch stay in order
+			for shard, shard_prio_dict in zip(self.shards, shard_prio_dict_list):
+				if shard_prio_dict:
+					shard.update_train_batch_priorities.remote(shard_prio_dict)
+
+	def save(self, directory): # O(N)
+		"""Saves every shard and the clustering scheme in directory, so that they can be restored with load after a restart.
+		Every shard writes its own sub-directory, on the node it is running on."""
+		os.makedirs(directory, exist_ok=True)
+		ray.get([
+			shard.save.remote(os.path.join(directory, f'shard_{i}'))
+			for i, shard in enumerate(self.shards)
+		])
+		with open(os.path.join(directory, 'sharded_replay_buffer.pkl'), 'wb') as f:
+			pickle.dump({
+				'num_shards': self.num_shards,
+				'num_added': self.num_added,
+				'clustering_scheme': self.clustering_scheme.get_state() if self.clustering_scheme is not None else None,
+			}, f)
+
+	def load(self, directory): # O(N)
+		"""Replaces the content of every shard and the state of the clustering scheme with the ones saved in directory by save, with the same number of shards."""
+		with open(os.path.join(directory, 'sharded_replay_buffer.pkl'), 'rb') as f:
+			state = pickle.load(f)
+		assert state['num_shards'] == self.num_shards, f"The buffer was saved with {state['num_shards']} shards, but it has {self.num_shards} shards."
+		ray.get(self._pending_adds)
+		self._pending_adds = []
+		ray.get([
+			shard.load.remote(os.path.join(directory, f'shard_{i}'))
+			for i, shard in enumerate(self.shards)
+		])
+		self._priority_states = [None]*self.num_shards # the masses of the loaded shards are asked at the next replay
+		if self.clustering_scheme is not None and state['clustering_scheme'] is not None:
+			self.clustering_scheme.set_state(state['clustering_scheme']) # restored in place, it is shared with the execution plan
+		self.num_added = state['num_added']
+
+	def stats(self, debug=False):
+		"""Same as LocalReplayBuffer.stats, without waiting for the shards: the stats of a shard are the last ones it sent, and they are asked again once received."""
+		stat = {
+			"add_batch_time_ms": round(1000 * self.add_batch_timer.mean, 3),
+			"replay_time_ms": round(1000 * self.replay_timer.mean, 3),
+			"update_priorities_time_ms": round(1000 * self.update_priorities_timer.mean, 3),
+			"pending_adds": len(self._pending_adds),
+		}
+		if self._pending_stats:
+			ready = set(ray.wait(list(self._pending_stats.values()), num_returns=len(self._pending_stats), timeout=0)[0])
+			for shard_index, shard_stat_ref in list(self._pending_stats.items()):
+				if shard_stat_ref in ready:
+					self._shard_stats[shard_index] = ray.get(shard_stat_ref)
+					del self._pending_stats[shard_index]
+		for shard_index, shard in enumerate(self.shards):
+			if shard_index not in self._pending_stats:
+				self._pending_stats[shard_index] = shard.stats.remote(debug=debug)
+			if self._shard_stats[shard_index] is not None:
+				stat[f'shard_{shard_index}'] = self._shard_stats[shard_index]
+		return stat
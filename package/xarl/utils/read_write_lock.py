@@ -1,5 +1,6 @@
 import threading
 import logging
+from contextlib import contextmanager
 
 class ReadWriteLock:
 	""" A lock object that allows many simultaneous "read locks", but
@@ -60,3 +61,86 @@ class ReadWriteLock:
 		self._writerList.remove(threading.get_ident())
 		self._read_ready.notifyAll(	)
 		self._read_ready.release(	)
+
+class LightReadWriteLock:
+	""" A ReadWriteLock without logging and without per-thread lists: many
+	readers or one writer. The writer can re-acquire the write lock (e.g.
+	a callback run under it can take it again) and can downgrade it to a
+	read lock without letting other writers in. Waiting writers are
+	preferred over new readers, so that they are not starved.
+	The version counts the acquired write locks, so that readers can tell
+	whether anything was written since they last read. """
+	__slots__ = ('_cond','_readers','_writer','_write_depth','_waiting_writers','version')
+
+	def __init__(self):
+		self._cond = threading.Condition(threading.Lock())
+		self._readers = 0
+		self._writer = None # Id of the thread holding the write lock
+		self._write_depth = 0
+		self._waiting_writers = 0
+		self.version = 0
+
+	def acquire_read(self):
+		""" Acquire a read lock. Blocks while a thread holds or waits for
+		the write lock. It is not re-entrant, and a writer must not call it. """
+		with self._cond:
+			while self._writer is not None or self._waiting_writers:
+				self._cond.wait()
+			self._readers += 1
+
+	def release_read(self):
+		""" Release a read lock. """
+		with self._cond:
+			self._readers -= 1
+			if not self._readers:
+				self._cond.notify_all()
+
+	def acquire_write(self):
+		""" Acquire a write lock. Blocks until there are no read or write
+		locks held by other threads. """
+		thread_id = threading.get_ident()
+		with self._cond:
+			if self._writer == thread_id:
+				self._write_depth += 1
+				return
+			self._waiting_writers += 1
+			while self._writer is not None or self._readers:
+				self._cond.wait()
+			self._waiting_writers -= 1
+			self._writer = thread_id
+			self._write_depth = 1
+			self.version += 1
+
+	def release_write(self):
+		""" Release a write lock. """
+		with self._cond:
+			self._write_depth -= 1
+			if not self._write_depth:
+				self._writer = None
+				self._cond.notify_all()
+
+	def downgrade(self):
+		""" Turn the write lock of this thread, if not re-acquired, into a
+		read lock, to be released with release_read. """
+		with self._cond:
+			assert self._writer == threading.get_ident() and self._write_depth == 1, "only a write lock acquired once can be downgraded"
+			self._writer = None
+			self._write_depth = 0
+			self._readers += 1
+			self._cond.notify_all()
+
+	@contextmanager
+	def reading(self):
+		self.acquire_read()
+		try:
+			yield self
+		finally:
+			self.release_read()
+
+	@contextmanager
+	def writing(self):
+		self.acquire_write()
+		try:
+			yield self
+		finally:
+			self.release_write()
@@ -1,5 +1,7 @@
 import numpy as np
 
+MIN_VECTORIZED_DESCENT_SIZE = 64 # How many prefixsums SumSegmentTree.find_prefixsum_idx_batch needs to descend the tree together rather than one by one
+
 def is_tuple(val):
 	return type(val) in [list,tuple]
 
@@ -34,18 +36,44 @@ class SegmentTree(object):
 		self._neutral_element = neutral_element
 		self.inserted_elements = 0
 
-	def resize(self, new_capacity):
+	@classmethod
+	def from_array(cls, values, capacity=None, **args): # O(N)
+		"""Build a tree whose first len(values) elements are values, in O(N) rather than inserting them one by one in O(N*log(N)).
+		Args:
+			values (list): The elements to insert, as they would be passed to __setitem__.
+			capacity (Optional[int]): Total size of the tree, by default the lowest power of 2 >= len(values).
+		"""
+		if capacity is None:
+			capacity = 1
+			while capacity < len(values):
+				capacity *= 2
+		tree = cls(capacity, **args)
+		tree._set_leaves(values)
+		return tree
+
+	def _set_leaves(self, values): # O(N)
+		values = list(values)
+		assert len(values) <= self._capacity, "too many values for this capacity"
+		self._value[self._capacity:self._capacity+len(values)] = values
+		self.inserted_elements = sum(1 for v in values if v != self._neutral_element)
+		self._build()
+
+	def _build(self): # O(N)
+		# Recalculate all the reduction values (in "first half" of tree), bottom-up.
+		for idx in range(self._capacity-1, 0, -1):
+			self._value[idx] = self._operation(self._value[2 * idx], self._value[2 * idx + 1])
+
+	def resize(self, new_capacity): # O(N)
 		if new_capacity == self._capacity:
 			return
 		assert new_capacity > 0 and new_capacity & (new_capacity - 1) == 0, "new capacity must be positive and a power of 2."
 		# assert self.inserted_elements <= new_capacity, "cannot resize because new_capacity is lower than inserted_elements"
-		old_value = self._value
-		old_capacity = self._capacity
-		self._value = [neutral_element for _ in range(2 * new_capacity)]
+		old_leaves = self._value[self._capacity:self._capacity+min(self._capacity,new_capacity)]
+		self._value = [self._neutral_element for _ in range(2 * new_capacity)]
 		self._capacity = new_capacity
-		self.inserted_elements = 0
-		for i,v in enumerate(old_value[:min(old_capacity,new_capacity)]):
-			self[i] = v
+		self._value[new_capacity:new_capacity+len(old_leaves)] = old_leaves
+		self.inserted_elements = sum(1 for v in old_leaves if v != self._neutral_element)
+		self._build()
 
 	def reduce(self, start=0, end=None):
 		"""Applies `self._operation` to subsequence of our values.
@@ -156,12 +184,20 @@ class SumSegmentTree(SegmentTree):
 		self.min_tree = MinSegmentTree(capacity, neutral_element=(float('inf'),-1)) if with_min_tree else None
 		self.max_tree = MaxSegmentTree(capacity, neutral_element=(float('-inf'),-1)) if with_max_tree else None
 
-	def resize(self, new_capacity):
+	def resize(self, new_capacity): # O(N)
 		super().resize(new_capacity)
 		if self.min_tree:
 			self.min_tree.resize(new_capacity)
 		if self.max_tree:
 			self.max_tree.resize(new_capacity)
+
+	def _set_leaves(self, values): # O(N)
+		values = list(values)
+		super()._set_leaves(values)
+		if self.min_tree:
+			self.min_tree._set_leaves(zip(values, range(len(values))))
+		if self.max_tree:
+			self.max_tree._set_leaves(zip(values, range(len(values))))
 	
 	@staticmethod
 	def _operation(a, b):
@@ -178,6 +214,50 @@ class SumSegmentTree(SegmentTree):
 		"""Returns arr[start] + ... + arr[end]"""
 		return super(SumSegmentTree, self).reduce(start, end)
 
+	def shift(self, delta): # O(N)
+		"""Adds delta to all the inserted elements, rebuilding the tree (and its min/max trees) in O(N)."""
+		self._set_leaves([v+delta for v in self._value[self._capacity:self._capacity+self.inserted_elements]])
+
+	def update(self, idx_list, val_list): # O(n*log)
+		"""Same as setting self[idx] = val for every idx, val in zip(idx_list, val_list). idx_list must not contain duplicates."""
+		for idx, val in zip(np.asarray(idx_list, dtype=np.int64).tolist(), np.asarray(val_list, dtype=np.float64).tolist()):
+			self[idx] = val
+
+	def _get_mass(self, check_min=True): # O(log)
+		"""Returns the total mass of the tree and the minimum to subtract from every element of the tree during a prefixsum descent (None if no element is negative)."""
+		if self.min_tree and check_min:
+			min_p = self.min_tree.min()[0] # O(log)
+			scaled_prefix = min_p < 0
+		else:
+			scaled_prefix = False
+		mass = self.sum() # O(log)
+		if not scaled_prefix:
+			return mass, None
+		# Use it in case of negative elements in the sumtree, they would break the tree invariant
+		mass -= min_p*self.inserted_elements # scale mass by min priority
+		return mass, min(self._neutral_element, min_p)
+
+	def _find_prefixsum_idx(self, prefixsum, minimum=None): # O(log)
+		summed_elements = self._capacity
+		idx = 1
+		# While non-leaf (first half of tree).
+		while idx < self._capacity:
+			update_idx = 2 * idx
+			value = self._value[update_idx]
+			if minimum is not None:
+				summed_elements /= 2
+				value -= minimum*summed_elements
+			if value > prefixsum:
+				idx = update_idx
+			else:
+				prefixsum -= value
+				idx = update_idx + 1
+		idx -= self._capacity
+		if idx == self.inserted_elements:
+			idx -= 1
+		assert 0 <= idx < self.inserted_elements, f"{idx} has to be lower than {self.inserted_elements} and greater than 0"
+		return idx
+
 	def find_prefixsum_idx(self, prefixsum_fn, check_min=True): # O(log)
 		"""Find the highest index `i` in the array such that
 			sum(arr[0] + arr[1] + ... + arr[i - i]) <= prefixsum
@@ -197,38 +277,76 @@ class SumSegmentTree(SegmentTree):
 			return None
 		if self.inserted_elements == 1:
 			return 0
-		if self.min_tree and check_min:
-			min_p = self.min_tree.min()[0] # O(log)
-			scaled_prefix = min_p < 0
-		else:
-			scaled_prefix = False
-		mass = self.sum() # O(log)
-		if scaled_prefix: # Use it in case of negative elements in the sumtree, they would break the tree invariant
-			mass -= min_p*self.inserted_elements # scale mass by min priority
-			minimum = min(self._neutral_element, min_p)
-			summed_elements = self._capacity
+		mass, minimum = self._get_mass(check_min) # O(log)
 		prefixsum = prefixsum_fn(mass)
 		# prefixsum = np.clip(prefixsum, 0, mass)
 		# print(prefixsum,mass)
 		assert 0 <= prefixsum <= mass + 1e-5
+		return self._find_prefixsum_idx(prefixsum, minimum) # O(log)
+
+	def find_prefixsum_leaf(self, prefixsum): # O(log)
+		"""Find the leaf `i` such that
+			sum(arr[0] + ... + arr[i-1]) <= prefixsum < sum(arr[0] + ... + arr[i])
+		Differently from find_prefixsum_idx, all the leaves of the tree are considered, also the empty ones, and prefixsum is not scaled by the tree's mass.
+		"""
 		idx = 1
-		# While non-leaf (first half of tree).
 		while idx < self._capacity:
 			update_idx = 2 * idx
 			value = self._value[update_idx]
-			if scaled_prefix:
-				summed_elements /= 2
-				value -= minimum*summed_elements
 			if value > prefixsum:
 				idx = update_idx
 			else:
 				prefixsum -= value
 				idx = update_idx + 1
+		return int(idx - self._capacity)
+
+	def find_prefixsum_idx_batch(self, prefixsums, check_min=True): # O(n*log)
+		"""Same as find_prefixsum_idx, but for many prefixsums at once.
+		The tree's mass (and its minimum, if needed) is computed only once.
+		Parameters
+		----------
+		prefixsums: list of floats
+			every prefixsum is a fraction of the tree's mass, in [0,1]. E.g. see uniform_prefixsums and stratified_prefixsums.
+		Returns
+		-------
+		idx: list of ints
+			for every prefixsum, the highest index satisfying the prefixsum constraint
+		"""
+		if self.inserted_elements == 0:
+			return None
+		if self.inserted_elements == 1:
+			return [0]*len(prefixsums)
+		mass, minimum = self._get_mass(check_min) # O(log)
+		if len(prefixsums) < MIN_VECTORIZED_DESCENT_SIZE: # the vectorized descent costs a few numpy calls per level, a few prefixsums are faster one by one
+			return [
+				self._find_prefixsum_idx(p*mass, minimum) # O(log)
+				for p in prefixsums
+			]
+		prefixsum = np.asarray(prefixsums, dtype=np.float64)*mass
+		assert np.all(0 <= prefixsum) and np.all(prefixsum <= mass + 1e-5)
+		# All the prefixsums descend the tree together, level by level, as in NumpySumSegmentTree.find_prefixsum_idx_batch
+		n = len(prefixsum)
+		summed_elements = self._capacity
+		level_start = 1
+		idx = np.ones(n, dtype=np.int64)
+		# While non-leaf (first half of tree).
+		while summed_elements > 1:
+			update_idx = 2 * idx
+			if level_start <= n: # the level has at most 2n nodes, convert it all
+				value = np.array(self._value[2*level_start:4*level_start], dtype=np.float64)[update_idx-2*level_start]
+			else: # gather only the n visited nodes
+				value = np.fromiter(map(self._value.__getitem__, update_idx.tolist()), dtype=np.float64, count=n)
+			level_start *= 2
+			summed_elements //= 2
+			if minimum is not None:
+				value -= minimum*summed_elements
+			go_right = value <= prefixsum
+			prefixsum -= value*go_right
+			idx = update_idx + go_right
 		idx -= self._capacity
-		if idx == self.inserted_elements:
-			idx -= 1
-		assert 0 <= idx < self.inserted_elements, f"{idx} has to be lower than {self.inserted_elements} and greater than 0"
-		return idx
+		idx = np.minimum(idx, self.inserted_elements-1)
+		assert np.all(0 <= idx), f"{idx} has to be greater than 0"
+		return idx.tolist()
 	
 class MinSegmentTree(SegmentTree):
 	def __init__(self, capacity, neutral_element=float('inf')):
@@ -260,6 +378,687 @@ class MaxSegmentTree(SegmentTree):
 		"""Returns min(arr[start], ...,  arr[end])"""
 		return super(MaxSegmentTree, self).reduce(start, end)
 
+class NumpySegmentTree(object):
+	"""Same as SegmentTree, but nodes are stored in a contiguous float64 array instead of a Python list."""
+	
+	def __init__(self, capacity, neutral_element):
+		assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
+		self._capacity = capacity
+		self._neutral_element = neutral_element
+		self._value = np.full(2 * capacity, neutral_element, dtype=np.float64)
+		self.inserted_elements = 0
+
+	from_array = classmethod(SegmentTree.from_array.__func__)
+
+	def _get_arrays(self):
+		"""Returns the list of (attribute name, neutral element) of the arrays storing the tree."""
+		return [('_value', self._neutral_element)]
+
+	def _is_neutral(self, idx):
+		return self._value[idx] == self._neutral_element
+
+	def _count_inserted_leaves(self):
+		return int(np.count_nonzero(~self._is_neutral(slice(self._capacity, 2 * self._capacity))))
+
+	def _set_leaves(self, values): # O(N)
+		values = np.asarray(values, dtype=np.float64)
+		assert len(values) <= self._capacity, "too many values for this capacity"
+		self._value[self._capacity:self._capacity+len(values)] = values
+		self.inserted_elements = self._count_inserted_leaves()
+		self._build()
+
+	def _build(self): # O(N)
+		# Recalculate all the reduction values, bottom-up, one level at a time.
+		first_idx = self._capacity >> 1
+		while first_idx >= 1:
+			self._update_nodes(np.arange(first_idx, 2 * first_idx))
+			first_idx >>= 1
+
+	def resize(self, new_capacity): # O(N)
+		if new_capacity == self._capacity:
+			return
+		assert new_capacity > 0 and new_capacity & (new_capacity - 1) == 0, "new capacity must be positive and a power of 2."
+		n = min(self._capacity, new_capacity)
+		for name, neutral_element in self._get_arrays():
+			old_array = getattr(self, name)
+			new_array = np.full(2 * new_capacity, neutral_element, dtype=old_array.dtype)
+			new_array[new_capacity:new_capacity+n] = old_array[self._capacity:self._capacity+n]
+			setattr(self, name, new_array)
+		self._capacity = new_capacity
+		self.inserted_elements = self._count_inserted_leaves()
+		self._build()
+
+	def _set_leaf(self, idx, val):
+		self._value[idx] = val
+
+	def _get_leaf(self, idx):
+		return np.float64(self._value[idx])
+
+	def _get_node(self, idx):
+		return self._value[idx]
+
+	def reduce(self, start=0, end=None):
+		"""Same as SegmentTree.reduce."""
+		if end is None:
+			end = self.inserted_elements
+		elif end < 0:
+			end += self.inserted_elements
+		result = self._neutral_element
+		start += self._capacity
+		end += self._capacity
+		while start < end:
+			if start & 1:
+				result = self._operation(result, self._get_node(start))
+				start += 1
+			if end & 1:
+				end -= 1
+				result = self._operation(result, self._get_node(end))
+			start //= 2
+			end //= 2
+		return result
+
+	def update(self, idx_list, val_list): # O(n*log)
+		"""Same as SumSegmentTree.update, but all the leaves are written at once and their ancestors are recomputed level by level, with vectorized array operations."""
+		idx = np.asarray(idx_list, dtype=np.int64) + self._capacity
+		if len(idx) == 0:
+			return
+		self.inserted_elements += int(np.count_nonzero(self._is_neutral(idx)))
+		self._set_leaf(idx, val_list)
+		nodes = np.unique(idx >> 1)
+		while nodes[0] >= 1:
+			self._update_nodes(nodes)
+			nodes = np.unique(nodes >> 1)
+
+	def __setitem__(self, idx, val):
+		assert 0 <= idx < self._capacity
+		idx += self._capacity
+		if self._is_neutral(idx):
+			if val is None:
+				return
+			self.inserted_elements += 1
+		elif val is None:
+			self.inserted_elements -= 1
+		self._set_leaf(idx, val if val is not None else self._neutral_element)
+		self._update_path(idx >> 1)
+
+	def __getitem__(self, idx):
+		assert 0 <= idx < self._capacity
+		return self._get_leaf(idx + self._capacity)
+
+class NumpySumSegmentTree(NumpySegmentTree):
+	def __init__(self, capacity, neutral_element=0., with_min_tree=True, with_max_tree=False):
+		super(NumpySumSegmentTree, self).__init__(
+			capacity=capacity,
+			neutral_element=neutral_element
+		)
+		self.min_tree = NumpyMinSegmentTree(capacity, neutral_element=(float('inf'),-1)) if with_min_tree else None
+		self.max_tree = NumpyMaxSegmentTree(capacity, neutral_element=(float('-inf'),-1)) if with_max_tree else None
+
+	def resize(self, new_capacity): # O(N)
+		super().resize(new_capacity)
+		if self.min_tree:
+			self.min_tree.resize(new_capacity)
+		if self.max_tree:
+			self.max_tree.resize(new_capacity)
+
+	def _set_leaves(self, values): # O(N)
+		values = np.asarray(values, dtype=np.float64)
+		super()._set_leaves(values)
+		if self.min_tree:
+			self.min_tree._set_leaf_arrays(values, np.arange(len(values)))
+		if self.max_tree:
+			self.max_tree._set_leaf_arrays(values, np.arange(len(values)))
+
+	@staticmethod
+	def _operation(a, b):
+		return a+b
+
+	def _update_nodes(self, nodes): # O(len(nodes))
+		self._value[nodes] = self._value[2 * nodes] + self._value[2 * nodes + 1]
+
+	def _update_path(self, idx): # O(log)
+		value = self._value
+		while idx >= 1:
+			update_idx = 2 * idx
+			value[idx] = value[update_idx] + value[update_idx + 1]
+			idx = idx >> 1
+
+	def __setitem__(self, idx, val): # O(log)
+		super().__setitem__(idx, val)
+		if self.min_tree:
+			self.min_tree[idx] = (val,idx) if val is not None else None
+		if self.max_tree:
+			self.max_tree[idx] = (val,idx) if val is not None else None
+
+	def sum(self, start=0, end=None): # O(log)
+		"""Returns arr[start] + ... + arr[end]"""
+		return np.float64(self.reduce(start, end))
+
+	def shift(self, delta): # O(N)
+		"""Adds delta to all the inserted elements, rebuilding the tree (and its min/max trees) in O(N)."""
+		self._set_leaves(self._value[self._capacity:self._capacity+self.inserted_elements] + delta)
+
+	def update(self, idx_list, val_list): # O(n*log)
+		idx_list = np.asarray(idx_list, dtype=np.int64)
+		val_list = np.asarray(val_list, dtype=np.float64)
+		super().update(idx_list, val_list)
+		if self.min_tree:
+			self.min_tree.update(idx_list, (val_list, idx_list))
+		if self.max_tree:
+			self.max_tree.update(idx_list, (val_list, idx_list))
+
+	_get_mass = SumSegmentTree._get_mass
+	_find_prefixsum_idx = SumSegmentTree._find_prefixsum_idx
+	find_prefixsum_idx = SumSegmentTree.find_prefixsum_idx
+	find_prefixsum_leaf = SumSegmentTree.find_prefixsum_leaf
+
+	def find_prefixsum_idx_batch(self, prefixsums, check_min=True): # O(log)
+		"""Same as SumSegmentTree.find_prefixsum_idx_batch, but all the prefixsums descend the tree together, level by level, with vectorized array operations."""
+		prefixsums = np.asarray(prefixsums, dtype=np.float64)
+		if self.inserted_elements == 0:
+			return None
+		if self.inserted_elements == 1:
+			return np.zeros(len(prefixsums), dtype=np.int64)
+		mass, minimum = self._get_mass(check_min) # O(log)
+		prefixsum = prefixsums*mass
+		assert np.all(0 <= prefixsum) and np.all(prefixsum <= mass + 1e-5)
+		summed_elements = self._capacity
+		idx = np.ones(len(prefixsum), dtype=np.int64)
+		# While non-leaf (first half of tree).
+		while summed_elements > 1:
+			update_idx = 2 * idx
+			value = self._value[update_idx]
+			summed_elements //= 2
+			if minimum is not None:
+				value -= minimum*summed_elements
+			go_right = value <= prefixsum
+			prefixsum -= value*go_right
+			idx = update_idx + go_right
+		idx -= self._capacity
+		idx = np.minimum(idx, self.inserted_elements-1)
+		assert np.all(0 <= idx), f"{idx} has to be greater than 0"
+		return idx
+
+class NumpyArgSegmentTree(NumpySegmentTree):
+	"""A NumpySegmentTree whose elements are (value, idx) tuples, stored as two separate arrays: a float64 array of values and an int64 array of arg-indexes."""
+
+	def __init__(self, capacity, neutral_element):
+		neutral_value, neutral_index = neutral_element
+		super(NumpyArgSegmentTree, self).__init__(
+			capacity=capacity,
+			neutral_element=neutral_value
+		)
+		self._neutral_element = neutral_element
+		self._index = np.full(2 * capacity, neutral_index, dtype=np.int64)
+
+	def _get_arrays(self):
+		return [('_value', self._neutral_element[0]), ('_index', self._neutral_element[1])]
+
+	def _is_neutral(self, idx):
+		return (self._value[idx] == self._neutral_element[0]) & (self._index[idx] == self._neutral_element[1])
+
+	def _set_leaves(self, values): # O(N)
+		values = list(values)
+		if not values:
+			return self._set_leaf_arrays([], [])
+		self._set_leaf_arrays(*zip(*values))
+
+	def _set_leaf_arrays(self, values, indexes): # O(N)
+		assert len(values) <= self._capacity, "too many values for this capacity"
+		self._value[self._capacity:self._capacity+len(values)] = values
+		self._index[self._capacity:self._capacity+len(indexes)] = indexes
+		self.inserted_elements = self._count_inserted_leaves()
+		self._build()
+
+	def _update_nodes(self, nodes): # O(len(nodes))
+		left = 2 * nodes
+		right = left + 1
+		child = np.where(self._pick_left(self._value[left], self._index[left], self._value[right], self._index[right]), left, right)
+		self._value[nodes] = self._value[child]
+		self._index[nodes] = self._index[child]
+
+	def _set_leaf(self, idx, val):
+		self._value[idx], self._index[idx] = val
+
+	def _get_leaf(self, idx):
+		return (np.float64(self._value[idx]), int(self._index[idx]))
+
+	_get_node = _get_leaf
+
+	def _update_path(self, idx): # O(log)
+		value = self._value
+		index = self._index
+		while idx >= 1:
+			left = 2 * idx
+			right = left + 1
+			child = left if self._pick_left(value[left], index[left], value[right], index[right]) else right
+			value[idx] = value[child]
+			index[idx] = index[child]
+			idx = idx >> 1
+
+class NumpyMinSegmentTree(NumpyArgSegmentTree):
+	def __init__(self, capacity, neutral_element=(float('inf'),-1)):
+		super(NumpyMinSegmentTree, self).__init__(
+			capacity=capacity,
+			neutral_element=neutral_element
+		)
+
+	@staticmethod
+	def _pick_left(left_value, left_index, right_value, right_index):
+		return (left_value < right_value) | ((left_value == right_value) & (left_index < right_index))
+
+	@staticmethod
+	def _operation(a, b):
+		return a if a < b else b
+
+	def min(self, start=0, end=None): # O(log)
+		"""Returns min(arr[start], ...,  arr[end])"""
+		return self.reduce(start, end)
+
+class NumpyMaxSegmentTree(NumpyArgSegmentTree):
+	def __init__(self, capacity, neutral_element=(float('-inf'),-1)):
+		super(NumpyMaxSegmentTree, self).__init__(
+			capacity=capacity,
+			neutral_element=neutral_element
+		)
+
+	@staticmethod
+	def _pick_left(left_value, left_index, right_value, right_index):
+		return (left_value > right_value) | ((left_value == right_value) & (left_index > right_index))
+
+	@staticmethod
+	def _operation(a, b):
+		return a if a > b else b
+
+	def max(self, start=0, end=None): # O(log)
+		"""Returns max(arr[start], ...,  arr[end])"""
+		return self.reduce(start, end)
+
+class FusedSumSegmentTree(NumpySumSegmentTree):
+	"""A NumpySumSegmentTree whose nodes hold also the min, argmin, max and argmax of their sub-tree, so that a single upward pass updates all of them.
+	min_tree and max_tree are views over these aggregates, with the same API of NumpyMinSegmentTree and NumpyMaxSegmentTree.
+	"""
+
+	def __init__(self, capacity, neutral_element=0., with_min_tree=True, with_max_tree=False):
+		NumpySegmentTree.__init__(self,
+			capacity=capacity,
+			neutral_element=neutral_element
+		)
+		self._min = np.full(2 * capacity, float('inf'), dtype=np.float64)
+		self._argmin = np.full(2 * capacity, -1, dtype=np.int64)
+		self._max = np.full(2 * capacity, float('-inf'), dtype=np.float64)
+		self._argmax = np.full(2 * capacity, -1, dtype=np.int64)
+		self._path_shifts = np.arange(capacity.bit_length()) # leaf, parent, ..., root
+		self.min_tree = FusedMinSegmentTree(self) if with_min_tree else None
+		self.max_tree = FusedMaxSegmentTree(self) if with_max_tree else None
+
+	def _get_arrays(self):
+		return [
+			('_value', self._neutral_element), 
+			('_min', float('inf')), 
+			('_argmin', -1), 
+			('_max', float('-inf')), 
+			('_argmax', -1),
+		]
+
+	def resize(self, new_capacity): # O(N)
+		NumpySegmentTree.resize(self, new_capacity)
+		self._path_shifts = np.arange(self._capacity.bit_length())
+
+	def _set_leaves(self, values): # O(N)
+		values = np.asarray(values, dtype=np.float64)
+		assert len(values) <= self._capacity, "too many values for this capacity"
+		leaves = slice(self._capacity, self._capacity+len(values))
+		self._value[leaves] = self._min[leaves] = self._max[leaves] = values
+		self._argmin[leaves] = self._argmax[leaves] = np.arange(len(values))
+		self.inserted_elements = self._count_inserted_leaves()
+		self._build()
+
+	def _update_nodes(self, nodes): # O(len(nodes))
+		left = 2 * nodes
+		right = left + 1
+		self._value[nodes] = self._value[left] + self._value[right]
+		child = np.where(NumpyMinSegmentTree._pick_left(self._min[left], self._argmin[left], self._min[right], self._argmin[right]), left, right)
+		self._min[nodes] = self._min[child]
+		self._argmin[nodes] = self._argmin[child]
+		child = np.where(NumpyMaxSegmentTree._pick_left(self._max[left], self._argmax[left], self._max[right], self._argmax[right]), left, right)
+		self._max[nodes] = self._max[child]
+		self._argmax[nodes] = self._argmax[child]
+
+	def _set_leaf(self, idx, val):
+		self._value[idx] = self._min[idx] = self._max[idx] = val
+		self._argmin[idx] = self._argmax[idx] = idx - self._capacity
+
+	def update(self, idx_list, val_list): # O(n*log)
+		NumpySegmentTree.update(self, idx_list, np.asarray(val_list, dtype=np.float64))
+
+	def __setitem__(self, idx, val): # O(log)
+		assert 0 <= idx < self._capacity
+		leaf = idx + self._capacity
+		if self._is_neutral(leaf):
+			if val is None:
+				return
+			self.inserted_elements += 1
+		elif val is None:
+			self.inserted_elements -= 1
+		if val is None:
+			self._value[leaf] = self._neutral_element
+			self._min[leaf], self._argmin[leaf] = float('inf'), -1
+			self._max[leaf], self._argmax[leaf] = float('-inf'), -1
+			val = self._neutral_element
+		else:
+			self._value[leaf] = self._min[leaf] = self._max[leaf] = val
+			self._argmin[leaf] = self._argmax[leaf] = idx
+		# Every sum in the path is the cumulative sum of the new leaf and the siblings of the path
+		path = leaf >> self._path_shifts
+		self._value[path] = np.cumsum(np.concatenate(([val], self._value[path[:-1] ^ 1])))
+		# Min and max are updated in the same pass, until they stop changing
+		min_value, argmin, max_value, argmax = self._min, self._argmin, self._max, self._argmax
+		update_min = update_max = True
+		idx = leaf >> 1
+		while idx >= 1 and (update_min or update_max):
+			left = 2 * idx
+			right = left + 1
+			if update_min:
+				child = left if NumpyMinSegmentTree._pick_left(min_value[left], argmin[left], min_value[right], argmin[right]) else right
+				if min_value[idx] == min_value[child] and argmin[idx] == argmin[child]:
+					update_min = False
+				else:
+					min_value[idx] = min_value[child]
+					argmin[idx] = argmin[child]
+			if update_max:
+				child = left if NumpyMaxSegmentTree._pick_left(max_value[left], argmax[left], max_value[right], argmax[right]) else right
+				if max_value[idx] == max_value[child] and argmax[idx] == argmax[child]:
+					update_max = False
+				else:
+					max_value[idx] = max_value[child]
+					argmax[idx] = argmax[child]
+			idx = idx >> 1
+
+	def sum(self, start=0, end=None): # O(log)
+		"""Returns arr[start] + ... + arr[end]"""
+		if start == 0 and end is None: # O(1), empty leaves hold the neutral element
+			return np.float64(self._value[1])
+		return super().sum(start, end)
+
+class FusedArgSegmentTree(object):
+	"""A read-only view over the (value, idx) aggregates of a FusedSumSegmentTree."""
+
+	def __init__(self, tree, value_name, index_name):
+		self._tree = tree
+		self._value_name = value_name
+		self._index_name = index_name
+
+	@property
+	def _value(self):
+		return getattr(self._tree, self._value_name)
+
+	@property
+	def _index(self):
+		return getattr(self._tree, self._index_name)
+
+	def _get_node(self, idx):
+		return (np.float64(self._value[idx]), int(self._index[idx]))
+
+	def reduce(self, start=0, end=None):
+		"""Same as SegmentTree.reduce."""
+		if start == 0 and end is None: # O(1), empty leaves hold the neutral element
+			return self._get_node(1)
+		tree = self._tree
+		if end is None:
+			end = tree.inserted_elements
+		elif end < 0:
+			end += tree.inserted_elements
+		result = self._neutral_element
+		start += tree._capacity
+		end += tree._capacity
+		while start < end:
+			if start & 1:
+				result = self._operation(result, self._get_node(start))
+				start += 1
+			if end & 1:
+				end -= 1
+				result = self._operation(result, self._get_node(end))
+			start //= 2
+			end //= 2
+		return result
+
+	def __getitem__(self, idx):
+		assert 0 <= idx < self._tree._capacity
+		return self._get_node(idx + self._tree._capacity)
+
+class FusedMinSegmentTree(FusedArgSegmentTree):
+	_neutral_element = (float('inf'),-1)
+	_operation = staticmethod(NumpyMinSegmentTree._operation)
+
+	def __init__(self, tree):
+		super().__init__(tree, '_min', '_argmin')
+
+	def min(self, start=0, end=None): # O(log)
+		"""Returns min(arr[start], ...,  arr[end])"""
+		return self.reduce(start, end)
+
+class FusedMaxSegmentTree(FusedArgSegmentTree):
+	_neutral_element = (float('-inf'),-1)
+	_operation = staticmethod(NumpyMaxSegmentTree._operation)
+
+	def __init__(self, tree):
+		super().__init__(tree, '_max', '_argmax')
+
+	def max(self, start=0, end=None): # O(log)
+		"""Returns max(arr[start], ...,  arr[end])"""
+		return self.reduce(start, end)
+
+class KarySumSegmentTree(object):
+	"""A sum tree where every node has branching_factor children instead of 2, and every level is stored in its own contiguous float64 array.
+	The children of a node are a contiguous block of the next level, hence a descent scans one block per level with a vectorized cumulative sum.
+	With branching_factor=16 the tree is 4 times shallower than a binary one. Min and max trees, if any, are binary NumpyMinSegmentTree and NumpyMaxSegmentTree.
+	"""
+
+	def __init__(self, capacity, neutral_element=0., with_min_tree=True, with_max_tree=False, branching_factor=16):
+		assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
+		assert branching_factor > 1, "branching_factor must be greater than 1."
+		self._branching_factor = branching_factor
+		self._neutral_element = neutral_element
+		self._init_levels(capacity)
+		self.inserted_elements = 0
+		self.min_tree = NumpyMinSegmentTree(capacity, neutral_element=(float('inf'),-1)) if with_min_tree else None
+		self.max_tree = NumpyMaxSegmentTree(capacity, neutral_element=(float('-inf'),-1)) if with_max_tree else None
+
+	from_array = classmethod(SegmentTree.from_array.__func__)
+
+	def _init_levels(self, capacity):
+		self._capacity = capacity
+		self._leaves_count = 1
+		while self._leaves_count < capacity:
+			self._leaves_count *= self._branching_factor
+		# self._levels[0] is the root, self._levels[-1] are the leaves
+		self._levels = []
+		level_size = self._leaves_count
+		while True:
+			self._levels.insert(0, np.full(level_size, self._neutral_element, dtype=np.float64))
+			if level_size == 1:
+				break
+			level_size //= self._branching_factor
+
+	@property
+	def _leaves(self):
+		return self._levels[-1]
+
+	def _build(self): # O(N)
+		for i in range(len(self._levels)-1, 0, -1):
+			self._levels[i-1][:] = self._levels[i].reshape(-1, self._branching_factor).sum(axis=1)
+
+	def _set_leaves(self, values): # O(N)
+		values = np.asarray(values, dtype=np.float64)
+		assert len(values) <= self._capacity, "too many values for this capacity"
+		self._leaves[:len(values)] = values
+		self.inserted_elements = int(np.count_nonzero(self._leaves != self._neutral_element))
+		self._build()
+		if self.min_tree:
+			self.min_tree._set_leaf_arrays(values, np.arange(len(values)))
+		if self.max_tree:
+			self.max_tree._set_leaf_arrays(values, np.arange(len(values)))
+
+	def resize(self, new_capacity): # O(N)
+		if new_capacity == self._capacity:
+			return
+		assert new_capacity > 0 and new_capacity & (new_capacity - 1) == 0, "new capacity must be positive and a power of 2."
+		old_leaves = self._leaves[:min(self._capacity, new_capacity)]
+		self._init_levels(new_capacity)
+		self._leaves[:len(old_leaves)] = old_leaves
+		self.inserted_elements = int(np.count_nonzero(self._leaves != self._neutral_element))
+		self._build()
+		if self.min_tree:
+			self.min_tree.resize(new_capacity)
+		if self.max_tree:
+			self.max_tree.resize(new_capacity)
+
+	def shift(self, delta): # O(N)
+		"""Adds delta to all the inserted elements, rebuilding the tree (and its min/max trees) in O(N)."""
+		self._set_leaves(self._leaves[:self.inserted_elements] + delta)
+
+	def __setitem__(self, idx, val): # O(k*log_k)
+		assert 0 <= idx < self._capacity
+		leaves = self._leaves
+		if leaves[idx] == self._neutral_element:
+			if val is None:
+				return
+			self.inserted_elements += 1
+		elif val is None:
+			self.inserted_elements -= 1
+		leaves[idx] = val if val is not None else self._neutral_element
+		k = self._branching_factor
+		node = idx
+		for i in range(len(self._levels)-1, 0, -1):
+			block_start = node - node % k
+			node //= k
+			self._levels[i-1][node] = self._levels[i][block_start:block_start+k].sum()
+		if self.min_tree:
+			self.min_tree[idx] = (val,idx) if val is not None else None
+		if self.max_tree:
+			self.max_tree[idx] = (val,idx) if val is not None else None
+
+	def update(self, idx_list, val_list): # O(n*k*log_k)
+		"""Same as SumSegmentTree.update, but all the leaves are written at once and their ancestors are recomputed level by level, with vectorized array operations."""
+		idx_list = np.asarray(idx_list, dtype=np.int64)
+		val_list = np.asarray(val_list, dtype=np.float64)
+		if len(idx_list) == 0:
+			return
+		assert np.all((0 <= idx_list) & (idx_list < self._capacity))
+		self.inserted_elements += int(np.count_nonzero(self._leaves[idx_list] == self._neutral_element))
+		self._leaves[idx_list] = val_list
+		k = self._branching_factor
+		nodes = idx_list
+		for i in range(len(self._levels)-1, 0, -1):
+			nodes = np.unique(nodes // k)
+			self._levels[i-1][nodes] = self._levels[i][nodes[:,None]*k + np.arange(k)].sum(axis=1)
+		if self.min_tree:
+			self.min_tree.update(idx_list, (val_list, idx_list))
+		if self.max_tree:
+			self.max_tree.update(idx_list, (val_list, idx_list))
+
+	def __getitem__(self, idx):
+		assert 0 <= idx < self._capacity
+		return np.float64(self._leaves[idx])
+
+	def _prefix_sum(self, end): # O(k*log_k)
+		"""Returns arr[0] + ... + arr[end-1]"""
+		result = 0.
+		k = self._branching_factor
+		for level in reversed(self._levels):
+			block_start = end - end % k
+			result += level[block_start:end].sum()
+			end //= k
+		return result
+
+	def sum(self, start=0, end=None): # O(k*log_k)
+		"""Returns arr[start] + ... + arr[end]"""
+		if start == 0 and end is None: # O(1), empty leaves hold the neutral element
+			return np.float64(self._levels[0][0])
+		if end is None:
+			end = self.inserted_elements
+		elif end < 0:
+			end += self.inserted_elements
+		end = min(end, self._leaves_count)
+		if start >= end:
+			return np.float64(0.)
+		if start == 0:
+			return np.float64(self._prefix_sum(end))
+		return np.float64(self._prefix_sum(end) - self._prefix_sum(start))
+
+	_get_mass = SumSegmentTree._get_mass
+	find_prefixsum_idx = SumSegmentTree.find_prefixsum_idx
+
+	def _find_prefixsum_idx(self, prefixsum, minimum=None): # O(k*log_k)
+		k = self._branching_factor
+		summed_elements = self._leaves_count
+		idx = 0
+		for level in self._levels[1:]:
+			block = level[idx*k:(idx+1)*k]
+			summed_elements //= k
+			if minimum is not None:
+				block = block - minimum*summed_elements
+			cumsum = np.cumsum(block)
+			child = min(int(np.searchsorted(cumsum, prefixsum, side='right')), k-1)
+			if child > 0:
+				prefixsum -= cumsum[child-1]
+			idx = idx*k + child
+		return min(idx, self.inserted_elements-1)
+
+	def find_prefixsum_leaf(self, prefixsum): # O(k*log_k)
+		"""Same as SumSegmentTree.find_prefixsum_leaf."""
+		k = self._branching_factor
+		idx = 0
+		for level in self._levels[1:]:
+			cumsum = np.cumsum(level[idx*k:(idx+1)*k])
+			child = min(int(np.searchsorted(cumsum, prefixsum, side='right')), k-1)
+			if child > 0:
+				prefixsum -= cumsum[child-1]
+			idx = idx*k + child
+		return int(min(idx, self._capacity-1)) # the leaves after self._capacity are just padding
+
+	def find_prefixsum_idx_batch(self, prefixsums, check_min=True): # O(k*log_k)
+		"""Same as SumSegmentTree.find_prefixsum_idx_batch, but all the prefixsums descend the tree together, scanning one block of children per prefixsum and per level."""
+		prefixsums = np.asarray(prefixsums, dtype=np.float64)
+		if self.inserted_elements == 0:
+			return None
+		if self.inserted_elements == 1:
+			return np.zeros(len(prefixsums), dtype=np.int64)
+		mass, minimum = self._get_mass(check_min) # O(log)
+		prefixsum = prefixsums*mass
+		assert np.all(0 <= prefixsum) and np.all(prefixsum <= mass + 1e-5)
+		k = self._branching_factor
+		children = np.arange(k)
+		rows = np.arange(len(prefixsum))
+		summed_elements = self._leaves_count
+		idx = np.zeros(len(prefixsum), dtype=np.int64)
+		for level in self._levels[1:]:
+			blocks = level[(idx*k)[:,None] + children]
+			summed_elements //= k
+			if minimum is not None:
+				blocks = blocks - minimum*summed_elements
+			cumsum = np.cumsum(blocks, axis=1)
+			child = np.minimum(np.count_nonzero(cumsum <= prefixsum[:,None], axis=1), k-1)
+			prefixsum -= np.where(child > 0, cumsum[rows, child-1], 0.)
+			idx = idx*k + child
+		return np.minimum(idx, self.inserted_elements-1)
+
+def uniform_prefixsums(n):
+	"""Returns n prefixsums (as fractions of a tree's mass) drawn uniformly at random."""
+	return np.random.random(n)
+
+def stratified_prefixsums(n):
+	"""Returns n prefixsums (as fractions of a tree's mass), one drawn from each of n equal-mass segments."""
+	return (np.arange(n) + np.random.random(n))/n
+
+segment_tree_backends = {
+	'python': (SumSegmentTree, MinSegmentTree),
+	'numpy': (NumpySumSegmentTree, NumpyMinSegmentTree),
+	'fused': (FusedSumSegmentTree, NumpyMinSegmentTree),
+	'kary': (KarySumSegmentTree, NumpyMinSegmentTree),
+}
+
 # from random import random
 # test = SumSegmentTree(4)
 # test[2] = -10
@@ -121,9 +121,20 @@ def test(tester_class, config, environment_class, checkpoint, save_gif=True, del
 				# Remove unzipped GIF
 				os.remove(gif_filename)
 
-def train(trainer_class, config, environment_class, test_every_n_step=None, stop_training_after_n_step=None, log=True):
+def get_local_replay_buffer(agent):
+	"""Returns the LocalReplayBuffer of the agent, if any."""
+	return getattr(agent.workers.local_worker(), 'local_replay_buffer', None)
+
+def train(trainer_class, config, environment_class, test_every_n_step=None, stop_training_after_n_step=None, log=True, checkpoint=None):
 	# Configure RLlib to train a policy using the given environment and trainer
 	agent = trainer_class(config, env=environment_class)
+	if checkpoint is not None: # Resume training, with the replay buffer saved along with the checkpoint
+		agent.restore(checkpoint)
+		replay_buffer_directory = os.path.join(os.path.dirname(checkpoint), 'replay_buffer')
+		local_replay_buffer = get_local_replay_buffer(agent)
+		if local_replay_buffer is not None and os.path.isdir(replay_buffer_directory):
+			local_replay_buffer.load(replay_buffer_directory)
+			print(f'Replay buffer restored from {replay_buffer_directory}')
 	# Inspect the trained policy and model, to see the results of training in detail
 	policy = agent.get_policy()
 	if not policy:
@@ -185,6 +196,11 @@ def train(trainer_class, config, environment_class, test_every_n_step=None, stop
 	def save_checkpoint():
 		checkpoint = agent.save()
 		print(f'Checkpoint saved in {checkpoint}')
+		local_replay_buffer = get_local_replay_buffer(agent)
+		if local_replay_buffer is not None:
+			replay_buffer_directory = os.path.join(os.path.dirname(checkpoint), 'replay_buffer')
+			local_replay_buffer.save(replay_buffer_directory)
+			print(f'Replay buffer saved in {replay_buffer_directory}')
 		print(f'Testing..')
 		try:
 			test(trainer_class, config, environment_class, checkpoint)